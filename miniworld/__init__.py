@@ -1,3 +1,21 @@
-from miniworld import envs, miniworld
+import os
+
+import pyglet
+
+# The OpenGL context backend environments render with, "window" (invisible
+# pyglet windows) or "egl" (surfaceless EGL context, needing no X server)
+GL_CONTEXT = os.environ.get("MINIWORLD_GL_CONTEXT", "window")
+
+# The pyglet options must be set before pyglet.gl is imported
+# PYOPENGL_PLATFORM=egl is a solution to
+# https://github.com/maximecb/gym-miniworld/issues/24
+# until pyglet support egl officially
+if GL_CONTEXT == "egl" or os.environ.get("PYOPENGL_PLATFORM", None) == "egl":
+    pyglet.options["headless"] = True
+if GL_CONTEXT == "egl":
+    # Do not create the pyglet shadow window when importing pyglet.gl
+    pyglet.options["shadow_window"] = False
+
+from miniworld import envs, miniworld  # noqa: E402
 
 __version__ = "2.1.0"
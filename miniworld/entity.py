@@ -3,11 +3,11 @@ import math
 import numpy as np
 
 # Map of color names to RGB values
-from pyglet.gl import (
+from miniworld.gl import (
     GL_DEPTH_TEST,
     GL_LIGHTING,
-    GL_LINES,
     GL_LINE_LOOP,
+    GL_LINES,
     GL_QUADS,
     GL_TEXTURE_2D,
     GL_TRIANGLES,
@@ -26,10 +26,9 @@ from pyglet.gl import (
     glTranslatef,
     glVertex3f,
 )
-
 from miniworld.math import X_VEC, Y_VEC, Z_VEC, gen_rot_matrix
 from miniworld.objmesh import ObjMesh
-from miniworld.opengl import Texture, drawBox
+from miniworld.opengl import InstancedGeometry, Texture, drawBox
 
 COLORS = {
     "red": np.array([1.0, 0.0, 0.0]),
@@ -45,6 +44,10 @@ COLOR_NAMES = sorted(list(COLORS.keys()))
 
 
 class Entity:
+    # Geometry shared by entities drawn with instanced rendering,
+    # None for entities which can only be drawn with render()
+    instance_geom = None
+
     def __init__(self):
         # World position
         # Note: for most entities, the position is at floor level
@@ -71,6 +74,13 @@ class Entity:
         """
         raise NotImplementedError
 
+    def instance_params(self):
+        """
+        Parameters used to draw this entity with its instance_geom:
+        position, rotation angle, scale, normal scale and color
+        """
+        raise NotImplementedError
+
     def step(self, delta_time):
         """
         Update the state of the object
@@ -151,6 +161,8 @@ class MeshEnt(Entity):
         self.radius = math.sqrt(sx * sx + sz * sz) * self.scale
         self.height = height
 
+        self.instance_geom = self.mesh.instanced_geom
+
     def render(self):
         """
         Draw the object
@@ -164,6 +176,10 @@ class MeshEnt(Entity):
         self.mesh.render()
         glPopMatrix()
 
+    def instance_params(self):
+        s = self.scale
+        return [*self.pos, self.dir, s, s, s, 1 / s, 1, 1, 1]
+
     @property
     def is_static(self):
         return self.static
@@ -392,6 +408,9 @@ class Box(Entity):
     Colored box object
     """
 
+    # Box of size 1, scaled to the size of each box
+    instance_geom = InstancedGeometry.unit_box()
+
     def __init__(self, color, size=0.8):
         super().__init__()
 
@@ -435,6 +454,9 @@ class Box(Entity):
 
         glPopMatrix()
 
+    def instance_params(self):
+        return [*self.pos, self.dir, *self.size, 1, *self.color_vec]
+
 
 class Key(MeshEnt):
     """
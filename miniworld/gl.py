@@ -0,0 +1,37 @@
+"""
+OpenGL bindings, forwarded from pyglet.gl
+
+OpenGL is optional: if pyglet.gl can't be loaded (e.g. on machines without
+an OpenGL library), the OpenGL names are placeholders raising an error when
+called, so that environments created without OpenGL (use_gl=False) can
+still be used and drawn from above in software (see softrender.py).
+"""
+
+try:
+    import pyglet.gl as _gl
+except ImportError as e:
+    _gl = None
+    _error = e
+
+
+class Unavailable:
+    """
+    Placeholder for an OpenGL name when OpenGL can't be loaded
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        raise RuntimeError(f"OpenGL is not available, can't call {self.name}: {_error}")
+
+
+def __getattr__(name):
+    if _gl is not None:
+        return getattr(_gl, name)
+
+    # OpenGL functions, constants and types
+    if name.startswith(("gl", "GL")):
+        return Unavailable(name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,171 @@
+"""
+OpenGL contexts environments render with, one per process, shared by all
+the environments. The backends are only imported by environments using
+OpenGL, as they need it to be available.
+"""
+
+import atexit
+import os
+from ctypes import byref
+
+import pyglet
+
+from miniworld.opengl import ResourceManager
+
+
+class ShadowWindow(pyglet.window.Window):
+    """
+    Invisible window providing an OpenGL context to render into
+    A single window is used per process (see get), shared by all
+    environments. It is only closed explicitly, by close_instance (at
+    exit at the latest), as closing a window switches the current OpenGL
+    context.
+    """
+
+    # Window of each process, indexed by process id. The windows inherited
+    # by forked processes are kept, as they belong to the parent process.
+    instances = {}
+
+    @classmethod
+    def get(cls):
+        """
+        Get the window of the current process, creating it if needed
+        """
+
+        pid = os.getpid()
+        if pid not in cls.instances:
+            cls.instances[pid] = ShadowWindow()
+            atexit.register(cls.close_instance)
+
+        return cls.instances[pid]
+
+    @classmethod
+    def close_instance(cls):
+        """
+        Close the window of the current process, if it was created
+        The environments rendering with it can't be used afterwards.
+        This must not be called while rendering.
+        """
+
+        window = cls.instances.pop(os.getpid(), None)
+        if window is not None:
+            window.switch_to()
+            window.resources.release_all()
+            window.close()
+
+    def __init__(self):
+        super().__init__(width=1, height=1, visible=False)
+
+        # Textures and meshes used by the environments rendering with
+        # this window
+        self.resources = ResourceManager()
+
+
+class EGLContext(pyglet.gl.base.Context):
+    """
+    Surfaceless EGL context, rendering only into frame buffer objects
+    It needs no window system (e.g. Mesa llvmpipe on headless machines).
+    A single context is created per process, shared by all environments.
+    """
+
+    # Context of the current process
+    instance = None
+
+    # EGL platform of surfaceless Mesa displays
+    EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+
+    @classmethod
+    def get(cls):
+        """
+        Get the EGL context of the current process, creating it if needed
+        Contexts are not inherited by forked processes.
+        """
+
+        if cls.instance is None or cls.instance.pid != os.getpid():
+            cls.instance = EGLContext()
+
+        return cls.instance
+
+    def __init__(self):
+        # EGL is only loaded when used, as it is not available everywhere
+        from pyglet.libs.egl import egl, eglext
+
+        super().__init__(config=None)
+
+        self.pid = os.getpid()
+
+        # Textures and meshes used by the environments rendering with
+        # this context
+        self.resources = ResourceManager()
+
+        self.display = eglext.eglGetPlatformDisplayEXT(
+            self.EGL_PLATFORM_SURFACELESS_MESA, None, None
+        )
+        if not self.display:
+            # Fall back to the first EGL device
+            num_devices = egl.EGLint()
+            eglext.eglQueryDevicesEXT(0, None, byref(num_devices))
+            if num_devices.value == 0:
+                raise RuntimeError("no EGL device available")
+            devices = (eglext.EGLDeviceEXT * num_devices.value)()
+            eglext.eglQueryDevicesEXT(num_devices.value, devices, byref(num_devices))
+            self.display = eglext.eglGetPlatformDisplayEXT(
+                eglext.EGL_PLATFORM_DEVICE_EXT, devices[0], None
+            )
+
+        # These calls must not be made in asserts, which python -O strips
+        if not egl.eglInitialize(self.display, None, None):
+            raise RuntimeError("failed to initialize EGL")
+        if not egl.eglBindAPI(egl.EGL_OPENGL_API):
+            raise RuntimeError("failed to bind the OpenGL API to EGL")
+
+        # Any surface type, as the context renders without surfaces
+        attribs = (egl.EGLint * 5)(
+            egl.EGL_SURFACE_TYPE,
+            0,
+            egl.EGL_RENDERABLE_TYPE,
+            egl.EGL_OPENGL_BIT,
+            egl.EGL_NONE,
+        )
+        config = egl.EGLConfig()
+        num_configs = egl.EGLint()
+        egl.eglChooseConfig(self.display, attribs, byref(config), 1, num_configs)
+        if num_configs.value == 0:
+            raise RuntimeError("no EGL config supporting OpenGL")
+
+        self.egl_context = egl.eglCreateContext(self.display, config, None, None)
+        if not self.egl_context:
+            raise RuntimeError("failed to create EGL context")
+
+        # pyglet only makes contexts attached to a canvas current,
+        # this context draws into the frame buffer objects of the display
+        self.canvas = self.display
+
+        self.set_current()
+
+    def set_current(self):
+        from pyglet.libs.egl import egl
+
+        if not egl.eglMakeCurrent(self.display, None, None, self.egl_context):
+            raise RuntimeError("failed to make the EGL context current")
+        super().set_current()
+
+    def switch_to(self):
+        """
+        Make the context current, if it is not already
+        """
+
+        if pyglet.gl.current_context is not self:
+            self.set_current()
+
+
+# OpenGL context backends, getting the context environments render with,
+# indexed by name. Each backend has a single context per process, shared by
+# all environments, with a resource manager counting the textures and
+# meshes each environment uses.
+GL_CONTEXTS = {
+    # Invisible pyglet window
+    "window": ShadowWindow.get,
+    # Surfaceless EGL context shared by all environments
+    "egl": EGLContext.get,
+}
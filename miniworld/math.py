@@ -7,6 +7,9 @@ X_VEC = np.array([1, 0, 0])
 Y_VEC = np.array([0, 1, 0])
 Z_VEC = np.array([0, 0, 1])
 
+# Texture size/density in texels/meter
+TEX_DENSITY = 512
+
 
 def gen_rot_matrix(axis, angle):
     """
@@ -27,6 +30,173 @@ def gen_rot_matrix(axis, angle):
     )
 
 
+def perspective(fov_y, aspect, near, far):
+    """
+    Perspective projection matrix, as computed by gluPerspective
+    The field of view is in degrees
+    """
+
+    f = 1 / math.tan(fov_y * math.pi / 360)
+
+    return np.array(
+        [
+            [f / aspect, 0, 0, 0],
+            [0, f, 0, 0],
+            [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+            [0, 0, -1, 0],
+        ]
+    )
+
+
+def ortho(left, right, bottom, top, near, far):
+    """
+    Orthographic projection matrix, as computed by glOrtho
+    """
+
+    return np.array(
+        [
+            [2 / (right - left), 0, 0, -(right + left) / (right - left)],
+            [0, 2 / (top - bottom), 0, -(top + bottom) / (top - bottom)],
+            [0, 0, -2 / (far - near), -(far + near) / (far - near)],
+            [0, 0, 0, 1],
+        ]
+    )
+
+
+def look_at(eye, target, up):
+    """
+    View matrix looking from eye towards target, as computed by gluLookAt
+    """
+
+    f = np.asarray(target, dtype=np.float64) - eye
+    f = f / np.linalg.norm(f)
+    s = np.cross(f, up)
+    s = s / np.linalg.norm(s)
+    u = np.cross(s, f)
+
+    m = np.identity(4)
+    m[0, :3] = s
+    m[1, :3] = u
+    m[2, :3] = -f
+    m[:3, 3] = -m[:3, :3] @ eye
+
+    return m
+
+
+def fit_extents(min_x, max_x, min_z, max_z, aspect):
+    """
+    Grow the extents of a top view to match an image aspect ratio,
+    keeping them centered
+    """
+
+    width = max_x - min_x
+    height = max_z - min_z
+
+    if width / height > aspect:
+        # Want to add to denom, add to height
+        h_diff = width / aspect - height
+        min_z -= h_diff / 2
+        max_z += h_diff / 2
+    elif width / height < aspect:
+        # Want to add to num, add to width
+        w_diff = height * aspect - width
+        min_x -= w_diff / 2
+        max_x += w_diff / 2
+
+    return min_x, max_x, min_z, max_z
+
+
+def frustum_planes(m):
+    """
+    Planes of the view frustum of a projection * view matrix
+    Returns an array of shape (6, 4), points p inside the frustum
+    satisfy planes @ (p, 1) >= 0
+    """
+
+    return np.array(
+        [m[3] + m[0], m[3] - m[0], m[3] + m[1], m[3] - m[1], m[3] + m[2], m[3] - m[2]]
+    )
+
+
+def boxes_in_frustum(planes, mins, maxs):
+    """
+    Test which axis-aligned boxes may be inside a view frustum
+    The boxes are given by their min and max corners, of shape (N, 3).
+    The test is conservative: some boxes near the frustum corners
+    are reported as inside.
+    """
+
+    # For each plane, take the box corner furthest along the plane normal
+    normals = planes[:, :3]
+    corners = np.where(normals >= 0, maxs[:, None, :], mins[:, None, :])
+    dists = np.einsum("npk,pk->np", corners, normals) + planes[:, 3]
+
+    return np.all(dists >= 0, axis=1)
+
+
+def clip_polygon(poly, planes):
+    """
+    Clip a convex polygon, of shape (N, 3), against a list of planes
+    Returns the part of the polygon inside all the planes, or None if
+    the polygon is entirely outside.
+    """
+
+    for plane in planes:
+        dists = poly @ plane[:3] + plane[3]
+
+        if np.all(dists >= 0):
+            continue
+        if np.all(dists < 0):
+            return None
+
+        # Keep the inside vertices, and add the intersections
+        # of the edges crossing the plane
+        clipped = []
+        for i in range(len(poly)):
+            j = (i + 1) % len(poly)
+            if dists[i] >= 0:
+                clipped.append(poly[i])
+            if (dists[i] >= 0) != (dists[j] >= 0):
+                t = dists[i] / (dists[i] - dists[j])
+                clipped.append(poly[i] + t * (poly[j] - poly[i]))
+
+        if len(clipped) < 3:
+            return None
+
+        poly = np.array(clipped)
+
+    return poly
+
+
+def polygon_planes(eye, poly):
+    """
+    Planes through an eye position and the edges of a convex polygon,
+    bounding the volume visible from the eye through the polygon
+    Returns an array of shape (M, 4), in the format of frustum_planes.
+    """
+
+    center = poly.mean(axis=0)
+    planes = []
+
+    for i in range(len(poly)):
+        normal = np.cross(poly[i] - eye, poly[(i + 1) % len(poly)] - eye)
+        norm = np.linalg.norm(normal)
+
+        # Skip the degenerate edges
+        if norm < 1e-9:
+            continue
+
+        normal = normal / norm
+
+        # Orient the plane towards the inside of the polygon
+        if np.dot(normal, center - eye) < 0:
+            normal = -normal
+
+        planes.append([*normal, -np.dot(normal, eye)])
+
+    return np.array(planes).reshape(-1, 4)
+
+
 def intersect_circle_segs(point, radius, segs):
     """
     Test if a circle intersects with any wall segments
@@ -60,3 +230,72 @@ def intersect_circle_segs(point, radius, segs):
 
     # No intersection
     return None
+
+
+class SegmentGrid:
+    """
+    Uniform grid over the X-Z plane indexing wall segments, of shape
+    (N, 2, 3), by the grid cells their bounding boxes overlap, so that
+    collision tests only check the segments near the tested position
+    """
+
+    def __init__(self, segs, cell_size=1.0):
+        self.segs = segs
+        self.cell_size = cell_size
+
+        xz = segs[:, :, [0, 2]]
+        self.origin = xz.reshape(-1, 2).min(axis=0) if len(segs) > 0 else np.zeros(2)
+
+        # Range of cells overlapped by the bounding box of each segment
+        seg_lo = self._cells(xz.min(axis=1))
+        seg_hi = self._cells(xz.max(axis=1))
+        self.num_x, self.num_z = seg_hi.max(axis=0) + 1 if len(segs) > 0 else (0, 0)
+
+        cell_ids = [[] for _ in range(self.num_x * self.num_z)]
+        for idx, ((x0, z0), (x1, z1)) in enumerate(zip(seg_lo, seg_hi)):
+            for ix in range(x0, x1 + 1):
+                for iz in range(z0, z1 + 1):
+                    cell_ids[ix * self.num_z + iz].append(idx)
+
+        # Segments of each cell, in row-major (x, z) order
+        empty = segs[:0]
+        self.cell_segs = [segs[ids] if len(ids) > 0 else empty for ids in cell_ids]
+
+    def _cells(self, xz):
+        """
+        Indices of the cells containing (N, 2) X-Z positions
+        """
+
+        return np.floor((xz - self.origin) / self.cell_size).astype(int)
+
+    def intersect_circle(self, point, radius):
+        """
+        Test if a circle intersects with any wall segments
+        Returns the same result as intersect_circle_segs over all the
+        segments, which remains the reference implementation.
+        """
+
+        px, _, pz = point
+        ox, oz = self.origin
+        size = self.cell_size
+
+        # Cells overlapped by the bounding box of the circle
+        x0 = max(math.floor((px - radius - ox) / size), 0)
+        x1 = min(math.floor((px + radius - ox) / size), self.num_x - 1)
+        z0 = max(math.floor((pz - radius - oz) / size), 0)
+        z1 = min(math.floor((pz + radius - oz) / size), self.num_z - 1)
+
+        if x0 > x1 or z0 > z1:
+            return None
+
+        cells = [
+            self.cell_segs[ix * self.num_z + iz]
+            for ix in range(x0, x1 + 1)
+            for iz in range(z0, z1 + 1)
+        ]
+        segs = cells[0] if len(cells) == 1 else np.concatenate(cells)
+
+        if len(segs) == 0:
+            return None
+
+        return intersect_circle_segs(point, radius, segs)
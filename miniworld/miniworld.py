@@ -8,10 +8,14 @@ import numpy as np
 import pyglet
 from gymnasium import spaces
 from gymnasium.core import ObsType
-from pyglet.gl import (
+
+import miniworld
+from miniworld.entity import Agent, Entity
+from miniworld.gl import (
     GL_AMBIENT,
     GL_AMBIENT_AND_DIFFUSE,
     GL_ANY_SAMPLES_PASSED,
+    GL_CCW,
     GL_COLOR_BUFFER_BIT,
     GL_COLOR_MATERIAL,
     GL_COMPILE,
@@ -25,7 +29,6 @@ from pyglet.gl import (
     GL_LIGHTING,
     GL_LINES,
     GL_MODELVIEW,
-    GL_POLYGON,
     GL_POSITION,
     GL_PROJECTION,
     GL_QUADS,
@@ -38,6 +41,7 @@ from pyglet.gl import (
     glBegin,
     glBeginQuery,
     glBindFramebuffer,
+    glBindTexture,
     glCallList,
     glClear,
     glClearColor,
@@ -52,33 +56,55 @@ from pyglet.gl import (
     glEndList,
     glEndQuery,
     glFlush,
+    glFrontFace,
+    glGenLists,
     glGenQueries,
     glGetQueryObjectuiv,
     glLightfv,
     glLineWidth,
     glLoadIdentity,
-    glLoadMatrixf,
     glMatrixMode,
     glNewList,
-    glNormal3f,
     glOrtho,
     glShadeModel,
     glTexCoord2f,
-    gluLookAt,
-    gluPerspective,
+    glUniform1ui,
     glVertex3f,
 )
-
-from miniworld.entity import Agent, Entity
-from miniworld.math import Y_VEC, intersect_circle_segs
-from miniworld.opengl import FrameBuffer, Texture, drawBox
+from miniworld.math import (
+    TEX_DENSITY,
+    Y_VEC,
+    SegmentGrid,
+    boxes_in_frustum,
+    clip_polygon,
+    fit_extents,
+    frustum_planes,
+    look_at,
+    ortho,
+    perspective,
+    polygon_planes,
+)
+from miniworld.opengl import (
+    FrameBuffer,
+    NoGLContext,
+    ShaderProgram,
+    StaticGeometry,
+    Texture,
+    TiledFrameBuffer,
+    drawBox,
+    load_matrix,
+)
 from miniworld.params import DEFAULT_PARAMS
 
 # Default wall height for room
 DEFAULT_WALL_HEIGHT = 2.74
 
-# Texture size/density in texels/meter
-TEX_DENSITY = 512
+# Segmentation IDs of rooms start at this value, entity IDs are their
+# index in the entity list plus one, and 0 is the background
+SEG_ROOM_BASE = 1 << 16
+
+# Maximum width and height of the cached map of the local top view
+LOCAL_MAP_MAX_SIZE = 4096
 
 
 def gen_texcs_wall(tex, min_x, min_y, width, height):
@@ -121,6 +147,52 @@ def gen_texcs_floor(tex, poss):
     return coords
 
 
+def render_obs_batch(views, frame_buffer=None, out=None):
+    """
+    Render observations for a list of (env, camera) pairs in one pass.
+    Each view is rendered into one tile of a tiled frame buffer, and all
+    the tiles are read back with a single glReadPixels call.
+    The environments may be different worlds, as long as they share the
+    same OpenGL context and observation size.
+    Returns a uint8 array of shape (N, H, W, 3), written into out if provided
+    """
+
+    assert len(views) > 0
+
+    env0, _ = views[0]
+
+    if frame_buffer is None:
+        frame_buffer = env0._get_batch_fb(len(views))
+    assert frame_buffer.num_tiles == len(views)
+
+    # Switch to the default OpenGL context
+    # This is necessary on Linux Nvidia drivers
+    env0.gl_context.switch_to()
+
+    # Bind the frame buffer before rendering into it
+    frame_buffer.bind()
+
+    for idx, (env, camera) in enumerate(views):
+        assert (env.obs_fb.width, env.obs_fb.height) == (
+            frame_buffer.tile_width,
+            frame_buffer.tile_height,
+        ), "all the views must have the same observation size"
+
+        # Restrict rendering to the tile for this view
+        frame_buffer.bind_tile(idx)
+
+        # Clear the color and depth buffers
+        glClearColor(*env.sky_color, 1.0)
+        glClearDepth(1.0)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+        env._setup_camera(camera, frame_buffer)
+        env._draw_world(render_agent=False, camera=camera)
+
+    # Read all the tiles back at once
+    return frame_buffer.resolve(out)
+
+
 class Room:
     """
     Represent an individual room and its contents
@@ -400,40 +472,43 @@ class Room:
         else:
             self.wall_texcs = np.array([]).reshape(0, 2)
 
-    def _render(self):
+        # Bounding box of the room polygons, for view-frustum culling
+        self.bound_min = np.array([self.min_x, 0, self.min_z])
+        self.bound_max = np.array([self.max_x, self.wall_height, self.max_z])
+
+        # Openings of the portals as quads, with the inward normals of
+        # their walls, for portal visibility culling
+        self.portal_quads = []
+        for wall_idx, portals in enumerate(self.portals):
+            edge_p0 = self.outline[wall_idx]
+            side_vec = self.edge_dirs[wall_idx]
+
+            for portal in portals:
+                p0 = edge_p0 + side_vec * portal["start_pos"]
+                p1 = edge_p0 + side_vec * portal["end_pos"]
+                min_y = Y_VEC * portal["min_y"]
+                max_y = Y_VEC * portal["max_y"]
+                quad = np.array([p0 + min_y, p1 + min_y, p1 + max_y, p0 + max_y])
+                self.portal_quads.append((quad, self.edge_norms[wall_idx]))
+
+    def _add_geometry(self, geom, seg_id=0):
         """
-        Render the static elements of the room
+        Add the static polygons of the room to a static geometry batch
+        The polygons are labelled with the room's segmentation ID.
         """
 
-        glColor3f(1, 1, 1)
-
-        # Draw the floor
-        self.floor_tex.bind()
-        glBegin(GL_POLYGON)
-        glNormal3f(0, 1, 0)
-        for i in range(self.floor_verts.shape[0]):
-            glTexCoord2f(*self.floor_texcs[i, :])
-            glVertex3f(*self.floor_verts[i, :])
-        glEnd()
+        geom.add_polygon(
+            self.floor_tex, self.floor_verts, Y_VEC, self.floor_texcs, seg_id
+        )
 
-        # Draw the ceiling
         if not self.no_ceiling:
-            self.ceil_tex.bind()
-            glBegin(GL_POLYGON)
-            glNormal3f(0, -1, 0)
-            for i in range(self.ceil_verts.shape[0]):
-                glTexCoord2f(*self.ceil_texcs[i, :])
-                glVertex3f(*self.ceil_verts[i, :])
-            glEnd()
+            geom.add_polygon(
+                self.ceil_tex, self.ceil_verts, -Y_VEC, self.ceil_texcs, seg_id
+            )
 
-        # Draw the walls
-        self.wall_tex.bind()
-        glBegin(GL_QUADS)
-        for i in range(self.wall_verts.shape[0]):
-            glNormal3f(*self.wall_norms[i, :])
-            glTexCoord2f(*self.wall_texcs[i, :])
-            glVertex3f(*self.wall_verts[i, :])
-        glEnd()
+        geom.add_quads(
+            self.wall_tex, self.wall_verts, self.wall_norms, self.wall_texcs, seg_id
+        )
 
 
 class MiniWorldEnv(gym.Env):
@@ -480,6 +555,19 @@ class MiniWorldEnv(gym.Env):
         domain_rand: bool = False,
         render_mode: Optional[str] = None,
         view: str = "agent",
+        top_down_readback: bool = False,
+        texture_arrays: bool = False,
+        instancing: bool = False,
+        renderer: str = "fixed",
+        obs_depth: bool = False,
+        obs_seg: bool = False,
+        culling: bool = False,
+        portal_culling: bool = False,
+        local_map_res: Optional[float] = None,
+        obs_samples: int = 8,
+        lazy_render: bool = False,
+        use_gl: bool = True,
+        max_texture_size: Optional[int] = None,
     ):
         # Action enumeration for this environment
         self.actions = MiniWorldEnv.Actions
@@ -492,6 +580,38 @@ class MiniWorldEnv(gym.Env):
             low=0, high=255, shape=(obs_height, obs_width, 3), dtype=np.uint8
         )
 
+        # Optionally, observations also include a depth map in meters,
+        # rendered in the same pass as the RGB image
+        self.obs_depth = obs_depth
+        if obs_depth:
+            self.observation_space = spaces.Dict(
+                rgb=self.observation_space,
+                depth=spaces.Box(
+                    low=0,
+                    high=100.0,
+                    shape=(obs_height, obs_width, 1),
+                    dtype=np.float32,
+                ),
+            )
+
+        # Optionally, observations also include a segmentation map of
+        # object IDs, rendered in the same step as the RGB image
+        # (see seg_object to map IDs back to entities and rooms)
+        self.obs_seg = obs_seg
+        if obs_seg:
+            spaces_dict = (
+                dict(self.observation_space.spaces)
+                if obs_depth
+                else {"rgb": self.observation_space}
+            )
+            spaces_dict["seg"] = spaces.Box(
+                low=0,
+                high=np.iinfo(np.uint32).max,
+                shape=(obs_height, obs_width),
+                dtype=np.uint32,
+            )
+            self.observation_space = spaces.Dict(spaces_dict)
+
         self.reward_range = (-math.inf, math.inf)
 
         # Maximum number of steps per episode
@@ -506,22 +626,125 @@ class MiniWorldEnv(gym.Env):
         # Window for displaying the environment to humans
         self.window = None
 
-        # Invisible window to render into (shadow OpenGL context)
-        self.shadow_window = pyglet.window.Window(width=1, height=1, visible=False)
-
-        # Enable depth testing and backface culling
-        glEnable(GL_DEPTH_TEST)
-        glEnable(GL_CULL_FACE)
-
-        # Frame buffer used to render observations
-        self.obs_fb = FrameBuffer(obs_width, obs_height, 8)
-
-        # Frame buffer used for human visualization
-        self.vis_fb = FrameBuffer(window_width, window_height, 16)
+        # Without OpenGL, the environment creates no OpenGL context, frame
+        # buffers or geometry, and can only be drawn from above in software
+        # (see miniworld.softrender). Its observations are None.
+        self.use_gl = use_gl
+
+        # OpenGL context to render into, by default an invisible window
+        # (shadow OpenGL context). The backend is chosen once per process,
+        # as OpenGL objects are shared by all the environments.
+        if use_gl:
+            # The backends are only imported when used, as they need OpenGL
+            from miniworld.glcontext import GL_CONTEXTS
+
+            assert (
+                miniworld.GL_CONTEXT in GL_CONTEXTS
+            ), f"unknown OpenGL context {miniworld.GL_CONTEXT}"
+            self.gl_context = GL_CONTEXTS[miniworld.GL_CONTEXT]()
+            self.gl_context.switch_to()
+
+            # Enable depth testing and backface culling
+            glEnable(GL_DEPTH_TEST)
+            glEnable(GL_CULL_FACE)
+        else:
+            self.gl_context = NoGLContext.get()
+
+        # Flip the projection when rendering, so that images are read
+        # back top-down without a flip copy
+        self.top_down_readback = top_down_readback
+
+        # Frame buffer used to render observations, with obs_samples
+        # samples per pixel for antialiasing. With a single sample, there
+        # is no multisampled frame buffer to resolve.
+        self.obs_width = obs_width
+        self.obs_height = obs_height
+        self.obs_samples = obs_samples
+        self.obs_fb = None
+        if use_gl:
+            self._init_obs_fb()
+
+        # Size of the human visualization
+        self.window_width = window_width
+        self.window_height = window_height
 
         # Frame buffer used for local top-down view
         self.local_top_view_fb = None
 
+        # Resolution of the map of the static world, in pixels per meter,
+        # rendered once per episode and cropped around the agent by the
+        # local top view. If None, the local top view renders the world
+        # at every call.
+        self.local_map_res = local_map_res
+
+        # Frame buffer holding the map, and the world extents it covers
+        # (None when the map is not rendered for the current episode),
+        # along with the outlines of the walls drawn over it
+        self.local_map_fb = None
+        self.local_map_extents = None
+        self.local_map_walls = None
+
+        # Static layer of the top view, cached for each frame buffer
+        # format (size and samples) the top view is rendered in, and the
+        # formats whose cached layer is up to date for the current episode
+        self.top_view_cache = {}
+        self.top_view_valid = set()
+
+        # Maximum width and height of the textures loaded, larger textures
+        # are downsampled on load (None to load them at full resolution).
+        # Small observations only sample the lower mip levels of large
+        # textures, so a cap close to the observation size (e.g. 128 for
+        # 80x60 observations) saves texture memory and upload time without
+        # visible changes.
+        self.max_texture_size = max_texture_size
+
+        # Pack the room textures into array textures, so that the room
+        # geometry is drawn with one draw call per texture size
+        self.texture_arrays = texture_arrays
+
+        # Rendering path, either the fixed-function pipeline ("fixed")
+        # or GLSL shader programs ("glsl")
+        assert renderer in ["fixed", "glsl"], f"unknown renderer {renderer}"
+        self.renderer = renderer
+
+        # Draw the dynamic entities sharing a mesh with one instanced
+        # draw call per mesh (always the case with the GLSL renderer)
+        self.instancing = instancing or renderer == "glsl"
+
+        # Only draw the rooms and entities whose bounding boxes intersect
+        # the view frustum of the camera. Entities are bounded by their
+        # radius and height, which custom entities may draw outside of.
+        self.culling = culling or portal_culling
+
+        # Also only draw the rooms seen through portals from the room
+        # containing the camera, and the entities in these rooms (this
+        # enables view-frustum culling)
+        self.portal_culling = portal_culling
+
+        # View frustum planes of the current camera, and the rooms it may
+        # see (None when culling is disabled)
+        self.frustum = None
+        self.visible_rooms = None
+        self.portal_culled = False
+
+        # Number of rooms and entities drawn and culled in the last
+        # rendering, for benchmarking
+        self.draw_counts = {
+            "rooms": 0,
+            "rooms_culled": 0,
+            "entities": 0,
+            "entities_culled": 0,
+        }
+
+        # Vertex buffers holding the room geometry, rebuilt on reset
+        self.static_geom = None
+
+        # Display list for the static entities
+        self.static_list = None
+
+        # Tiled frame buffer used for batched observation rendering
+        self.batch_fb = None
+
         # Set rendering mode
         self.render_mode = render_mode
 
@@ -533,18 +756,19 @@ class MiniWorldEnv(gym.Env):
         self.obs_disp_width = 256
         self.obs_disp_height = obs_height * (self.obs_disp_width / obs_width)
 
-        # For displaying text
-        try:
-            self.text_label = pyglet.text.Label(
-                font_name="Arial",
-                font_size=14,
-                multiline=True,
-                width=400,
-                x=window_width + 5,
-                y=window_height - (self.obs_disp_height + 19),
-            )
-        except Exception:
-            self.text_label = None
+        # Frame buffer used for human visualization, and text label
+        # displayed in the window. With lazy_render, these are only created
+        # on the first call to render, so that environments used only for
+        # training do not allocate them.
+        self.vis_fb = None
+        self.text_label = None
+        if not lazy_render and use_gl:
+            self._init_render()
+
+        # When set, reset and step return None instead of rendering the
+        # observation, which is rendered afterwards along with those of
+        # other environments (see miniworld.vector)
+        self.defer_obs = False
 
         # Initialize the state
         self.reset()
@@ -574,39 +798,49 @@ class MiniWorldEnv(gym.Env):
         # Shape is (N, 2, 3)
         self.wall_segs = []
 
-        # Generate the world
-        self._gen_world()
+        # Generate the world, counting the textures and meshes it loads as
+        # used by this environment, so that they are released on close
+        with self.gl_context.resources.use(self, self.max_texture_size):
+            self._gen_world()
 
-        # Check if domain randomization is enabled or not
-        rand = self.np_random if self.domain_rand else None
+            # Check if domain randomization is enabled or not
+            rand = self.np_random if self.domain_rand else None
 
-        # Randomize elements of the world (domain randomization)
-        self.params.sample_many(
-            rand, self, ["sky_color", "light_pos", "light_color", "light_ambient"]
-        )
+            # Randomize elements of the world (domain randomization)
+            self.params.sample_many(
+                rand, self, ["sky_color", "light_pos", "light_color", "light_ambient"]
+            )
 
-        # Get the max forward step distance
-        self.max_forward_step = self.params.get_max("forward_step")
+            # Get the max forward step distance
+            self.max_forward_step = self.params.get_max("forward_step")
 
-        # Randomize parameters of the entities
-        for ent in self.entities:
-            ent.randomize(self.params, rand)
+            # Randomize parameters of the entities
+            for ent in self.entities:
+                ent.randomize(self.params, rand)
 
-        # Compute the min and max x, z extents of the whole floorplan
-        self.min_x = min(r.min_x for r in self.rooms)
-        self.max_x = max(r.max_x for r in self.rooms)
-        self.min_z = min(r.min_z for r in self.rooms)
-        self.max_z = max(r.max_z for r in self.rooms)
+            # Compute the min and max x, z extents of the whole floorplan
+            self.min_x = min(r.min_x for r in self.rooms)
+            self.max_x = max(r.max_x for r in self.rooms)
+            self.min_z = min(r.min_z for r in self.rooms)
+            self.max_z = max(r.max_z for r in self.rooms)
 
-        # Generate static data
-        if len(self.wall_segs) == 0:
-            self._gen_static_data()
+            # Generate static data
+            if len(self.wall_segs) == 0:
+                self._gen_static_data()
+
+        if self.use_gl:
+            self.gl_context.switch_to()
 
-        # Pre-compile static parts of the environment into a display list
-        self._render_static()
+            # The observation frame buffer is freed when the environment is
+            # closed, recreate it if the environment is used again
+            if self.obs_fb is None:
+                self._init_obs_fb()
+
+            # Pre-compile static parts of the environment into a display list
+            self._render_static()
 
         # Generate the first camera image
-        obs = self.render_obs()
+        obs = self._get_obs()
 
         # Return first observation
         return obs, {}
@@ -722,7 +956,7 @@ class MiniWorldEnv(gym.Env):
             self.agent.carrying.dir = self.agent.dir
 
         # Generate the current camera image
-        obs = self.render_obs()
+        obs = self._get_obs()
 
         # If the maximum time step count is reached
         if self.step_count >= self.max_episode_steps:
@@ -951,8 +1185,10 @@ class MiniWorldEnv(gym.Env):
         px, _, pz = pos
         pos = np.array([px, 0, pz])
 
-        # Check for intersection with walls
-        if intersect_circle_segs(pos, radius, self.wall_segs):
+        # Check for intersection with walls, only testing the wall segments
+        # near the entity (intersect_circle_segs over all of wall_segs gives
+        # the same result)
+        if self.wall_grid.intersect_circle(pos, radius):
             return True
 
         # Check for entity intersection
@@ -1006,10 +1242,42 @@ class MiniWorldEnv(gym.Env):
         # Concatenate the wall segments
         self.wall_segs = np.concatenate([r.wall_segs for r in self.rooms])
 
+        # Grid index of the wall segments, for collision detection
+        self.wall_grid = SegmentGrid(self.wall_segs)
+
+        # Room bounding boxes, for view-frustum culling
+        self.room_bound_min = np.array([r.bound_min for r in self.rooms])
+        self.room_bound_max = np.array([r.bound_max for r in self.rooms])
+
         # Room selection probabilities
         self.room_probs = np.array([r.area for r in self.rooms], dtype=float)
         self.room_probs /= np.sum(self.room_probs)
 
+        # Graph of the rooms connected through portals
+        self._gen_portal_graph()
+
+    def _gen_portal_graph(self):
+        """
+        Compute the room adjacency graph used for portal visibility culling
+        For each room, portal_graph lists the neighboring rooms with the
+        opening leading to them. Rooms are adjacent when they have
+        portals with the same opening.
+        """
+
+        # Portals indexed by the position of their bottom edge
+        openings = {}
+        for idx, room in enumerate(self.rooms):
+            for quad, normal in room.portal_quads:
+                key = tuple(sorted(tuple(np.round(p[[0, 2]], 3)) for p in quad[:2]))
+                openings.setdefault(key, []).append((idx, quad, normal))
+
+        self.portal_graph = [[] for _ in self.rooms]
+        for portals in openings.values():
+            for idx, quad, normal in portals:
+                for other, _, _ in portals:
+                    if other != idx:
+                        self.portal_graph[idx].append((other, quad, normal))
+
     def _gen_world(self):
         """
         Generate the world. Derived classes must implement this method.
@@ -1026,14 +1294,45 @@ class MiniWorldEnv(gym.Env):
 
     def _render_static(self):
         """
-        Render the static elements of the scene into a display list.
+        Render the static elements of the scene into a display list,
+        and upload the room geometry into vertex buffers.
         Called once at the beginning of each episode.
         """
 
-        # TODO: manage this automatically
-        # glIsList
-        glDeleteLists(1, 1)
-        glNewList(1, GL_COMPILE)
+        # The cached top views show the static elements of the last episode
+        self.top_view_valid.clear()
+        self.local_map_extents = None
+
+        # Each environment owns its display list, so that several
+        # environments can share the same OpenGL context
+        if self.static_list is None:
+            self.static_list = glGenLists(1)
+        glNewList(self.static_list, GL_COMPILE)
+
+        # Render the static entities
+        for ent in self.entities:
+            if ent.is_static:
+                ent.render()
+
+        glEndList()
+
+        # Upload the room geometry into vertex buffers, grouped by texture
+        if self.static_geom is not None:
+            self.static_geom.delete()
+        self.static_geom = StaticGeometry(
+            texture_arrays=self.texture_arrays,
+            shaders=self.renderer == "glsl",
+            resources=self.gl_context.resources,
+        )
+        for idx, room in enumerate(self.rooms):
+            room._add_geometry(self.static_geom, SEG_ROOM_BASE + idx)
+        self.static_geom.upload()
+
+    def _setup_lights(self):
+        """
+        Set up the light, for the fixed-function pipeline and
+        the shader programs, with the current camera setup
+        """
 
         # Light position
         glLightfv(GL_LIGHT0, GL_POSITION, (GLfloat * 4)(*self.light_pos + [1]))
@@ -1057,39 +1356,133 @@ class MiniWorldEnv(gym.Env):
         glEnable(GL_COLOR_MATERIAL)
         glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
 
-        # Render the rooms
-        glEnable(GL_TEXTURE_2D)
-        for room in self.rooms:
-            room._render()
+        # Light parameters used by the shader programs, matching the
+        # fixed-function light
+        # Note: the fixed-function global ambient light is 0.2
+        light_pos = (GLfloat * 4)(*self.light_pos + [1])
+        ShaderProgram.set_shared(
+            light_pos=list(light_pos),
+            light_ambient=np.asarray(self.light_ambient) + 0.2,
+            light_color=self.light_color,
+        )
 
-        # Render the static entities
-        for ent in self.entities:
-            if ent.is_static:
-                ent.render()
+    def _draw_static(self):
+        """
+        Draw the static parts of the environment: the light setup,
+        the display list (static entities) and the room geometry
+        """
 
-        glEndList()
+        self._setup_lights()
+
+        glCallList(self.static_list)
+
+        # Draw the rooms which may be visible from the camera
+        visible = None
+        num_visible = len(self.rooms)
+        if self.visible_rooms is not None:
+            visible = set(SEG_ROOM_BASE + np.flatnonzero(self.visible_rooms))
+            num_visible = len(visible)
+
+        self.draw_counts["rooms"] = num_visible
+        self.draw_counts["rooms_culled"] = len(self.rooms) - num_visible
 
-    def _render_world(self, frame_buffer, render_agent):
+        glColor3f(1, 1, 1)
+        self.static_geom.render(visible=visible)
+
+    def _draw_world(self, render_agent, camera=None):
         """
-        Render the world from a given camera position into a frame buffer,
-        and produce a numpy image array as output.
+        Draw the world with the current camera setup
+        The camera entity, if given, is not drawn.
         """
 
-        # Call the display list for the static parts of the environment
-        glCallList(1)
+        # Draw the static parts of the environment
+        self._draw_static()
 
         # TODO: keep the non-static entities in a different list for efficiency?
         # Render the non-static entities
-        for ent in self.entities:
-            if not ent.is_static and ent is not self.agent:
-                ent.render()
-                # ent.draw_bound()
+        self._draw_dynamic(camera)
 
         if render_agent:
             self.agent.render()
 
+    def _draw_dynamic(self, camera=None):
+        """
+        Draw the non-static entities, except the agent and the camera entity
+        Entities sharing a mesh are drawn instanced if instancing is enabled.
+        """
+
+        ents = [
+            ent
+            for ent in self.entities
+            if not ent.is_static and ent is not self.agent and ent is not camera
+        ]
+        num_ents = len(ents)
+
+        if self.visible_rooms is not None:
+            ents = self._cull_entities(ents)
+
+        self.draw_counts["entities"] = len(ents)
+        self.draw_counts["entities_culled"] = num_ents - len(ents)
+
+        # Instance parameters, indexed by shared geometry
+        instances = {}
+
+        for ent in ents:
+            if self.instancing and ent.instance_geom is not None:
+                params = ent.instance_params()
+                instances.setdefault(ent.instance_geom, []).append(params)
+            else:
+                ent.render()
+            # ent.draw_bound()
+
+        for geom, params in instances.items():
+            geom.set_instances(params)
+            geom.render()
+
+    def _cull_entities(self, ents):
+        """
+        Keep the entities whose bounding boxes intersect the view frustum
+        With portal culling, the entities must also overlap a visible room
+        (or no room at all). Entities without extents are always kept.
+        """
+
+        if len(ents) == 0:
+            return ents
+
+        pos = np.array([ent.pos for ent in ents], dtype=float)
+        radius = np.array([ent.radius for ent in ents], dtype=float)
+        height = np.array([ent.height for ent in ents], dtype=float)
+
+        ext = np.stack([radius, np.zeros_like(radius), radius], axis=1)
+        mins = pos - ext
+        maxs = pos + ext
+        maxs[:, 1] += height
+
+        keep = boxes_in_frustum(self.frustum, mins, maxs)
+
+        if self.portal_culled:
+            overlap = np.all(
+                (mins[:, None, :] <= self.room_bound_max)
+                & (maxs[:, None, :] >= self.room_bound_min),
+                axis=2,
+            )
+            in_visible = np.any(overlap[:, self.visible_rooms], axis=1)
+            keep &= in_visible | ~np.any(overlap, axis=1)
+
+        keep |= (radius == 0) & (height == 0)
+
+        return [ent for ent, k in zip(ents, keep) if k]
+
+    def _render_world(self, frame_buffer, render_agent, out=None):
+        """
+        Render the world from a given camera position into a frame buffer,
+        and produce a numpy image array as output.
+        """
+
+        self._draw_world(render_agent)
+
         # Resolve the rendered image into a numpy array
-        img = frame_buffer.resolve()
+        img = frame_buffer.resolve(out)
 
         return img
 
@@ -1103,7 +1496,7 @@ class MiniWorldEnv(gym.Env):
 
         # Switch to the default OpenGL context
         # This is necessary on Linux Nvidia drivers
-        self.shadow_window.switch_to()
+        self.gl_context.switch_to()
 
         # Bind the frame buffer before rendering into it
         frame_buffer.bind()
@@ -1120,67 +1513,96 @@ class MiniWorldEnv(gym.Env):
         min_z = self.min_z - 1
         max_z = self.max_z + 1
 
-        width = max_x - min_x
-        height = max_z - min_z
-        aspect = width / height
-        fb_aspect = frame_buffer.width / frame_buffer.height
-
         # Adjust the aspect extents to match the frame buffer aspect
-        if aspect > fb_aspect:
-            # Want to add to denom, add to height
-            new_h = width / fb_aspect
-            h_diff = new_h - height
-            min_z -= h_diff / 2
-            max_z += h_diff / 2
-        elif aspect < fb_aspect:
-            # Want to add to num, add to width
-            new_w = height * fb_aspect
-            w_diff = new_w - width
-            min_x -= w_diff / 2
-            max_x += w_diff / 2
+        min_x, max_x, min_z, max_z = fit_extents(
+            min_x, max_x, min_z, max_z, frame_buffer.aspect
+        )
 
         # Set the projection matrix
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        glOrtho(min_x, max_x, -max_z, -min_z, -100, 100.0)
+        proj = ortho(min_x, max_x, -max_z, -min_z, -100, 100.0)
 
         # Setup the camera
         # Y maps to +Z, Z maps to +Y
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        m = [
-            1,
-            0,
-            0,
-            0,
-            0,
-            0,
-            1,
-            0,
-            0,
-            -1,
-            0,
-            0,
-            0,
-            0,
-            0,
-            1,
-        ]
-        glLoadMatrixf((GLfloat * len(m))(*m))
+        view = np.array([[1, 0, 0, 0], [0, 0, -1, 0], [0, 1, 0, 0], [0, 0, 0, 1]])
+
+        self._load_camera(frame_buffer, proj, view)
 
-        # Call the display list for the static parts of the environment
-        glCallList(1)
+        # Copy the static layer (floors, static entities and walls),
+        # rendered once per episode
+        frame_buffer.copy_from(self._top_view_static(frame_buffer))
+        self._setup_lights()
 
         # Render the non-static entities
-        for ent in self.entities:
-            if not ent.is_static and ent is not self.agent:
-                ent.render()
+        self._draw_dynamic()
+
+        if render_agent:
+            self.agent.render()
+
+        # Resolve the rendered image into a numpy array
+        img = frame_buffer.resolve()
+
+        if return_scale:
+            x_scale = frame_buffer.width / (max_x - min_x)
+            z_scale = frame_buffer.height / (max_z - min_z)
+
+            scale = {
+                "x_scale": x_scale,
+                "z_scale": z_scale,
+                "x_offset": int(0 - min_x * x_scale),
+                "z_offset": int(0 - min_z * z_scale),
+            }
+
+            return img, scale
+        else:
+            return img
+
+    def _top_view_static(self, frame_buffer):
+        """
+        Get a frame buffer holding the static layer of the top view,
+        rendered into it once per episode
+        The camera for the top view must be set up.
+        """
+
+        # Frame buffers of the same format share the cached layer, so
+        # that the cache doesn't grow with the frame buffers of the caller
+        key = (
+            frame_buffer.width,
+            frame_buffer.height,
+            frame_buffer.num_samples or 1,
+            frame_buffer.top_down,
+            frame_buffer.float_depth,
+        )
+        static_fb = self.top_view_cache.get(key)
+
+        if static_fb is None:
+            static_fb = FrameBuffer(*key[:3], top_down=key[3], float_depth=key[4])
+            self.top_view_cache[key] = static_fb
+
+        if key in self.top_view_valid:
+            return static_fb
+
+        static_fb.bind()
+        glClearColor(0, 0, 0, 1.0)
+        glClearDepth(1.0)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+        # Draw the static parts of the environment
+        self._draw_static()
 
         # Draw the walls
-        glDisable(GL_TEXTURE_2D)
-        glDisable(GL_LIGHTING)
-        glLineWidth(6.0)
-        glColor3f(0.3, 0.3, 0.3)
+        self._draw_top_walls()
+
+        self.top_view_valid.add(key)
+
+        return static_fb
+
+    def _top_wall_lines(self):
+        """
+        Get the lines outlining the walls in top views, skipping the
+        doors, as a list of (p0, p1) pairs of points at wall height
+        """
+
+        lines = []
 
         for room in self.rooms:
             for i in range(room.num_walls):
@@ -1192,7 +1614,7 @@ class MiniWorldEnv(gym.Env):
                 dir = vec / length
 
                 # Height to draw the lines at
-                y = room.wall_height
+                y = room.wall_height * Y_VEC
 
                 current_pos = 0.0
 
@@ -1203,60 +1625,131 @@ class MiniWorldEnv(gym.Env):
                     end = portal["end_pos"]
                     min_y = portal["min_y"]
 
-                    # Draw wall segment before portal
+                    # Wall segment before portal
                     if start > current_pos:
                         seg_p0 = p0 + dir * current_pos
                         seg_p1 = p0 + dir * start
+                        lines.append((seg_p0 + y, seg_p1 + y))
 
-                        glBegin(GL_LINES)
-                        glVertex3f(float(seg_p0[0]), float(y), float(seg_p0[2]))
-                        glVertex3f(float(seg_p1[0]), float(y), float(seg_p1[2]))
-                        glEnd()
-
-                    # If this is a window (not a door), draw the wall segment
+                    # If this is a window (not a door), add the wall segment
                     if min_y > 0:
                         seg_p0 = p0 + dir * start
                         seg_p1 = p0 + dir * end
-
-                        glBegin(GL_LINES)
-                        glVertex3f(float(seg_p0[0]), float(y), float(seg_p0[2]))
-                        glVertex3f(float(seg_p1[0]), float(y), float(seg_p1[2]))
-                        glEnd()
+                        lines.append((seg_p0 + y, seg_p1 + y))
 
                     current_pos = end
 
-                # Draw remaining wall segment
+                # Remaining wall segment
                 if current_pos < length:
                     seg_p0 = p0 + dir * current_pos
                     seg_p1 = p1
+                    lines.append((seg_p0 + y, seg_p1 + y))
+
+        return lines
+
+    def _draw_top_walls(self, lines=None):
+        """
+        Draw the outlines of the walls, for top views
+        The lines default to those of _top_wall_lines, as an (N, 2, 3)
+        array of line end points.
+        """
 
-                    glBegin(GL_LINES)
-                    glVertex3f(float(seg_p0[0]), float(y), float(seg_p0[2]))
-                    glVertex3f(float(seg_p1[0]), float(y), float(seg_p1[2]))
-                    glEnd()
+        if lines is None:
+            lines = np.array(self._top_wall_lines(), dtype=float)
+
+        glDisable(GL_TEXTURE_2D)
+        glDisable(GL_LIGHTING)
+        glLineWidth(6.0)
+        glColor3f(0.3, 0.3, 0.3)
+
+        glBegin(GL_LINES)
+        for p in lines.reshape(-1, 3).tolist():
+            glVertex3f(*p)
+        glEnd()
 
         glEnable(GL_LIGHTING)
 
-        if render_agent:
-            self.agent.render()
+    def _local_top_view_map(self):
+        """
+        Get the frame buffer holding the map of the static world,
+        rendered into it once per episode. The walls are left out, as
+        their outlines are drawn at the resolution of each view (see
+        local_map_walls).
+        """
 
-        # Resolve the rendered image into a numpy array
-        img = frame_buffer.resolve()
+        if self.local_map_extents is not None:
+            return self.local_map_fb
 
-        if return_scale:
-            x_scale = frame_buffer.width / (max_x - min_x)
-            z_scale = frame_buffer.height / (max_z - min_z)
+        min_x = self.min_x - 1
+        min_z = self.min_z - 1
+        width = self.max_x + 1 - min_x
+        height = self.max_z + 1 - min_z
+
+        # Lower the resolution if the map would be too large
+        res = min(self.local_map_res, LOCAL_MAP_MAX_SIZE / max(width, height))
+        map_width = max(1, math.ceil(width * res))
+        map_height = max(1, math.ceil(height * res))
+
+        # Round the extents to whole pixels
+        max_x = min_x + map_width / res
+        max_z = min_z + map_height / res
+
+        if (
+            self.local_map_fb is None
+            or self.local_map_fb.width != map_width
+            or self.local_map_fb.height != map_height
+        ):
+            self.local_map_fb = FrameBuffer(map_width, map_height, 4)
+
+        self.local_map_fb.bind()
+        glClearColor(0, 0, 0, 1.0)
+        glClearDepth(1.0)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
-            scale = {
-                "x_scale": x_scale,
-                "z_scale": z_scale,
-                "x_offset": int(0 - min_x * x_scale),
-                "z_offset": int(0 - min_z * z_scale),
-            }
+        proj = ortho(min_x, max_x, -max_z, -min_z, -100, 100.0)
+        view = np.array([[1, 0, 0, 0], [0, 0, -1, 0], [0, 1, 0, 0], [0, 0, 0, 1]])
+        self._load_camera(self.local_map_fb, proj, view)
 
-            return img, scale
-        else:
-            return img
+        self._draw_static()
+
+        self.local_map_fb.resolve_texture()
+        self.local_map_extents = (min_x, max_x, min_z, max_z)
+        self.local_map_walls = np.array(self._top_wall_lines(), dtype=float)
+
+        return self.local_map_fb
+
+    def _draw_local_map(self):
+        """
+        Draw the map of the static world on the ground, with the current
+        camera setup, resampling it to the frame buffer resolution
+        """
+
+        min_x, max_x, min_z, max_z = self.local_map_extents
+
+        glDisable(GL_LIGHTING)
+        glDisable(GL_DEPTH_TEST)
+        glDisable(GL_CULL_FACE)
+        glEnable(GL_TEXTURE_2D)
+        glBindTexture(GL_TEXTURE_2D, self.local_map_fb.final_tex)
+        glColor3f(1, 1, 1)
+
+        # The bottom row of the map is at max_z
+        glBegin(GL_QUADS)
+        glTexCoord2f(0, 0)
+        glVertex3f(min_x, 0, max_z)
+        glTexCoord2f(1, 0)
+        glVertex3f(max_x, 0, max_z)
+        glTexCoord2f(1, 1)
+        glVertex3f(max_x, 0, min_z)
+        glTexCoord2f(0, 1)
+        glVertex3f(min_x, 0, min_z)
+        glEnd()
+
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glDisable(GL_TEXTURE_2D)
+        glEnable(GL_CULL_FACE)
+        glEnable(GL_DEPTH_TEST)
+        glEnable(GL_LIGHTING)
 
     def render_local_top_view(
         self,
@@ -1265,9 +1758,15 @@ class MiniWorldEnv(gym.Env):
         image_size=256,
         render_agent=True,
         return_scale=False,
+        rotate=False,
     ):
         """
         Render a top view centered on the agent (local view)
+        If the environment has a local_map_res, the static world is drawn
+        from a map rendered once per episode, resampled directly at the
+        frame buffer resolution, and only the non-static entities and the
+        wall outlines are rendered. With rotate, the view turns with the agent, so that the
+        agent faces up. The scale returned ignores the rotation.
         """
 
         if frame_buffer is None:
@@ -1276,12 +1775,18 @@ class MiniWorldEnv(gym.Env):
                 or self.local_top_view_fb.width != image_size
                 or self.local_top_view_fb.height != image_size
             ):
-                self.local_top_view_fb = FrameBuffer(image_size, image_size, 8)
+                self.local_top_view_fb = FrameBuffer(
+                    image_size, image_size, 8, top_down=self.top_down_readback
+                )
             frame_buffer = self.local_top_view_fb
 
         # Switch to the default OpenGL context
         # This is necessary on Linux Nvidia drivers
-        self.shadow_window.switch_to()
+        self.gl_context.switch_to()
+
+        # Render the map of the static world, once per episode
+        if self.local_map_res is not None:
+            self._local_top_view_map()
 
         # Bind the frame buffer before rendering into it
         frame_buffer.bind()
@@ -1299,122 +1804,46 @@ class MiniWorldEnv(gym.Env):
         min_z = cz - view_size / 2
         max_z = cz + view_size / 2
 
-        width = max_x - min_x
-        height = max_z - min_z
-        aspect = width / height
-        fb_aspect = frame_buffer.width / frame_buffer.height
-
         # Adjust the aspect extents to match the frame buffer aspect
-        if aspect > fb_aspect:
-            # Want to add to denom, add to height
-            new_h = width / fb_aspect
-            h_diff = new_h - height
-            min_z -= h_diff / 2
-            max_z += h_diff / 2
-        elif aspect < fb_aspect:
-            # Want to add to num, add to width
-            new_w = height * fb_aspect
-            w_diff = new_w - width
-            min_x -= w_diff / 2
-            max_x += w_diff / 2
+        min_x, max_x, min_z, max_z = fit_extents(
+            min_x, max_x, min_z, max_z, frame_buffer.aspect
+        )
 
         # Set the projection matrix
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        glOrtho(min_x, max_x, -max_z, -min_z, -100, 100.0)
+        proj = ortho(min_x, max_x, -max_z, -min_z, -100, 100.0)
 
         # Setup the camera
         # Y maps to +Z, Z maps to +Y
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        m = [
-            1,
-            0,
-            0,
-            0,
-            0,
-            0,
-            1,
-            0,
-            0,
-            -1,
-            0,
-            0,
-            0,
-            0,
-            0,
-            1,
-        ]
-        glLoadMatrixf((GLfloat * len(m))(*m))
-
-        # Call the display list for the static parts of the environment
-        glCallList(1)
-
-        # Render the non-static entities
-        for ent in self.entities:
-            if not ent.is_static and ent is not self.agent:
-                ent.render()
-
-        # Draw the walls
-        glDisable(GL_TEXTURE_2D)
-        glDisable(GL_LIGHTING)
-        glLineWidth(6.0)
-        glColor3f(0.3, 0.3, 0.3)
-
-        for room in self.rooms:
-            for i in range(room.num_walls):
-                p0 = room.outline[i]
-                p1 = room.outline[(i + 1) % room.num_walls]
-
-                vec = p1 - p0
-                length = np.linalg.norm(vec)
-                dir = vec / length
-
-                # Height to draw the lines at
-                y = room.wall_height
-
-                current_pos = 0.0
-
-                portals = sorted(room.portals[i], key=lambda p: p["start_pos"])
-
-                for portal in portals:
-                    start = portal["start_pos"]
-                    end = portal["end_pos"]
-                    min_y = portal["min_y"]
-
-                    # Draw wall segment before portal
-                    if start > current_pos:
-                        seg_p0 = p0 + dir * current_pos
-                        seg_p1 = p0 + dir * start
+        view = np.array([[1, 0, 0, 0], [0, 0, -1, 0], [0, 1, 0, 0], [0, 0, 0, 1]])
 
-                        glBegin(GL_LINES)
-                        glVertex3f(float(seg_p0[0]), float(y), float(seg_p0[2]))
-                        glVertex3f(float(seg_p1[0]), float(y), float(seg_p1[2]))
-                        glEnd()
+        # Rotate the world about the agent, so that it faces up (-Z)
+        if rotate:
+            rot = np.identity(4)
+            rot[0, :3] = self.agent.right_vec
+            rot[2, :3] = -self.agent.dir_vec
+            rot[:3, 3] = self.agent.pos - rot[:3, :3] @ self.agent.pos
+            view = view @ rot
 
-                    # If this is a window (not a door), draw the wall segment
-                    if min_y > 0:
-                        seg_p0 = p0 + dir * start
-                        seg_p1 = p0 + dir * end
+        self._load_camera(frame_buffer, proj, view)
 
-                        glBegin(GL_LINES)
-                        glVertex3f(float(seg_p0[0]), float(y), float(seg_p0[2]))
-                        glVertex3f(float(seg_p1[0]), float(y), float(seg_p1[2]))
-                        glEnd()
+        if self.local_map_res is None:
+            # Draw the static parts of the environment
+            self._draw_static()
 
-                    current_pos = end
+            # Render the non-static entities
+            self._draw_dynamic()
 
-                # Draw remaining wall segment
-                if current_pos < length:
-                    seg_p0 = p0 + dir * current_pos
-                    seg_p1 = p1
+            # Draw the walls
+            self._draw_top_walls()
+        else:
+            self._draw_local_map()
+            self._setup_lights()
 
-                    glBegin(GL_LINES)
-                    glVertex3f(float(seg_p0[0]), float(y), float(seg_p0[2]))
-                    glVertex3f(float(seg_p1[0]), float(y), float(seg_p1[2]))
-                    glEnd()
+            # Render the non-static entities
+            self._draw_dynamic()
 
-        glEnable(GL_LIGHTING)
+            # Draw the walls, with the same width as without the map
+            self._draw_top_walls(self.local_map_walls)
 
         if render_agent:
             self.agent.render()
@@ -1437,17 +1866,173 @@ class MiniWorldEnv(gym.Env):
         else:
             return img
 
-    def render_obs(self, frame_buffer=None):
+    def render_obs(self, frame_buffer=None, out=None):
         """
         Render an observation from the point of view of the agent
+        The observation is written into out if provided, which avoids
+        allocating a new array (e.g. to fill preallocated shared memory).
         """
 
         if frame_buffer is None:
             frame_buffer = self.obs_fb
 
+        self._setup_obs(frame_buffer)
+
+        return self._render_world(frame_buffer, render_agent=False, out=out)
+
+    def render_obs_depth(self, frame_buffer=None, out=None, depth_out=None):
+        """
+        Render an observation and its depth map in a single pass
+        Returns the RGB image and the depth map, of shape (H,W,1), with
+        distances in meters from the observer. For precise depth, use a
+        frame buffer with a floating-point depth buffer.
+        """
+
+        if frame_buffer is None:
+            frame_buffer = self.obs_fb
+
+        obs = self.render_obs(frame_buffer, out=out)
+        depth = frame_buffer.get_depth_map(0.04, 100.0, out=depth_out)
+
+        return obs, depth
+
+    def render_obs_seg(self, frame_buffer=None, out=None, seg_out=None):
+        """
+        Render an observation and its segmentation map in the same step
+        Returns the RGB image and the segmentation map, a uint32 array of
+        shape (H,W) holding the segmentation ID of the entity or room
+        visible at each pixel (0 for the background). The frame buffer
+        must have a segmentation buffer.
+        Note: the segmentation IDs are drawn in a second pass with flat
+              colors, without lighting or textures, because the
+              fixed-function pipeline cannot write integer buffers. The
+              entities sharing geometry are drawn in this pass with one
+              instanced draw call per mesh.
+        """
+
+        if frame_buffer is None:
+            frame_buffer = self.obs_fb
+
+        self._setup_obs(frame_buffer)
+        self._draw_world(render_agent=False)
+
+        frame_buffer.begin_seg()
+        self._draw_seg()
+        frame_buffer.end_seg()
+
+        obs = frame_buffer.resolve(out)
+        seg = frame_buffer.resolve_seg(seg_out)
+
+        return obs, seg
+
+    def _draw_seg(self):
+        """
+        Draw the rooms and entities with their segmentation IDs,
+        except the agent
+        """
+
+        shader = ShaderProgram.get("seg")
+        shader.use()
+
+        self.static_geom.render_seg(shader)
+
+        # Instance parameters and segmentation IDs, indexed by shared
+        # geometry
+        instances = {}
+
+        for idx, ent in enumerate(self.entities):
+            if ent is self.agent:
+                continue
+
+            if ent.instance_geom is not None:
+                params, seg_ids = instances.setdefault(ent.instance_geom, ([], []))
+                params.append(ent.instance_params())
+                seg_ids.append(idx + 1)
+            else:
+                glUniform1ui(shader.location("seg_id"), idx + 1)
+                ent.render()
+
+        shader.unuse()
+
+        for geom, (params, seg_ids) in instances.items():
+            geom.render_seg(params, seg_ids)
+
+    def seg_object(self, seg_id):
+        """
+        Get the entity or room with a given segmentation ID
+        Returns None for the background.
+        """
+
+        if seg_id >= SEG_ROOM_BASE:
+            return self.rooms[seg_id - SEG_ROOM_BASE]
+
+        if seg_id > 0:
+            return self.entities[seg_id - 1]
+
+        return None
+
+    def _get_obs(self):
+        """
+        Produce the observation returned by reset and step
+        Environments created without OpenGL have no observations.
+        """
+
+        if self.defer_obs or not self.use_gl:
+            return None
+
+        if not self.obs_depth and not self.obs_seg:
+            return self.render_obs()
+
+        if self.obs_seg:
+            rgb, seg = self.render_obs_seg()
+            obs = {"rgb": rgb, "seg": seg}
+        else:
+            obs = {"rgb": self.render_obs()}
+
+        if self.obs_depth:
+            obs["depth"] = self.obs_fb.get_depth_map(0.04, 100.0)
+
+        return obs
+
+    def render_obs_async(self, frame_buffer=None, out=None):
+        """
+        Render an observation from the point of view of the agent, and
+        start reading it back asynchronously, without waiting for the
+        rendering to complete.
+        Returns the observation rendered by the previous call (None on
+        the first call). Pending observations can be obtained with
+        collect_obs.
+        """
+
+        if frame_buffer is None:
+            frame_buffer = self.obs_fb
+
+        self._setup_obs(frame_buffer)
+        self._draw_world(render_agent=False)
+
+        return frame_buffer.resolve_async(out)
+
+    def collect_obs(self, frame_buffer=None, out=None):
+        """
+        Wait for the oldest observation started by render_obs_async,
+        and return it. Returns None if no observation is pending.
+        """
+
+        if frame_buffer is None:
+            frame_buffer = self.obs_fb
+
+        self.gl_context.switch_to()
+
+        return frame_buffer.collect(out)
+
+    def _setup_obs(self, frame_buffer):
+        """
+        Bind and clear a frame buffer, and set up the agent's camera
+        """
+
         # Switch to the default OpenGL context
         # This is necessary on Linux Nvidia drivers
-        self.shadow_window.switch_to()
+        self.gl_context.switch_to()
 
         # Bind the frame buffer before rendering into it
         frame_buffer.bind()
@@ -1457,31 +2042,154 @@ class MiniWorldEnv(gym.Env):
         glClearDepth(1.0)
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
+        # Set the projection matrix and camera
+        self._setup_camera(self.agent, frame_buffer)
+
+    def _setup_camera(self, camera, frame_buffer):
+        """
+        Set the projection and modelview matrices to look through
+        the camera of an agent
+        """
+
         # Set the projection matrix
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        gluPerspective(
-            self.agent.cam_fov_y,
-            frame_buffer.width / float(frame_buffer.height),
-            0.04,
-            100.0,
-        )
+        proj = perspective(camera.cam_fov_y, frame_buffer.aspect, 0.04, 100.0)
 
         # Setup the camera
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        gluLookAt(
+        view = look_at(
             # Eye position
-            *self.agent.cam_pos,
+            camera.cam_pos,
             # Target
-            *(self.agent.cam_pos + self.agent.cam_dir),
+            camera.cam_pos + camera.cam_dir,
             # Up vector
-            0,
-            1.0,
-            0.0,
+            Y_VEC,
+        )
+
+        self._load_camera(frame_buffer, proj, view, eye=camera.cam_pos)
+
+    def _load_camera(self, frame_buffer, proj, view, eye=None):
+        """
+        Load the projection and view matrices, both into the OpenGL
+        matrix stacks and as uniforms of the shader programs
+        The eye position of perspective cameras is used for portal culling.
+        """
+
+        self.frustum = frustum_planes(proj @ view)
+        self._find_visible_rooms(eye)
+
+        proj = frame_buffer.load_projection(proj)
+
+        glMatrixMode(GL_MODELVIEW)
+        load_matrix(view)
+
+        ShaderProgram.set_shared(proj=proj, view=view)
+
+    def _find_visible_rooms(self, eye=None):
+        """
+        Find the rooms which may be visible with the current view frustum
+        When the eye is inside a room with a ceiling, the frustum is
+        recursively clipped through the portals of the rooms it reaches,
+        starting from the room containing the eye.
+        """
+
+        self.portal_culled = False
+
+        if not self.culling:
+            self.visible_rooms = None
+            return
+
+        in_frustum = boxes_in_frustum(
+            self.frustum, self.room_bound_min, self.room_bound_max
         )
+        self.visible_rooms = in_frustum
+
+        if not self.portal_culling or eye is None:
+            return
 
-        return self._render_world(frame_buffer, render_agent=False)
+        room_idx = self._room_containing(eye)
+        if room_idx is None or self.rooms[room_idx].no_ceiling:
+            return
+
+        # The portals are clipped against the side and far planes of the
+        # frustum. The near plane is left out, as the eye may be closer to
+        # a portal than the near plane. Through each portal, the side
+        # planes are replaced by the planes through the portal edges.
+        far = self.frustum[5:]
+        visible = np.zeros(len(self.rooms), dtype=bool)
+
+        def visit(idx, planes, path):
+            visible[idx] = True
+
+            for other, quad, normal in self.portal_graph[idx]:
+                if other in path:
+                    continue
+
+                # Skip the portals seen from behind
+                dist = np.dot(normal, eye - quad[0])
+                if dist <= 0:
+                    continue
+
+                poly = clip_polygon(quad, planes)
+                if poly is None:
+                    continue
+
+                # Standing in a portal, keep the frustum
+                if dist < 0.01:
+                    visit(other, planes, path | {other})
+                    continue
+
+                portal_planes = polygon_planes(eye, poly)
+                visit(other, np.concatenate([far, portal_planes]), path | {other})
+
+        visit(room_idx, self.frustum[[0, 1, 2, 3, 5]], {room_idx})
+
+        self.visible_rooms = visible & in_frustum
+        self.portal_culled = True
+
+    def _room_containing(self, pos):
+        """
+        Get the index of the room containing a position, or None
+        """
+
+        inside = np.all(
+            (self.room_bound_min <= pos) & (pos <= self.room_bound_max), axis=1
+        )
+
+        for idx in np.flatnonzero(inside):
+            if self.rooms[idx].point_inside(pos):
+                return idx
+
+        return None
+
+    def render_obs_batch(self, cameras=None, frame_buffer=None, out=None):
+        """
+        Render observations from several cameras placed in this world
+        The cameras are agents (objects with cam_pos, cam_dir and cam_fov_y)
+        and default to the environment's own agent.
+        Returns a uint8 array of shape (N, H, W, 3)
+        """
+
+        if cameras is None:
+            cameras = [self.agent]
+
+        return render_obs_batch(
+            [(self, camera) for camera in cameras], frame_buffer, out
+        )
+
+    def _get_batch_fb(self, num_tiles):
+        """
+        Get a tiled frame buffer with one observation-sized tile per view
+        """
+
+        if self.batch_fb is None or self.batch_fb.num_tiles != num_tiles:
+            self.batch_fb = TiledFrameBuffer(
+                self.obs_fb.width,
+                self.obs_fb.height,
+                num_tiles,
+                self.obs_fb.num_samples or 1,
+                top_down=self.top_down_readback,
+            )
+
+        return self.batch_fb
 
     def render_depth(self, frame_buffer=None):
         """
@@ -1494,9 +2202,9 @@ class MiniWorldEnv(gym.Env):
             frame_buffer = self.obs_fb
 
         # Render the world
-        self.render_obs(frame_buffer)
+        _, depth = self.render_obs_depth(frame_buffer)
 
-        return frame_buffer.get_depth_map(0.04, 100.0)
+        return depth
 
     def get_visible_ents(self):
         """
@@ -1512,7 +2220,7 @@ class MiniWorldEnv(gym.Env):
 
         # Switch to the default OpenGL context
         # This is necessary on Linux Nvidia drivers
-        self.shadow_window.switch_to()
+        self.gl_context.switch_to()
 
         # Use the small observation frame buffer
         frame_buffer = self.obs_fb
@@ -1525,34 +2233,12 @@ class MiniWorldEnv(gym.Env):
         glClearDepth(1.0)
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
-        # Set the projection matrix
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        gluPerspective(
-            self.agent.cam_fov_y,
-            frame_buffer.width / float(frame_buffer.height),
-            0.04,
-            100.0,
-        )
-
-        # Setup the cameravisible objects
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        gluLookAt(
-            # Eye position
-            *self.agent.cam_pos,
-            # Target
-            *(self.agent.cam_pos + self.agent.cam_dir),
-            # Up vector
-            0,
-            1.0,
-            0.0,
-        )
+        # Set the projection matrix and camera
+        self._setup_camera(self.agent, frame_buffer)
 
         # Render the rooms, without texturing
         glDisable(GL_TEXTURE_2D)
-        for room in self.rooms:
-            room._render()
+        self.static_geom.render(textured=False)
 
         # For each entity
         for ent_idx, ent in enumerate(self.entities):
@@ -1595,10 +2281,84 @@ class MiniWorldEnv(gym.Env):
 
         return vis_objs
 
+    def _init_obs_fb(self):
+        """
+        Create the frame buffer used to render observations
+        """
+
+        self.gl_context.switch_to()
+
+        self.obs_fb = FrameBuffer(
+            self.obs_width,
+            self.obs_height,
+            self.obs_samples,
+            top_down=self.top_down_readback,
+            float_depth=self.obs_depth,
+            seg=self.obs_seg,
+        )
+
+    def _init_render(self):
+        """
+        Create the frame buffer and text label used for human visualization
+        """
+
+        self.gl_context.switch_to()
+
+        # Frame buffer used for human visualization
+        self.vis_fb = FrameBuffer(
+            self.window_width, self.window_height, 16, top_down=self.top_down_readback
+        )
+
+        # For displaying text
+        try:
+            self.text_label = pyglet.text.Label(
+                font_name="Arial",
+                font_size=14,
+                multiline=True,
+                width=400,
+                x=self.window_width + 5,
+                y=self.window_height - (self.obs_disp_height + 19),
+            )
+        except Exception:
+            self.text_label = None
+
     def close(self):
         if self.window:
             self.window.close()
-        return
+
+        # Free the OpenGL objects of this environment, and release the
+        # textures and meshes no other environment sharing the context uses
+        if self.use_gl:
+            self.gl_context.switch_to()
+
+        if self.static_list is not None:
+            glDeleteLists(self.static_list, 1)
+            self.static_list = None
+
+        if self.static_geom is not None:
+            self.static_geom.delete()
+
+        frame_buffers = [
+            self.obs_fb,
+            self.vis_fb,
+            self.batch_fb,
+            self.local_map_fb,
+            self.local_top_view_fb,
+            *self.top_view_cache.values(),
+        ]
+        for frame_buffer in frame_buffers:
+            if frame_buffer is not None:
+                frame_buffer.delete()
+
+        self.obs_fb = None
+        self.vis_fb = None
+        self.batch_fb = None
+        self.local_map_fb = None
+        self.local_top_view_fb = None
+        self.top_view_cache = {}
+        self.top_view_valid.clear()
+
+        self.gl_context.resources.release(self)
 
     def render(self):
         """
@@ -1613,6 +2373,9 @@ class MiniWorldEnv(gym.Env):
             )
             return
 
+        if self.vis_fb is None:
+            self._init_render()
+
         # Render the human-view image
         if self.view == "agent":
             img = self.render_obs(self.vis_fb)
@@ -1645,6 +2408,7 @@ class MiniWorldEnv(gym.Env):
 
         # Bind the default frame buffer
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glFrontFace(GL_CCW)
 
         # Clear the color and depth buffers
         glClearColor(0, 0, 0, 1.0)
@@ -1658,19 +2422,21 @@ class MiniWorldEnv(gym.Env):
         glLoadIdentity()
         glOrtho(0, window_width, 0, window_height, 0, 10)
 
+        # The images are stored top-to-bottom. Instead of copying flipped
+        # images, draw them with a negative height (flipped quads)
+        glDisable(GL_CULL_FACE)
+
         # Draw the human render to the rendering window
-        img_flip = np.ascontiguousarray(np.flip(img, axis=0))
         img_data = pyglet.image.ImageData(
             img_width,
             img_height,
             "RGB",
-            img_flip.ctypes.data_as(POINTER(GLubyte)),
+            img.ctypes.data_as(POINTER(GLubyte)),
             pitch=img_width * 3,
         )
-        img_data.blit(0, 0, 0, width=img_width, height=img_height)
+        img_data.blit(0, img_height, 0, width=img_width, height=-img_height)
 
         # Draw the observation
-        obs = np.ascontiguousarray(np.flip(obs, axis=0))
         obs_data = pyglet.image.ImageData(
             obs_width,
             obs_height,
@@ -1680,12 +2446,14 @@ class MiniWorldEnv(gym.Env):
         )
         obs_data.blit(
             img_width,
-            img_height - self.obs_disp_height,
+            img_height,
             0,
             width=self.obs_disp_width,
-            height=self.obs_disp_height,
+            height=-self.obs_disp_height,
         )
 
+        glEnable(GL_CULL_FACE)
+
         # Draw the text label in the window
         if self.text_label:
             self.text_label.text = "pos: (%.2f, %.2f, %.2f)\nangle: %d\nsteps: %d" % (
@@ -1,19 +1,30 @@
+import hashlib
 import os
 
 import numpy as np
-import pyglet
-from pyglet.gl import GL_TEXTURE_2D, GL_TRIANGLES, glBindTexture, glDisable, glEnable
 
-from miniworld.opengl import Texture
+from miniworld.opengl import InstancedGeometry, ResourceManager, Texture
 from miniworld.utils import get_file_path
 
+# Directory of the parsed meshes cached on disk (None if the environment
+# variable MINIWORLD_MESH_CACHE is set empty, which disables the cache)
+MESH_CACHE_DIR = os.environ.get(
+    "MINIWORLD_MESH_CACHE", os.path.join("~", ".cache", "miniworld", "meshes")
+)
+MESH_CACHE_DIR = os.path.expanduser(MESH_CACHE_DIR) if MESH_CACHE_DIR else None
+
+# Version of the mesh cache format, cached meshes of other versions are
+# parsed again
+MESH_CACHE_VERSION = 2
+
 
 class ObjMesh:
     """
     Load and render OBJ model files
     """
 
-    # Loaded mesh files, indexed by mesh file path
+    # Loaded mesh files, indexed by mesh file path, whether they were
+    # loaded with OpenGL and the maximum size of their textures
     cache = {}
 
     @classmethod
@@ -25,149 +36,223 @@ class ObjMesh:
         # Assemble the absolute path to the mesh file
         file_path = get_file_path("meshes", mesh_name, "obj")
 
-        if file_path in self.cache:
-            return self.cache[file_path]
-
-        mesh = ObjMesh(file_path)
-        self.cache[file_path] = mesh
+        # Meshes loaded without OpenGL, or with another maximum texture
+        # size, have other textures (see Texture.get_file), and are cached
+        # separately
+        key = (
+            file_path,
+            ResourceManager.loading_gl(),
+            ResourceManager.loading_max_size(),
+        )
+        if key not in self.cache:
+            self.cache[key] = ObjMesh(file_path)
+
+        # The mesh textures are used as long as the mesh is
+        mesh = self.cache[key]
+        ResourceManager.track(mesh)
+        for tex in mesh.textures:
+            if tex is not None:
+                ResourceManager.track(tex)
 
         return mesh
 
     def __init__(self, file_path):
         """
         Load an OBJ model file
+        The parsed model is cached on disk (see MESH_CACHE_DIR), so that
+        it is only parsed once.
 
         Limitations:
         - only one object/group
         - only triangle faces
         """
 
-        # OBJ file format:
-        # #Comments
-        # mtllib file_name
-        # o object_name
-        # v x y z
-        # vt u v
-        # vn x y z
-        # usemtl mtl_name
-        # f v0/t0/n0 v1/t1/n1 v2/t2/n2
+        data = self._load_cached(file_path)
+        if data is None:
+            data = self._parse(file_path)
+            self._save_cached(file_path, data)
 
-        # print('Loading mesh "%s"' % file_path)
+        vertices = data["vertices"]
 
-        # Attempt to load the materials library
-        materials = self._load_mtl(file_path)
-        mesh_file = open(file_path)
+        # Recompute the object extents after centering
+        self.min_coords = vertices[:, 0:3].min(axis=0)
+        self.max_coords = vertices[:, 0:3].max(axis=0)
+
+        # Textures, and their file paths, one per chunk
+        # The textures are shared with other meshes and entities using them
+        self.tex_paths = [str(tex_path) or None for tex_path in data["chunk_texs"]]
+        self.textures = [
+            Texture.get_file(tex_path) if tex_path is not None else None
+            for tex_path in self.tex_paths
+        ]
+
+        # Geometry of the mesh, in a single indexed vertex buffer, with one
+        # range of indices per chunk. The geometry is used both to draw
+        # single copies of the mesh and multiple copies at once.
+        self.instanced_geom = InstancedGeometry(
+            vertices[:, 0:3],
+            vertices[:, 3:6],
+            vertices[:, 6:8],
+            vertices[:, 8:11],
+            [
+                (tex, 3 * int(start_idx), 3 * int(end_idx - start_idx))
+                for tex, start_idx, end_idx in zip(
+                    self.textures, data["chunk_starts"], data["chunk_ends"]
+                )
+            ],
+            data["indices"],
+        )
 
-        verts = []
-        texs = []
-        normals = []
-        faces = []
+    @staticmethod
+    def _cache_path(file_path):
+        """
+        Path of the cache file of a mesh, unique to its source path
+        """
 
-        cur_mtl = ""
+        file_path = os.path.realpath(file_path)
+        digest = hashlib.sha1(file_path.encode()).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(file_path))[0]
 
-        # For each line of the input file
-        for line in mesh_file:
-            line = line.rstrip(" \r\n")
+        return os.path.join(MESH_CACHE_DIR, f"{name}_{digest}.npz")
 
-            # Skip comments
-            if line.startswith("#") or line == "":
-                continue
+    @staticmethod
+    def _source_stamp(file_path):
+        """
+        Sizes and modification times of the OBJ and MTL files of a mesh
+        """
 
-            tokens = line.split(" ")
-            tokens = map(lambda t: t.strip(" "), tokens)
-            tokens = list(filter(lambda t: t != "", tokens))
+        stamp = [MESH_CACHE_VERSION]
+        for path in [file_path, os.path.splitext(file_path)[0] + ".mtl"]:
+            if os.path.exists(path):
+                st = os.stat(path)
+                stamp += [st.st_size, st.st_mtime_ns]
+            else:
+                stamp += [-1, -1]
 
-            prefix = tokens[0]
-            tokens = tokens[1:]
+        return np.array(stamp, dtype=np.int64)
 
-            if prefix == "v":
-                vert = list(map(lambda v: float(v), tokens))
-                verts.append(vert)
+    def _load_cached(self, file_path):
+        """
+        Load the parsed model from the cache, None if it is missing or stale
+        (or the cache is disabled)
+        """
 
-            if prefix == "vt":
-                tc = list(map(lambda v: float(v), tokens))
-                texs.append(tc)
+        if MESH_CACHE_DIR is None:
+            return None
 
-            if prefix == "vn":
-                normal = list(map(lambda v: float(v), tokens))
-                normals.append(normal)
+        cache_path = self._cache_path(file_path)
 
-            if prefix == "usemtl":
-                mtl_name = tokens[0]
-                if mtl_name in materials:
-                    cur_mtl = mtl_name
-                else:
-                    cur_mtl = ""
+        try:
+            with np.load(cache_path) as npz:
+                if not np.array_equal(npz["stamp"], self._source_stamp(file_path)):
+                    return None
+                return {key: npz[key] for key in npz.files if key != "stamp"}
+        except (OSError, KeyError, ValueError):
+            return None
 
-            if prefix == "f":
-                assert len(tokens) == 3, "only triangle faces are supported"
+    def _save_cached(self, file_path, data):
+        """
+        Write the parsed model to the cache, if the cache is enabled and
+        writable
+        """
 
-                face = []
-                for token in tokens:
-                    indices = filter(lambda t: t != "", token.split("/"))
-                    indices = list(map(lambda idx: int(idx), indices))
-                    assert len(indices) == 2 or len(indices) == 3
-                    face.append(indices)
+        if MESH_CACHE_DIR is None:
+            return
 
-                faces.append([face, cur_mtl])
+        cache_path = self._cache_path(file_path)
 
-        mesh_file.close()
+        # Write to a temporary file first, so that processes loading the
+        # mesh concurrently never read a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
 
-        # Sort the faces by material name
-        faces.sort(key=lambda f: f[1])
+        try:
+            os.makedirs(MESH_CACHE_DIR, exist_ok=True)
+            np.savez(tmp_path, stamp=self._source_stamp(file_path), **data)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # Don't leave a partial file behind
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-        # Compute the start and end faces for each chunk in the model
-        cur_mtl = None
-        chunks = []
-        for idx, face in enumerate(faces):
-            face, mtl_name = face
-            if mtl_name != cur_mtl:
-                if len(chunks) > 0:
-                    chunks[-1]["end_idx"] = idx
-                chunks.append(
-                    {"mtl": materials[mtl_name], "start_idx": idx, "end_idx": None}
-                )
-                cur_mtl = mtl_name
-        chunks[-1]["end_idx"] = len(faces)
+    def _parse(self, file_path):
+        """
+        Parse an OBJ model file into an array of unique vertices, with
+        interleaved attributes, the vertex indices of the faces, sorted by
+        material, and the table of chunks of faces using each material
+        """
+
+        # OBJ file format:
+        # #Comments
+        # mtllib file_name
+        # o object_name
+        # v x y z
+        # vt u v
+        # vn x y z
+        # usemtl mtl_name
+        # f v0/t0/n0 v1/t1/n1 v2/t2/n2
 
-        num_faces = len(faces)
-        # print('num verts=%d' % len(verts))
-        # print('num faces=%d' % num_faces)
-        # print('num chunks=%d' % len(chunks))
+        # print('Loading mesh "%s"' % file_path)
 
-        # Create numpy arrays to store the vertex data
-        list_verts = np.zeros(shape=(num_faces, 3, 3), dtype=np.float32)
-        list_norms = np.zeros(shape=(num_faces, 3, 3), dtype=np.float32)
-        list_texcs = np.zeros(shape=(num_faces, 3, 2), dtype=np.float32)
-        list_color = np.zeros(shape=(num_faces, 3, 3), dtype=np.float32)
+        # Attempt to load the materials library
+        materials = self._load_mtl(file_path)
 
-        # For each triangle
-        for f_idx, face in enumerate(faces):
-            face, mtl_name = face
+        with open(file_path) as mesh_file:
+            lines = [line.strip() for line in mesh_file]
+
+        # Split the lines by prefix, without the prefix
+        def data_lines(prefix):
+            return [line[len(prefix) :] for line in lines if line.startswith(prefix)]
+
+        def parse_floats(prefix, size):
+            values = np.array(" ".join(data_lines(prefix)).split(), dtype=np.float64)
+            return values.reshape(-1, size)
+
+        verts = parse_floats("v ", 3)
+        texs = parse_floats("vt ", 2)
+        normals = parse_floats("vn ", 3)
+
+        # Faces, as (vertex, texcoord, normal) indices, with a texcoord
+        # index of 0 when texture coordinates are missing (v//n)
+        face_lines = data_lines("f ")
+        num_faces = len(face_lines)
+        indices = " ".join(face_lines).replace("//", "/0/").replace("/", " ").split()
+        assert len(indices) == 9 * num_faces, "only triangle faces are supported"
+        indices = np.array(indices, dtype=np.int64).reshape(num_faces, 3, 3)
+
+        # Material of each face, set by the last usemtl line before it
+        face_line_idx = [i for i, line in enumerate(lines) if line.startswith("f ")]
+        mtl_line_idx = [i for i, line in enumerate(lines) if line.startswith("usemtl")]
+        mtl_names = [""] + [
+            lines[i].split()[1] if lines[i].split()[1] in materials else ""
+            for i in mtl_line_idx
+        ]
+        face_mtl = np.array(mtl_names)[np.searchsorted(mtl_line_idx, face_line_idx)]
 
-            # Get the color for this face
+        # Sort the faces by material name
+        order = np.argsort(face_mtl, kind="stable")
+        indices = indices[order]
+        face_mtl = face_mtl[order]
+
+        # Compute the start and end faces for each chunk in the model
+        chunk_mtls, chunk_starts = np.unique(face_mtl, return_index=True)
+        chunk_ends = np.append(chunk_starts[1:], num_faces)
+
+        # Look up the vertex data of each face
+        # Note: OBJ uses 1-based indexing
+        # and texture coordinates are optional
+        v_idx, t_idx, n_idx = indices[..., 0], indices[..., 1], indices[..., 2]
+        list_verts = verts[v_idx - 1].astype(np.float32)
+        list_norms = normals[n_idx - 1].astype(np.float32)
+        list_texcs = np.zeros(shape=(num_faces, 3, 2), dtype=np.float32)
+        if len(texs) > 0:
+            list_texcs[:] = np.where(t_idx[..., None] > 0, texs[t_idx - 1], 0)
+
+        # Get the color of each face
+        list_color = np.zeros(shape=(num_faces, 3, 3), dtype=np.float32)
+        for mtl_name, start_idx, end_idx in zip(chunk_mtls, chunk_starts, chunk_ends):
             f_mtl = materials[mtl_name]
             f_color = f_mtl["Kd"] if f_mtl else np.array((1, 1, 1))
-
-            # For each tuple of indices
-            for l_idx, indices in enumerate(face):
-                # Note: OBJ uses 1-based indexing
-                # and texture coordinates are optional
-                if len(indices) == 3:
-                    v_idx, t_idx, n_idx = indices
-                    vert = verts[v_idx - 1]
-                    texc = texs[t_idx - 1]
-                    normal = normals[n_idx - 1]
-                else:
-                    v_idx, n_idx = indices
-                    vert = verts[v_idx - 1]
-                    normal = normals[n_idx - 1]
-                    texc = [0, 0]
-
-                list_verts[f_idx, l_idx, :] = vert
-                list_texcs[f_idx, l_idx, :] = texc
-                list_norms[f_idx, l_idx, :] = normal
-                list_color[f_idx, l_idx, :] = f_color
+            list_color[start_idx:end_idx] = f_color
 
         # Re-center the object so that the base is at y=0
         # and the object is centered in x and z
@@ -181,39 +266,25 @@ class ObjMesh:
         list_verts[:, :, 0] -= mean_x
         list_verts[:, :, 2] -= mean_z
 
-        # Recompute the object extents after centering
-        self.min_coords = list_verts.min(axis=0).min(axis=0)
-        self.max_coords = list_verts.max(axis=0).max(axis=0)
-
-        # Vertex lists, one per chunk
-        self.vlists = []
-
-        # Textures, one per chunk
-        self.textures = []
-
-        # For each chunk
-        for chunk in chunks:
-            start_idx = chunk["start_idx"]
-            end_idx = chunk["end_idx"]
-            num_faces_chunk = end_idx - start_idx
-
-            # Create a vertex list to be used for rendering
-            vlist = pyglet.graphics.vertex_list(
-                3 * num_faces_chunk,
-                ("v3f", list_verts[start_idx:end_idx, :, :].reshape(-1)),
-                ("t2f", list_texcs[start_idx:end_idx, :, :].reshape(-1)),
-                ("n3f", list_norms[start_idx:end_idx, :, :].reshape(-1)),
-                ("c3f", list_color[start_idx:end_idx, :, :].reshape(-1)),
-            )
-
-            mtl = chunk["mtl"]
-            if "map_Kd" in mtl:
-                texture = Texture.load(mtl["map_Kd"])
-            else:
-                texture = None
-
-            self.vlists.append(vlist)
-            self.textures.append(texture)
+        # Merge the identical vertices, keeping them in order of first use
+        vertices = np.concatenate([list_verts, list_norms, list_texcs, list_color], 2)
+        vertices = vertices.reshape(-1, InstancedGeometry.VERTEX_SIZE)
+        _, first, inverse = np.unique(
+            vertices, axis=0, return_index=True, return_inverse=True
+        )
+        order = np.argsort(first)
+        remap = np.empty_like(order)
+        remap[order] = np.arange(len(order))
+
+        return {
+            "vertices": vertices[first[order]],
+            "indices": remap[inverse.reshape(-1)].astype(np.uint32),
+            "chunk_starts": chunk_starts,
+            "chunk_ends": chunk_ends,
+            "chunk_texs": np.array(
+                [materials[name].get("map_Kd") or "" for name in chunk_mtls]
+            ),
+        }
 
     def _load_mtl(self, model_file):
         model_dir, file_name = os.path.split(model_file)
@@ -277,16 +348,17 @@ class ObjMesh:
 
         return materials
 
-    def render(self):
-        for idx, vlist in enumerate(self.vlists):
-            texture = self.textures[idx]
+    def release(self):
+        """
+        Remove the mesh from the cache and free its vertex buffers, once no
+        environment uses it
+        """
 
-            if texture:
-                glEnable(GL_TEXTURE_2D)
-                glBindTexture(texture.target, texture.id)
-            else:
-                glDisable(GL_TEXTURE_2D)
+        for key, mesh in list(ObjMesh.cache.items()):
+            if mesh is self:
+                del ObjMesh.cache[key]
 
-            vlist.draw(GL_TRIANGLES)
+        self.instanced_geom.delete()
 
-        glDisable(GL_TEXTURE_2D)
+    def render(self):
+        self.instanced_geom.render_fixed()
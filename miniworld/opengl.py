@@ -1,21 +1,34 @@
+import itertools
+import math
 import os
-from ctypes import POINTER, byref
+import weakref
+from contextlib import contextmanager
+from ctypes import POINTER, byref, cast, create_string_buffer, pointer
 
 import numpy as np
 import pyglet
 
-# Solution to https://github.com/maximecb/gym-miniworld/issues/24
-# until pyglet support egl officially
-from pyglet.gl import (
+from miniworld.gl import (
+    GL_ARRAY_BUFFER,
+    GL_CCW,
+    GL_COLOR,
+    GL_COLOR_ARRAY,
     GL_COLOR_ATTACHMENT0,
     GL_COLOR_BUFFER_BIT,
+    GL_COMPILE_STATUS,
+    GL_CW,
     GL_DEPTH_ATTACHMENT,
     GL_DEPTH_BUFFER_BIT,
     GL_DEPTH_COMPONENT,
     GL_DEPTH_COMPONENT16,
+    GL_DEPTH_COMPONENT32F,
     GL_DEPTH_TEST,
     GL_DRAW_FRAMEBUFFER,
+    GL_DYNAMIC_DRAW,
+    GL_ELEMENT_ARRAY_BUFFER,
+    GL_FALSE,
     GL_FLOAT,
+    GL_FRAGMENT_SHADER,
     GL_FRAMEBUFFER,
     GL_FRAMEBUFFER_COMPLETE,
     GL_FRAMEBUFFER_INCOMPLETE_ATTACHMENT,
@@ -30,61 +43,136 @@ from pyglet.gl import (
     GL_LINEAR,
     GL_LINEAR_MIPMAP_LINEAR,
     GL_LINES,
+    GL_LINK_STATUS,
+    GL_MAX_TEXTURE_SIZE,
     GL_MULTISAMPLE,
     GL_NEAREST,
     GL_NICEST,
+    GL_NORMAL_ARRAY,
     GL_PACK_ALIGNMENT,
+    GL_PIXEL_PACK_BUFFER,
+    GL_PROJECTION,
     GL_QUADS,
+    GL_R32UI,
     GL_READ_FRAMEBUFFER,
+    GL_RED_INTEGER,
     GL_RENDERBUFFER,
     GL_RGB,
+    GL_RGB8,
     GL_RGBA,
     GL_RGBA32F,
+    GL_SCISSOR_TEST,
+    GL_STATIC_DRAW,
+    GL_STREAM_READ,
     GL_TEXTURE_2D,
+    GL_TEXTURE_2D_ARRAY,
     GL_TEXTURE_2D_MULTISAMPLE,
+    GL_TEXTURE_COORD_ARRAY,
     GL_TEXTURE_MAG_FILTER,
+    GL_TEXTURE_MAX_LEVEL,
     GL_TEXTURE_MIN_FILTER,
+    GL_TRIANGLES,
+    GL_TRUE,
+    GL_UNPACK_ALIGNMENT,
     GL_UNSIGNED_BYTE,
+    GL_UNSIGNED_INT,
     GL_UNSIGNED_SHORT,
+    GL_VERTEX_ARRAY,
+    GL_VERTEX_SHADER,
+    GLchar,
+    GLdouble,
+    GLfloat,
     GLint,
+    GLsizei,
     GLubyte,
     GLuint,
     GLushort,
     gl_info,
+    glAttachShader,
     glBegin,
+    glBindAttribLocation,
+    glBindBuffer,
     glBindFramebuffer,
     glBindRenderbuffer,
     glBindTexture,
     glBlitFramebuffer,
+    glBufferData,
     glCheckFramebufferStatus,
+    glClear,
+    glClearBufferuiv,
     glColor3f,
+    glColorPointer,
+    glCompileShader,
+    glCreateProgram,
+    glCreateShader,
+    glDeleteBuffers,
+    glDeleteFramebuffers,
+    glDeleteRenderbuffers,
+    glDeleteShader,
+    glDeleteTextures,
+    glDisable,
+    glDisableClientState,
+    glDisableVertexAttribArray,
+    glDrawArrays,
+    glDrawArraysInstanced,
+    glDrawElements,
+    glDrawElementsInstanced,
     glEnable,
+    glEnableClientState,
+    glEnableVertexAttribArray,
     glEnd,
     glFramebufferRenderbuffer,
     glFramebufferTexture2D,
+    glFrontFace,
+    glGenBuffers,
     glGenerateMipmap,
     glGenFramebuffers,
     glGenRenderbuffers,
     glGenTextures,
+    glGetAttribLocation,
+    glGetBufferSubData,
     glGetIntegerv,
+    glGetProgramInfoLog,
+    glGetProgramiv,
+    glGetShaderInfoLog,
+    glGetShaderiv,
+    glGetTexImage,
+    glGetUniformLocation,
     glHint,
+    glLinkProgram,
+    glLoadMatrixd,
+    glMatrixMode,
+    glMultiDrawArrays,
     glNormal3f,
+    glNormalPointer,
     glPixelStorei,
     glReadPixels,
     glRenderbufferStorage,
     glRenderbufferStorageMultisample,
+    glScissor,
+    glShaderSource,
+    glTexCoordPointer,
     glTexImage2D,
     glTexImage2DMultisample,
+    glTexImage3D,
     glTexParameteri,
+    glTexSubImage3D,
+    glUniform1f,
+    glUniform1i,
+    glUniform1ui,
+    glUniform3f,
+    glUniform4f,
+    glUniformMatrix4fv,
+    glUseProgram,
     glVertex3f,
+    glVertexAttribDivisor,
+    glVertexAttribPointer,
+    glVertexPointer,
     glViewport,
 )
-
-from miniworld.utils import get_file_path
-
-if os.environ.get("PYOPENGL_PLATFORM", None) == "egl":
-    pyglet.options["headless"] = True
-
+from miniworld.shaders import SHADERS
+from miniworld.texcache import TextureCache, decode_image, downsample_image
+from miniworld.utils import get_file_path, get_subdir_path, image_size
 
 # Mapping of frame buffer error enums to strings
 FB_ERROR_ENUMS = {
@@ -99,79 +187,339 @@ FB_ERROR_ENUMS = {
 }
 
 
+class ResourceManager:
+    """
+    Track the textures and meshes used by the environments sharing an
+    OpenGL context, with a count of the environments using each of them.
+    The resources loaded while an environment is active (see use) are
+    attributed to it, and released once the last environment using them
+    is closed.
+    """
+
+    # Manager the resources loaded are attributed to (None if no
+    # environment is active)
+    active = None
+
+    def __init__(self, gl=True):
+        # Whether the resources are OpenGL objects. Environments created
+        # without OpenGL load them without uploading anything.
+        self.gl = gl
+
+        # Environments using each resource
+        self.users = {}
+
+        # Array textures packing the textures of this context, indexed by
+        # texture size (see TextureArray)
+        self.texture_arrays = {}
+
+        # Environment active while loading resources, and the maximum size
+        # of the textures it loads
+        self.owner = None
+        self.max_texture_size = None
+
+    @contextmanager
+    def use(self, owner, max_texture_size=None):
+        """
+        Attribute the resources loaded within this context to an environment
+        Textures larger than max_texture_size are downsampled on load.
+        """
+
+        prev = (ResourceManager.active, self.owner, self.max_texture_size)
+        ResourceManager.active, self.owner = self, owner
+        self.max_texture_size = max_texture_size
+
+        try:
+            yield self
+        finally:
+            ResourceManager.active, self.owner, self.max_texture_size = prev
+
+    @classmethod
+    def track(cls, resource):
+        """
+        Count a resource as used by the active environment, if any
+        """
+
+        manager = cls.active
+        if manager is not None:
+            if resource not in manager.users:
+                manager.users[resource] = weakref.WeakSet()
+            manager.users[resource].add(manager.owner)
+
+    @classmethod
+    def loading_gl(cls):
+        """
+        Whether the resources loaded now are OpenGL objects, which is the
+        case unless the active environment was created without OpenGL
+        """
+
+        return cls.active is None or cls.active.gl
+
+    @classmethod
+    def loading_max_size(cls):
+        """
+        Maximum width and height of the textures loaded now, set by the
+        active environment (None for full-size textures). Textures loaded
+        without OpenGL are not uploaded, and never downsampled.
+        """
+
+        if cls.active is None or not cls.active.gl:
+            return None
+
+        return cls.active.max_texture_size
+
+    def num_users(self, resource):
+        """
+        Number of environments using a resource
+        """
+
+        return len(self.users.get(resource, ()))
+
+    def release(self, owner):
+        """
+        Stop counting the resources used by an environment, and release
+        those no other environment uses. Resources of environments freed
+        without being closed are also released.
+        Returns the number of resources released.
+        """
+
+        released = []
+        for resource, users in self.users.items():
+            users.discard(owner)
+            if len(users) == 0:
+                released.append(resource)
+
+        for resource in released:
+            del self.users[resource]
+            resource.release()
+
+        self._release_layers(released)
+
+        return len(released)
+
+    def _release_layers(self, textures):
+        """
+        Free the layers of released textures in the array textures,
+        and delete the arrays left empty
+        """
+
+        for key, array in list(self.texture_arrays.items()):
+            for tex in textures:
+                if tex in array.layers:
+                    array.remove(tex)
+
+            if len(array.layers) == 0:
+                array.delete()
+                del self.texture_arrays[key]
+
+    def release_all(self):
+        """
+        Release all the resources, before their OpenGL context is destroyed
+        """
+
+        for resource in self.users:
+            resource.release()
+
+        for array in self.texture_arrays.values():
+            array.delete()
+
+        self.users = {}
+        self.texture_arrays.clear()
+
+
+class NoGLContext:
+    """
+    Stand-in for the OpenGL context of environments created without
+    OpenGL (use_gl=False), holding the resources they load, which are not
+    uploaded. A single one is used per process, as for OpenGL contexts.
+    """
+
+    # Stand-in shared by all the environments
+    instance = None
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = NoGLContext()
+
+        return cls.instance
+
+    def __init__(self):
+        self.resources = ResourceManager(gl=False)
+
+    def switch_to(self):
+        raise RuntimeError(
+            "environment created without OpenGL (use_gl=False), "
+            "it can only be drawn in software (see miniworld.softrender)"
+        )
+
+
 class Texture:
     """
     Manage the loading and caching of textures, as well as texture randomization
     """
 
-    # List of textures available for a given path
+    # List of texture files available for a given texture name, one per
+    # variant used for domain randomization
     tex_paths = {}
 
-    # Cache of textures
+    # Whether the textures directory was indexed into tex_paths
+    indexed = False
+
+    # Cache of textures, indexed by path, maximum size and whether they
+    # are OpenGL textures
     tex_cache = {}
 
     @classmethod
-    def get(self, tex_name, rng=None):
+    def get(self, tex_name, rng=None, max_size=None):
         """
         Load a texture by name (or used a cached version)
         Also performs domain randomization if multiple versions are available.
         """
 
-        paths = self.tex_paths.get(tex_name, [])
+        paths = self.get_paths(tex_name)
+
+        # If domain-randomization is to be used
+        if rng:
+            path_idx = rng.integers(0, len(paths))
+            path = paths[path_idx]
+        else:
+            path = paths[0]
+
+        return self.get_file(path, tex_name, max_size)
+
+    @classmethod
+    def get_file(cls, path, tex_name=None, max_size=None):
+        """
+        Load a texture by file path (or use a cached version)
+        Textures larger than max_size are downsampled on load, by default
+        to the maximum texture size of the environment loading them.
+        """
+
+        if tex_name is None:
+            tex_name = os.path.splitext(os.path.basename(path))[0]
+
+        if max_size is None:
+            max_size = ResourceManager.loading_max_size()
+
+        # Environments created without OpenGL only use the size of the
+        # textures, which are not uploaded, and are cached separately
+        gl = ResourceManager.loading_gl()
+        key = (path, max_size if gl else None, gl)
+        if key not in cls.tex_cache:
+            tex = Texture.load(path, max_size) if gl else None
+            cls.tex_cache[key] = Texture(
+                tex, tex_name, path, image_size(path), max_size
+            )
+
+        tex = cls.tex_cache[key]
+        ResourceManager.track(tex)
+
+        return tex
+
+    @classmethod
+    def get_paths(cls, tex_name):
+        """
+        Get the list of texture files available for a texture name
+        """
+
+        if not cls.indexed:
+            cls.index_textures()
 
-        # Get an inventory of the existing texture files
-        if len(paths) == 0:
-            for i in range(1, 10):
+        paths = cls.tex_paths.get(tex_name)
+
+        # Textures outside of the textures directory are looked up on disk
+        if paths is None:
+            paths = []
+            for i in itertools.count(1):
                 path = get_file_path("textures", "%s_%d" % (tex_name, i), "png")
 
                 if not os.path.exists(path):
-                    # Also check the filename without the id
-                    path = get_file_path("textures", tex_name, "png")
-                    paths.append(path)
                     break
 
                 paths.append(path)
 
-        assert len(paths) > 0, ValueError(
-            'failed to load textures for name "%s"' % tex_name
-        )
+            # Also check the filename without the id
+            if len(paths) == 0:
+                paths.append(get_file_path("textures", tex_name, "png"))
 
-        # If domain-randomization is to be used
-        if rng:
-            path_idx = rng.integers(0, len(paths))
-            path = paths[path_idx]
-        else:
-            path = paths[0]
+            cls.tex_paths[tex_name] = paths
+
+        return paths
+
+    @classmethod
+    def num_variants(cls, tex_name):
+        """
+        Number of variants of a texture available for domain randomization
+        """
+
+        return len(cls.get_paths(tex_name))
+
+    @classmethod
+    def index_textures(cls):
+        """
+        List the texture files of the textures directory, once, so that
+        textures are looked up without probing the filesystem. The files
+        named <name>_<i>.png are the variants of the texture <name>, used
+        instead of <name>.png if both exist.
+        """
+
+        tex_dir = get_subdir_path("textures")
+        variants = {}
+
+        for dir_path, _, file_names in os.walk(tex_dir):
+            rel_dir = os.path.relpath(dir_path, tex_dir)
 
-        if path not in self.tex_cache:
-            self.tex_cache[path] = Texture(Texture.load(path), tex_name)
+            for file_name in file_names:
+                base, ext = os.path.splitext(file_name)
+                if ext != ".png":
+                    continue
 
-        return self.tex_cache[path]
+                name = base if rel_dir == "." else f"{rel_dir}/{base}"
+                path = os.path.join(tex_dir, name + ".png")
+                cls.tex_paths.setdefault(name, [path])
+
+                prefix, _, idx = name.rpartition("_")
+                if prefix and idx.isdigit():
+                    variants.setdefault(prefix, []).append((int(idx), path))
+
+        for name, paths in variants.items():
+            cls.tex_paths[name] = [path for _, path in sorted(paths)]
+
+        cls.indexed = True
 
     @classmethod
-    def load(cls, tex_path):
+    def load(cls, tex_path, max_size=None):
         """
         Load a texture based on its path. No domain randomization.
         In most cases, this method should not be used directly.
+        The decoded image is taken from the texture cache if available
+        (see miniworld/texcache.py). Images larger than max_size are
+        downsampled (None to load them at full resolution).
         """
 
         # print('Loading texture "%s"' % tex_path)
 
-        img = pyglet.image.load(tex_path)
-        tex = img.get_texture()
+        pixels, src_size = cls.load_image(tex_path, max_size)
+
+        height, width = pixels.shape[:2]
+        if (width, height) != src_size:
+            return cls._load_downsampled(pixels, width, height)
+
+        tex = pyglet.image.Texture.create(width, height)
         glEnable(tex.target)
         glBindTexture(tex.target, tex.id)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
 
         glTexImage2D(
             GL_TEXTURE_2D,
             0,
             GL_RGB,
-            img.width,
-            img.height,
+            width,
+            height,
             0,
             GL_RGBA,
             GL_UNSIGNED_BYTE,
-            img.get_image_data().get_data("RGBA", img.width * 4),
+            pixels.ctypes.data_as(POINTER(GLubyte)),
         )
 
         # Generate mipmaps (multiple levels of detail)
@@ -187,167 +535,806 @@ class Texture:
 
         return tex
 
-    def __init__(self, tex, tex_name):
-        assert not isinstance(tex, str)
-        self.tex = tex
-        self.width = self.tex.width
-        self.height = self.tex.height
-        self.name = tex_name
+    @classmethod
+    def load_image(cls, tex_path, max_size=None):
+        """
+        Get the RGBA pixels of a texture image, of shape (H, W, 4), from
+        the texture cache if available or else by decoding the image file.
+        Images larger than max_size are downsampled.
+        Returns the pixels along with the (width, height) of the image.
+        """
 
-    def bind(self):
-        glBindTexture(self.tex.target, self.tex.id)
+        cached = TextureCache.lookup(tex_path, max_size)
+        if cached is not None:
+            pixels, (src_width, src_height) = cached
+        else:
+            pixels = decode_image(tex_path)
+            src_height, src_width = pixels.shape[:2]
 
+        if max_size is not None and max(src_width, src_height) > max_size:
+            scale = max_size / max(src_width, src_height)
+            width = max(1, int(src_width * scale))
+            height = max(1, int(src_height * scale))
+            pixels = downsample_image(pixels, width, height)
 
-class FrameBuffer:
-    """
-    Manage frame buffers for rendering
-    """
+        return pixels, (src_width, src_height)
 
-    def __init__(self, width, height, num_samples=1):
-        """Create the frame buffer objects"""
+    @classmethod
+    def _load_downsampled(cls, pixels, width, height):
+        """
+        Upload downsampled RGBA pixels of the given size, along with
+        their mip levels, computed by averaging blocks of pixels
+        """
 
-        assert num_samples > 0
-        assert num_samples <= 16
+        tex = pyglet.image.Texture.create(width, height)
+        glBindTexture(tex.target, tex.id)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
 
-        self.width = width
-        self.height = height
+        # Upload the mip levels down to 1x1, as glGenerateMipmap would
+        level = 0
+        while True:
+            if level > 0:
+                pixels = downsample_image(pixels, width, height)
+            glTexImage2D(
+                GL_TEXTURE_2D,
+                level,
+                GL_RGB,
+                width,
+                height,
+                0,
+                GL_RGBA,
+                GL_UNSIGNED_BYTE,
+                pixels.ctypes.data_as(POINTER(GLubyte)),
+            )
 
-        # Create a frame buffer (rendering target)
-        self.multi_fbo = GLuint(0)
-        glGenFramebuffers(1, byref(self.multi_fbo))
-        glBindFramebuffer(GL_FRAMEBUFFER, self.multi_fbo)
+            if width == 1 and height == 1:
+                break
 
-        # The try block here is because some OpenGL drivers
-        # (Intel GPU drivers on MacBooks in particular) do not
-        # support multisampling on frame buffer objects
-        try:
-            # Ensure that the correct extension is supported
-            assert gl_info.have_extension("GL_EXT_framebuffer_multisample")
+            width = max(1, width // 2)
+            height = max(1, height // 2)
+            level += 1
 
-            # Get the maximum number of samples supported
-            MAX_SAMPLES_EXT = 0x8D57
-            max_samples = GLint()
-            glGetIntegerv(MAX_SAMPLES_EXT, max_samples)
-            max_samples = max_samples.value
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, level)
 
-            if num_samples > max_samples:
-                print(f"Falling back to num_samples={max_samples}")
-                num_samples = max_samples
+        # Trilinear texture filtering
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
 
-            # Create a multisampled texture to render into
-            fbTex = GLuint(0)
-            glGenTextures(1, byref(fbTex))
-            glBindTexture(GL_TEXTURE_2D_MULTISAMPLE, fbTex)
-            glTexImage2DMultisample(
-                GL_TEXTURE_2D_MULTISAMPLE, num_samples, GL_RGBA32F, width, height, True
-            )
-            glFramebufferTexture2D(
-                GL_FRAMEBUFFER,
-                GL_COLOR_ATTACHMENT0,
-                GL_TEXTURE_2D_MULTISAMPLE,
-                fbTex,
-                0,
-            )
+        # Unbind the texture
+        glBindTexture(GL_TEXTURE_2D, 0)
 
-            # Attach a multisampled depth buffer to the FBO
-            depth_rb = GLuint(0)
-            glGenRenderbuffers(1, byref(depth_rb))
-            glBindRenderbuffer(GL_RENDERBUFFER, depth_rb)
-            glRenderbufferStorageMultisample(
-                GL_RENDERBUFFER, num_samples, GL_DEPTH_COMPONENT16, width, height
-            )
-            glFramebufferRenderbuffer(
-                GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth_rb
-            )
+        return tex
 
-            # Check that the frame buffer creation succeeded
-            res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
-            assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
+    def __init__(self, tex, tex_name, path=None, size=None, max_size=None):
+        """
+        The size of a texture is the (width, height) of its image, which
+        texture coordinates are scaled by. It defaults to the size of the
+        OpenGL texture, which is smaller if the image was downsampled on
+        load (to max_size). Textures loaded without OpenGL have no OpenGL
+        texture (tex is None).
+        """
 
-        except Exception:
-            print("Falling back to non-multisampled frame buffer")
+        assert not isinstance(tex, str)
+        self.tex = tex
+        if size is None:
+            size = (tex.width, tex.height)
+        self.width, self.height = size
+        self.name = tex_name
+        self.path = path
+        self.max_size = max_size
 
-            # Create a plain texture to render into
-            fbTex = GLuint(0)
-            glGenTextures(1, byref(fbTex))
-            glBindTexture(GL_TEXTURE_2D, fbTex)
-            glTexImage2D(
-                GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_FLOAT, None
-            )
-            glFramebufferTexture2D(
-                GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, fbTex, 0
-            )
+    def bind(self):
+        glBindTexture(self.tex.target, self.tex.id)
 
-            # Attach depth buffer to FBO
-            depth_rb = GLuint(0)
-            glGenRenderbuffers(1, byref(depth_rb))
-            glBindRenderbuffer(GL_RENDERBUFFER, depth_rb)
-            glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT16, width, height)
-            glFramebufferRenderbuffer(
-                GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth_rb
-            )
+    def release(self):
+        """
+        Remove the texture from the cache, once no environment uses it
+        The OpenGL texture is deleted by pyglet when the last reference
+        to it is dropped, as entities of closed environments and texture
+        arrays may still refer to it.
+        """
 
-        # Sanity check
-        res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
-        assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
+        for key, tex in list(Texture.tex_cache.items()):
+            if tex is self:
+                del Texture.tex_cache[key]
 
-        # Create the frame buffer used to resolve the final render
-        self.final_fbo = GLuint(0)
-        glGenFramebuffers(1, byref(self.final_fbo))
-        glBindFramebuffer(GL_FRAMEBUFFER, self.final_fbo)
+    def read_pixels(self):
+        """
+        Read the texture image back from OpenGL, as an (H, W, 3) array
+        """
 
-        # Create the texture used to resolve the final render
-        fbTex = GLuint(0)
-        glGenTextures(1, byref(fbTex))
-        glBindTexture(GL_TEXTURE_2D, fbTex)
-        glTexImage2D(
-            GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_FLOAT, None
-        )
-        glFramebufferTexture2D(
-            GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, fbTex, 0
-        )
+        pixels = np.zeros(shape=(self.tex.height, self.tex.width, 3), dtype=np.uint8)
 
-        # Create a depth buffer for the final frame buffer
-        depth_rb = GLuint(0)
-        glGenRenderbuffers(1, byref(depth_rb))
-        glBindRenderbuffer(GL_RENDERBUFFER, depth_rb)
-        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT16, width, height)
-        glFramebufferRenderbuffer(
-            GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth_rb
+        glBindTexture(self.tex.target, self.tex.id)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glGetTexImage(
+            self.tex.target,
+            0,
+            GL_RGB,
+            GL_UNSIGNED_BYTE,
+            pixels.ctypes.data_as(POINTER(GLubyte)),
         )
+        glBindTexture(self.tex.target, 0)
 
-        # Sanity check
-        res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
-        assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
-
-        # Enable depth testing
-        glEnable(GL_DEPTH_TEST)
+        return pixels
 
-        # Unbind the frame buffer
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
 
-        # Array to render the image into (for observation rendering)
-        # The array is stored in column-major order
-        self.img_array = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+class TextureArray:
+    """
+    Array texture packing same-sized textures as layers, so that geometry
+    using any of them can be drawn without switching textures.
+    Textures are added on demand and the array grows as needed. The arrays
+    belong to the resource manager of the OpenGL context, which frees the
+    layers of the textures it releases, for the next textures added to
+    reuse, and deletes the arrays left empty.
+    """
 
-    def bind(self):
+    @classmethod
+    def pack(cls, textures, resources):
         """
-        Bind the frame buffer before rendering into it
+        Pack textures into the array textures of a resource manager, one
+        array per size of their OpenGL textures
+        Returns a dictionary mapping each texture to an (array, layer) pair
         """
 
-        # Bind the multisampled frame buffer
-        glEnable(GL_MULTISAMPLE)
-        glBindFramebuffer(GL_FRAMEBUFFER, self.multi_fbo)
-        glViewport(0, 0, self.width, self.height)
+        arrays = resources.texture_arrays
+        added = {}
 
-    def resolve(self):
-        """
-        Produce a numpy image array from the rendered image
-        """
+        for tex in textures:
+            key = (tex.tex.width, tex.tex.height)
+            if key not in arrays:
+                arrays[key] = TextureArray(*key)
 
-        # Resolve the multisampled frame buffer into the final frame buffer
-        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.multi_fbo)
-        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.final_fbo)
+            array = arrays[key]
+            if tex not in array.layers:
+                added.setdefault(array, {})[tex] = None
+
+        # Grow each array once for all its new textures, so that the
+        # layers already uploaded are only uploaded again once
+        for array, new_textures in added.items():
+            array.reserve(len(new_textures))
+            for tex in new_textures:
+                array.add(tex)
+
+        packed = {}
+        for tex in textures:
+            array = arrays[(tex.tex.width, tex.tex.height)]
+            packed[tex] = (array, array.layers[tex])
+
+        # Generate mipmaps once all the new layers are uploaded
+        for array in added:
+            array.bind()
+            glGenerateMipmap(GL_TEXTURE_2D_ARRAY)
+            glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+
+        return packed
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+        # Source textures, one per layer (None for free layers)
+        self.textures = []
+
+        # Layer index of each texture
+        self.layers = {}
+
+        # Layers freed by removed textures
+        self.free_layers = []
+
+        # Number of layers allocated
+        self.capacity = 0
+
+        self.id = None
+
+    def add(self, tex):
+        """
+        Add a texture as a new layer
+        Note: mipmaps must be regenerated after adding layers
+        """
+
+        assert (tex.tex.width, tex.tex.height) == (self.width, self.height)
+
+        if len(self.free_layers) > 0:
+            self.layers[tex] = self.free_layers.pop()
+            self.textures[self.layers[tex]] = tex
+        else:
+            self.layers[tex] = len(self.textures)
+            self.textures.append(tex)
+
+        if len(self.textures) > self.capacity:
+            # Reallocate the array with more layers, and upload all of them
+            self._allocate(max(4, 2 * self.capacity))
+        else:
+            self._upload_layer(self.layers[tex])
+
+        return self.layers[tex]
+
+    def reserve(self, count):
+        """
+        Make room for count more textures, reallocating the array at once
+        if needed
+        """
+
+        needed = len(self.textures) + max(0, count - len(self.free_layers))
+        if needed > self.capacity:
+            self._allocate(max(4, needed, 2 * self.capacity))
+
+    def remove(self, tex):
+        """
+        Remove a texture, freeing its layer
+        The layers of the other textures are left unchanged, as the
+        geometry drawn with them refers to their index.
+        """
+
+        layer = self.layers.pop(tex)
+        self.textures[layer] = None
+        self.free_layers.append(layer)
+
+    def delete(self):
+        """
+        Free the array texture
+        """
+
+        if self.id is not None:
+            glDeleteTextures(1, byref(self.id))
+            self.id = None
+
+    def _allocate(self, capacity):
+        if self.id is not None:
+            glDeleteTextures(1, byref(self.id))
+
+        self.capacity = capacity
+
+        self.id = GLuint(0)
+        glGenTextures(1, byref(self.id))
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.id)
+        glTexImage3D(
+            GL_TEXTURE_2D_ARRAY,
+            0,
+            GL_RGB8,
+            self.width,
+            self.height,
+            capacity,
+            0,
+            GL_RGB,
+            GL_UNSIGNED_BYTE,
+            None,
+        )
+
+        # Trilinear texture filtering
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(
+            GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR
+        )
+
+        for layer in self.layers.values():
+            self._upload_layer(layer)
+
+    def _upload_layer(self, layer):
+        # Upload the pixels of the texture image rather than reading the
+        # 2D texture back from OpenGL
+        tex = self.textures[layer]
+        if tex.path is not None:
+            pixels, _ = Texture.load_image(tex.path, tex.max_size)
+            pixel_format = GL_RGBA
+        else:
+            pixels = tex.read_pixels()
+            pixel_format = GL_RGB
+
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.id)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexSubImage3D(
+            GL_TEXTURE_2D_ARRAY,
+            0,
+            0,
+            0,
+            layer,
+            self.width,
+            self.height,
+            1,
+            pixel_format,
+            GL_UNSIGNED_BYTE,
+            pixels.ctypes.data_as(POINTER(GLubyte)),
+        )
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+
+    def bind(self):
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.id)
+
+
+class ShaderProgram:
+    """
+    Compile and cache GLSL shader programs
+    The shader sources are defined in miniworld/shaders.py
+    """
+
+    # Compiled programs, indexed by name
+    cache = {}
+
+    # Uniform values shared by all programs (camera and light parameters),
+    # set on a program whenever it is used
+    shared = {}
+
+    @classmethod
+    def get(cls, name):
+        """
+        Get a shader program by name (or use a cached version)
+        """
+
+        if name not in cls.cache:
+            vert_src, frag_src = SHADERS[name]
+            cls.cache[name] = ShaderProgram(vert_src, frag_src)
+
+        return cls.cache[name]
+
+    @classmethod
+    def set_shared(cls, **values):
+        """
+        Set the values of uniforms shared by all programs
+        """
+
+        cls.shared.update(values)
+
+    def __init__(self, vert_src, frag_src):
+        self.id = glCreateProgram()
+
+        shaders = [
+            self._compile(GL_VERTEX_SHADER, vert_src),
+            self._compile(GL_FRAGMENT_SHADER, frag_src),
+        ]
+        for shader in shaders:
+            glAttachShader(self.id, shader)
+
+        # The position must be attribute 0 in compatibility contexts
+        glBindAttribLocation(self.id, 0, b"position")
+
+        glLinkProgram(self.id)
+
+        status = GLint(0)
+        glGetProgramiv(self.id, GL_LINK_STATUS, byref(status))
+        if not status.value:
+            log = create_string_buffer(4096)
+            glGetProgramInfoLog(self.id, len(log), None, log)
+            raise RuntimeError("failed to link shader program:\n" + log.value.decode())
+
+        for shader in shaders:
+            glDeleteShader(shader)
+
+        # Uniform and attribute locations, indexed by name
+        self.locations = {}
+        self.attribs = {}
+
+    @staticmethod
+    def _compile(shader_type, src):
+        shader = glCreateShader(shader_type)
+
+        src_buf = create_string_buffer(src.encode())
+        src_ptr = cast(pointer(pointer(src_buf)), POINTER(POINTER(GLchar)))
+        glShaderSource(shader, 1, src_ptr, None)
+        glCompileShader(shader)
+
+        status = GLint(0)
+        glGetShaderiv(shader, GL_COMPILE_STATUS, byref(status))
+        if not status.value:
+            log = create_string_buffer(4096)
+            glGetShaderInfoLog(shader, len(log), None, log)
+            raise RuntimeError("failed to compile shader:\n" + log.value.decode())
+
+        return shader
+
+    def use(self):
+        glUseProgram(self.id)
+
+        for name, value in self.shared.items():
+            self.set_uniform(name, value)
+
+    @staticmethod
+    def unuse():
+        glUseProgram(0)
+
+    def location(self, name):
+        """
+        Get the location of a uniform variable
+        """
+
+        if name not in self.locations:
+            self.locations[name] = glGetUniformLocation(self.id, name.encode())
+
+        return self.locations[name]
+
+    def set_uniform(self, name, value):
+        """
+        Set a float, vector or 4x4 matrix uniform of the program in use
+        Uniforms not used by the program are ignored.
+        """
+
+        loc = self.location(name)
+        if loc < 0:
+            return
+
+        value = np.asarray(value, dtype=np.float32)
+
+        if value.shape == (4, 4):
+            data = (GLfloat * 16)(*value.flatten())
+            glUniformMatrix4fv(loc, 1, GL_TRUE, data)
+        elif value.size == 4:
+            glUniform4f(loc, *value)
+        elif value.size == 3:
+            glUniform3f(loc, *value)
+        else:
+            glUniform1f(loc, value)
+
+    def attrib_location(self, name):
+        """
+        Get the location of a vertex attribute
+        """
+
+        if name not in self.attribs:
+            self.attribs[name] = glGetAttribLocation(self.id, name.encode())
+
+        return self.attribs[name]
+
+
+class FrameBuffer:
+    """
+    Manage frame buffers for rendering
+    """
+
+    def __init__(
+        self,
+        width,
+        height,
+        num_samples=1,
+        num_pbos=2,
+        top_down=False,
+        float_depth=False,
+        seg=False,
+    ):
+        """
+        Create the frame buffer objects
+        With a single sample, images are rendered directly into the final
+        frame buffer, without a multisampled frame buffer to resolve.
+        In top-down mode, the projection is flipped vertically when
+        rendering, so that images are read back starting from the top row
+        and no flip copy is needed.
+        With float_depth, the depth buffers are 32-bit floating-point
+        instead of 16-bit integers, for precise depth maps.
+        With seg, the frame buffer has an unsigned integer segmentation
+        buffer, rendered into between begin_seg and end_seg.
+        """
+
+        assert num_samples > 0
+        assert num_samples <= 16
+        assert num_pbos > 0
+
+        self.width = width
+        self.height = height
+        self.top_down = top_down
+        self.float_depth = float_depth
+        self.seg = seg
+
+        depth_format = GL_DEPTH_COMPONENT32F if float_depth else GL_DEPTH_COMPONENT16
+
+        # OpenGL objects created, with the functions deleting them
+        self.gl_objects = []
+
+        # Create the frame buffer used to resolve the final render
+        self.final_fbo = self._gen_name(glGenFramebuffers, glDeleteFramebuffers)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.final_fbo)
+
+        # Create the texture used to resolve the final render
+        fbTex = self._gen_name(glGenTextures, glDeleteTextures)
+        glBindTexture(GL_TEXTURE_2D, fbTex)
+        glTexImage2D(
+            GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_FLOAT, None
+        )
+        glFramebufferTexture2D(
+            GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, fbTex, 0
+        )
+        self.final_tex = fbTex
+
+        # Create a depth buffer for the final frame buffer
+        depth_rb = self._gen_name(glGenRenderbuffers, glDeleteRenderbuffers)
+        glBindRenderbuffer(GL_RENDERBUFFER, depth_rb)
+        glRenderbufferStorage(GL_RENDERBUFFER, depth_format, width, height)
+        glFramebufferRenderbuffer(
+            GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth_rb
+        )
+
+        # Sanity check
+        res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
+
+        # With a single sample, render directly into the final frame buffer,
+        # so that no resolve blit is needed
+        if num_samples == 1:
+            self.multi_fbo = self.final_fbo
+            self.multi_depth_rb = depth_rb
+        else:
+            num_samples = self._create_multi_fbo(num_samples, depth_format)
+
+        # Number of samples of the multisampled frame buffer (None if
+        # multisampling is not supported)
+        self.num_samples = num_samples
+
+        # Create the frame buffers used to render segmentation maps
+        if seg:
+            self._create_seg_fbos(num_samples)
+
+        # Enable depth testing
+        glEnable(GL_DEPTH_TEST)
+
+        # Unbind the frame buffer
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+        # Array to render the image into (for observation rendering)
+        # The array is stored in column-major order
+        self.img_array = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+
+        # Arrays to read the depth buffer into, and to linearize it into
+        # These are only allocated on the first call to get_depth_map
+        self.depth_raw = None
+        self.depth_array = None
+
+        # Array to read the segmentation map into
+        self.seg_array = None
+
+        # Ring of pixel buffer objects for asynchronous readback
+        # These are only allocated on the first call to resolve_async
+        self.num_pbos = num_pbos
+        self.pbos = None
+        self.next_pbo = 0
+        self.pending = []
+
+    def _gen_name(self, gen_func, delete_func):
+        """
+        Create an OpenGL object name, deleted along with the frame buffer
+        """
+
+        name = GLuint(0)
+        gen_func(1, byref(name))
+        self.gl_objects.append((delete_func, name))
+
+        return name
+
+    def delete(self):
+        """
+        Free the frame buffers, their attachments and pixel buffers
+        """
+
+        for delete_func, name in self.gl_objects:
+            delete_func(1, byref(name))
+        self.gl_objects = []
+
+        if self.pbos is not None:
+            glDeleteBuffers(self.num_pbos, self.pbos)
+            self.pbos = None
+        self.pending = []
+
+    def _create_multi_fbo(self, num_samples, depth_format):
+        """
+        Create the multisampled frame buffer rendered into
+        Returns the number of samples used (None if multisampling is not
+        supported).
+        """
+
+        # Create a frame buffer (rendering target)
+        self.multi_fbo = self._gen_name(glGenFramebuffers, glDeleteFramebuffers)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.multi_fbo)
+
+        # The try block here is because some OpenGL drivers
+        # (Intel GPU drivers on MacBooks in particular) do not
+        # support multisampling on frame buffer objects
+        try:
+            # Ensure that the correct extension is supported
+            assert gl_info.have_extension("GL_EXT_framebuffer_multisample")
+
+            # Get the maximum number of samples supported
+            MAX_SAMPLES_EXT = 0x8D57
+            max_samples = GLint()
+            glGetIntegerv(MAX_SAMPLES_EXT, max_samples)
+            max_samples = max_samples.value
+
+            if num_samples > max_samples:
+                print(f"Falling back to num_samples={max_samples}")
+                num_samples = max_samples
+
+            # Create a multisampled texture to render into
+            fbTex = self._gen_name(glGenTextures, glDeleteTextures)
+            glBindTexture(GL_TEXTURE_2D_MULTISAMPLE, fbTex)
+            glTexImage2DMultisample(
+                GL_TEXTURE_2D_MULTISAMPLE,
+                num_samples,
+                GL_RGBA32F,
+                self.width,
+                self.height,
+                True,
+            )
+            glFramebufferTexture2D(
+                GL_FRAMEBUFFER,
+                GL_COLOR_ATTACHMENT0,
+                GL_TEXTURE_2D_MULTISAMPLE,
+                fbTex,
+                0,
+            )
+
+            # Attach a multisampled depth buffer to the FBO
+            depth_rb = self._gen_name(glGenRenderbuffers, glDeleteRenderbuffers)
+            glBindRenderbuffer(GL_RENDERBUFFER, depth_rb)
+            glRenderbufferStorageMultisample(
+                GL_RENDERBUFFER, num_samples, depth_format, self.width, self.height
+            )
+            glFramebufferRenderbuffer(
+                GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth_rb
+            )
+            self.multi_depth_rb = depth_rb
+
+            # Check that the frame buffer creation succeeded
+            res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+            assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
+
+        except Exception:
+            print("Falling back to non-multisampled frame buffer")
+
+            # Create a plain texture to render into
+            fbTex = self._gen_name(glGenTextures, glDeleteTextures)
+            glBindTexture(GL_TEXTURE_2D, fbTex)
+            glTexImage2D(
+                GL_TEXTURE_2D,
+                0,
+                GL_RGBA,
+                self.width,
+                self.height,
+                0,
+                GL_RGBA,
+                GL_FLOAT,
+                None,
+            )
+            glFramebufferTexture2D(
+                GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, fbTex, 0
+            )
+
+            # Attach depth buffer to FBO
+            depth_rb = self._gen_name(glGenRenderbuffers, glDeleteRenderbuffers)
+            glBindRenderbuffer(GL_RENDERBUFFER, depth_rb)
+            glRenderbufferStorage(
+                GL_RENDERBUFFER, depth_format, self.width, self.height
+            )
+            glFramebufferRenderbuffer(
+                GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth_rb
+            )
+            self.multi_depth_rb = depth_rb
+            num_samples = None
+
+        # Sanity check
+        res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
+
+        return num_samples
+
+    def _create_seg_fbos(self, num_samples=None):
+        """
+        Create the frame buffers holding the unsigned integer segmentation
+        buffer, and the one it is resolved into. The segmentation frame
+        buffer shares the depth buffer of the multisampled frame buffer.
+        Note: the segmentation buffer is not attached to the color frame
+              buffer because some drivers refuse fixed-function rendering
+              into a frame buffer with an integer attachment.
+        """
+
+        self.seg_fbo = self._gen_name(glGenFramebuffers, glDeleteFramebuffers)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.seg_fbo)
+
+        seg_rb = self._gen_name(glGenRenderbuffers, glDeleteRenderbuffers)
+        glBindRenderbuffer(GL_RENDERBUFFER, seg_rb)
+        if num_samples is None or num_samples == 1:
+            glRenderbufferStorage(GL_RENDERBUFFER, GL_R32UI, self.width, self.height)
+        else:
+            glRenderbufferStorageMultisample(
+                GL_RENDERBUFFER, num_samples, GL_R32UI, self.width, self.height
+            )
+        glFramebufferRenderbuffer(
+            GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, seg_rb
+        )
+        glFramebufferRenderbuffer(
+            GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.multi_depth_rb
+        )
+
+        res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
+
+        self.final_seg_fbo = self._gen_name(glGenFramebuffers, glDeleteFramebuffers)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.final_seg_fbo)
+
+        seg_rb = self._gen_name(glGenRenderbuffers, glDeleteRenderbuffers)
+        glBindRenderbuffer(GL_RENDERBUFFER, seg_rb)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_R32UI, self.width, self.height)
+        glFramebufferRenderbuffer(
+            GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, seg_rb
+        )
+
+        res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
+
+    def bind(self):
+        """
+        Bind the frame buffer before rendering into it
+        """
+
+        # Bind the multisampled frame buffer
+        glEnable(GL_MULTISAMPLE)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.multi_fbo)
+        glViewport(0, 0, self.width, self.height)
+
+        # Flipping the projection also flips the winding of polygons
+        glFrontFace(GL_CW if self.top_down else GL_CCW)
+
+    @property
+    def aspect(self):
+        """
+        Aspect ratio of the images rendered into this frame buffer
+        """
+
+        return self.width / float(self.height)
+
+    @property
+    def out_shape(self):
+        """
+        Shape of the image arrays produced by this frame buffer
+        """
+
+        return (self.height, self.width, 3)
+
+    def load_projection(self, proj):
+        """
+        Load a projection matrix and return the matrix loaded
+        In top-down mode, the projection is flipped vertically.
+        """
+
+        if self.top_down:
+            proj = np.diag([1, -1, 1, 1]) @ proj
+
+        glMatrixMode(GL_PROJECTION)
+        load_matrix(proj)
+
+        return proj
+
+    def copy_from(self, other):
+        """
+        Copy the color and depth contents of another frame buffer of the
+        same size and format, before rendering more on top of them
+        The frame buffer is left bound.
+        """
+
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, other.multi_fbo)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.multi_fbo)
+        glBlitFramebuffer(
+            0,
+            0,
+            self.width,
+            self.height,
+            0,
+            0,
+            self.width,
+            self.height,
+            GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT,
+            GL_NEAREST,
+        )
+
+        glBindFramebuffer(GL_FRAMEBUFFER, self.multi_fbo)
+
+    def _blit(self):
+        """
+        Resolve the multisampled frame buffer into the final frame buffer
+        Frame buffers with a single sample are rendered into directly.
+        """
+
+        if self.multi_fbo is self.final_fbo:
+            return
+
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.multi_fbo)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.final_fbo)
         glBlitFramebuffer(
             0,
             0,
@@ -361,7 +1348,229 @@ class FrameBuffer:
             GL_LINEAR,
         )
 
-        # Resolve the depth component as well
+        # Resolve the depth component as well
+        glBlitFramebuffer(
+            0,
+            0,
+            self.width,
+            self.height,
+            0,
+            0,
+            self.width,
+            self.height,
+            GL_DEPTH_BUFFER_BIT,
+            GL_NEAREST,
+        )
+
+    def resolve_texture(self):
+        """
+        Resolve the rendered image into the texture of the final frame
+        buffer, with mipmaps, so that it can be drawn at a smaller scale
+        Returns the texture id.
+        """
+
+        self._blit()
+
+        glBindTexture(GL_TEXTURE_2D, self.final_tex)
+        glGenerateMipmap(GL_TEXTURE_2D)
+
+        # Trilinear texture filtering
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+        return self.final_tex
+
+    def _output(self, img_array, out):
+        """
+        Produce the output image from the array read back from OpenGL
+        """
+
+        # Flip the image because OpenGL maps (0,0) to the lower-left corner
+        # Note: this is necessary for gym.wrappers.Monitor to record videos
+        # properly, otherwise they are vertically inverted.
+        # Note: the flipped view is not contiguous, so producing the image
+        # copies the data. Use top-down mode to avoid this copy.
+        img = img_array if self.top_down else np.flip(img_array, axis=0)
+
+        if out is None:
+            return np.ascontiguousarray(img)
+
+        np.copyto(out, img)
+        return out
+
+    def _direct_target(self, out):
+        """
+        Get the array to read pixels into directly, when the readback
+        needs no reordering. Returns None if a copy is needed.
+        """
+
+        if not self.top_down:
+            return None
+
+        if out is None:
+            return np.empty(self.out_shape, dtype=np.uint8)
+
+        return out
+
+    def _readback(self, read, out):
+        """
+        Read pixels with the given function and produce the output image
+        The pixels go straight into the output array when possible.
+        """
+
+        if out is not None:
+            assert out.dtype == np.uint8
+            assert out.flags.c_contiguous
+            assert out.shape == self.out_shape
+
+        target = self._direct_target(out)
+
+        if target is not None:
+            read(target)
+            return target
+
+        read(self.img_array)
+
+        return self._output(self.img_array, out)
+
+    def resolve(self, out=None):
+        """
+        Produce a numpy image array from the rendered image
+        The image is written into out if provided.
+        """
+
+        self._blit()
+
+        def read(array):
+            # Copy the frame buffer contents into a numpy array
+            # Note: glReadPixels reads starting from the lower left corner
+            glBindFramebuffer(GL_FRAMEBUFFER, self.final_fbo)
+            glPixelStorei(GL_PACK_ALIGNMENT, 1)
+            glReadPixels(
+                0,
+                0,
+                self.width,
+                self.height,
+                GL_RGB,
+                GL_UNSIGNED_BYTE,
+                array.ctypes.data_as(POINTER(GLubyte)),
+            )
+
+            # Unbind the frame buffer
+            glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+        return self._readback(read, out)
+
+    def resolve_async(self, out=None):
+        """
+        Start an asynchronous readback of the rendered image into a ring
+        of pixel buffer objects, without waiting for rendering to finish.
+        Once the ring is full, the oldest pending frame is collected and
+        returned (frame t-1 for a ring of two buffers), otherwise None.
+        """
+
+        if self.pbos is None:
+            self.pbos = (GLuint * self.num_pbos)()
+            glGenBuffers(self.num_pbos, self.pbos)
+            for pbo in self.pbos:
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+                glBufferData(
+                    GL_PIXEL_PACK_BUFFER, self.img_array.nbytes, None, GL_STREAM_READ
+                )
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        self._blit()
+
+        # Start copying the frame buffer contents into the next buffer
+        # With a pixel pack buffer bound, glReadPixels returns immediately
+        pbo = self.pbos[self.next_pbo]
+        self.next_pbo = (self.next_pbo + 1) % self.num_pbos
+        self.pending.append(pbo)
+
+        glBindFramebuffer(GL_FRAMEBUFFER, self.final_fbo)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(0, 0, self.width, self.height, GL_RGB, GL_UNSIGNED_BYTE, 0)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+        if len(self.pending) == self.num_pbos:
+            return self.collect(out)
+
+        return None
+
+    def collect(self, out=None):
+        """
+        Produce a numpy image array from the oldest pending asynchronous
+        readback, waiting for it to complete if necessary.
+        Returns None if no readback is pending.
+        """
+
+        if len(self.pending) == 0:
+            return None
+
+        pbo = self.pending.pop(0)
+
+        def read(array):
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glGetBufferSubData(
+                GL_PIXEL_PACK_BUFFER,
+                0,
+                array.nbytes,
+                array.ctypes.data_as(POINTER(GLubyte)),
+            )
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        return self._readback(read, out)
+
+    @property
+    def num_pending(self):
+        """
+        Number of asynchronous readbacks not collected yet
+        """
+
+        return len(self.pending)
+
+    def begin_seg(self):
+        """
+        Start rendering into the segmentation buffer instead of the color
+        buffer. The segmentation and depth buffers are cleared, so that
+        the scene is drawn again with segmentation IDs (background is 0).
+        """
+
+        assert self.seg, "frame buffer created without a segmentation buffer"
+
+        glBindFramebuffer(GL_FRAMEBUFFER, self.seg_fbo)
+        glClearBufferuiv(GL_COLOR, 0, (GLuint * 4)(0, 0, 0, 0))
+        glClear(GL_DEPTH_BUFFER_BIT)
+
+    def end_seg(self):
+        """
+        Go back to rendering into the color buffer
+        """
+
+        glBindFramebuffer(GL_FRAMEBUFFER, self.multi_fbo)
+
+    def resolve_seg(self, out=None):
+        """
+        Produce a segmentation map from the segmentation buffer
+        The map is a uint32 array of shape (H,W), written into out
+        if provided.
+        """
+
+        assert self.seg, "frame buffer created without a segmentation buffer"
+
+        if out is not None:
+            assert out.dtype == np.uint32
+            assert out.flags.c_contiguous
+            assert out.shape == (self.height, self.width)
+
+        # Resolve the multisampled segmentation buffer
+        # Integer buffers are resolved by picking one of the samples
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.seg_fbo)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.final_seg_fbo)
         glBlitFramebuffer(
             0,
             0,
@@ -371,72 +1580,793 @@ class FrameBuffer:
             0,
             self.width,
             self.height,
-            GL_DEPTH_BUFFER_BIT,
+            GL_COLOR_BUFFER_BIT,
             GL_NEAREST,
         )
 
-        # Copy the frame buffer contents into a numpy array
-        # Note: glReadPixels reads starting from the lower left corner
-        glBindFramebuffer(GL_FRAMEBUFFER, self.final_fbo)
+        if self.top_down:
+            target = out if out is not None else np.empty(self.out_shape[:2], np.uint32)
+        else:
+            if self.seg_array is None:
+                self.seg_array = np.zeros(self.out_shape[:2], dtype=np.uint32)
+            target = self.seg_array
+
+        glBindFramebuffer(GL_FRAMEBUFFER, self.final_seg_fbo)
         glPixelStorei(GL_PACK_ALIGNMENT, 1)
         glReadPixels(
             0,
             0,
             self.width,
             self.height,
-            GL_RGB,
-            GL_UNSIGNED_BYTE,
-            self.img_array.ctypes.data_as(POINTER(GLubyte)),
+            GL_RED_INTEGER,
+            GL_UNSIGNED_INT,
+            target.ctypes.data_as(POINTER(GLuint)),
         )
-
-        # Unbind the frame buffer
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
 
-        # Flip the image because OpenGL maps (0,0) to the lower-left corner
-        # Note: this is necessary for gym.wrappers.Monitor to record videos
-        # properly, otherwise they are vertically inverted.
-        # Note: ascontiguousarray operates in constant time because it
-        # does not copy the data
-        img = np.ascontiguousarray(np.flip(self.img_array, axis=0))
+        if self.top_down:
+            return target
 
-        return img
+        seg = np.flip(self.seg_array, axis=0)
 
-    def get_depth_map(self, z_near=0.04, z_far=1.0):
+        if out is None:
+            return np.ascontiguousarray(seg)
+
+        np.copyto(out, seg)
+        return out
+
+    def get_depth_map(self, z_near=0.04, z_far=1.0, out=None):
         """
         Read the depth buffer into a depth map
         The values returned are real-world z-distance from the observer
+        The depth map is written into out if provided, as a float32
+        array of shape (H,W,1).
         """
 
-        depth_map = np.zeros(shape=(self.height, self.width, 1), dtype=np.uint16)
+        if out is not None:
+            assert out.dtype == np.float32
+            assert out.flags.c_contiguous
+            assert out.shape == (self.height, self.width, 1)
+
+        if self.depth_array is None:
+            self.depth_array = np.zeros((self.height, self.width, 1), dtype=np.float32)
+            if not self.float_depth:
+                self.depth_raw = np.zeros(self.depth_array.shape, dtype=np.uint16)
+
+        # Linearize directly in the output array when no flip is needed
+        depth_map = self.depth_array
+        if self.top_down:
+            depth_map = out if out is not None else np.empty_like(self.depth_array)
+
+        raw = depth_map if self.float_depth else self.depth_raw
 
         glBindFramebuffer(GL_FRAMEBUFFER, self.final_fbo)
         glPixelStorei(GL_PACK_ALIGNMENT, 1)
-        glReadPixels(
-            0,
-            0,
-            self.width,
-            self.height,
-            GL_DEPTH_COMPONENT,
-            GL_UNSIGNED_SHORT,
-            depth_map.ctypes.data_as(POINTER(GLushort)),
-        )
+        if self.float_depth:
+            data = raw.ctypes.data_as(POINTER(GLfloat))
+            glReadPixels(
+                0, 0, self.width, self.height, GL_DEPTH_COMPONENT, GL_FLOAT, data
+            )
+        else:
+            data = raw.ctypes.data_as(POINTER(GLushort))
+            glReadPixels(
+                0,
+                0,
+                self.width,
+                self.height,
+                GL_DEPTH_COMPONENT,
+                GL_UNSIGNED_SHORT,
+                data,
+            )
 
         # Unbind the frame buffer
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
 
+        # Transform into floating-point values in [0, 1]
+        if not self.float_depth:
+            np.multiply(raw, 1 / 65535, out=depth_map)
+
+        # Convert to real-world z-distances, in place
+        # z = 2fn / ((f + n) - clip_z (f - n)) where clip_z = 2 depth - 1
+        np.multiply(depth_map, -(z_far - z_near), out=depth_map)
+        np.add(depth_map, z_far, out=depth_map)
+        np.divide(z_far * z_near, depth_map, out=depth_map)
+
+        if self.top_down:
+            return depth_map
+
         # Flip the depth map vertically to map OpenAI gym conventions
         depth_map = np.flip(depth_map, axis=0)
 
-        # Transform into floating-point values
-        depth_map = depth_map.astype(np.float32) / 65535
+        if out is None:
+            return np.ascontiguousarray(depth_map)
+
+        np.copyto(out, depth_map)
+        return out
+
+
+class TiledFrameBuffer(FrameBuffer):
+    """
+    Frame buffer split into a grid of equally-sized tiles (viewports).
+    Used to render many small images and read them all back with a
+    single glReadPixels call.
+    """
+
+    def __init__(
+        self,
+        tile_width,
+        tile_height,
+        num_tiles,
+        num_samples=1,
+        num_pbos=2,
+        top_down=False,
+    ):
+        assert num_tiles > 0
+
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.num_tiles = num_tiles
+
+        max_size = GLint()
+        glGetIntegerv(GL_MAX_TEXTURE_SIZE, max_size)
+
+        if top_down and num_tiles * tile_height <= max_size.value:
+            # Stack the tiles in a single column, so that the top-down
+            # readback is already laid out as an (N, H, W, 3) array
+            self.num_cols = 1
+        else:
+            # Lay the tiles out on a near-square grid
+            self.num_cols = math.ceil(math.sqrt(num_tiles))
+        self.num_rows = math.ceil(num_tiles / self.num_cols)
+
+        super().__init__(
+            self.num_cols * tile_width,
+            self.num_rows * tile_height,
+            num_samples,
+            num_pbos,
+            top_down,
+        )
+
+    @property
+    def aspect(self):
+        return self.tile_width / float(self.tile_height)
+
+    @property
+    def out_shape(self):
+        return (self.num_tiles, self.tile_height, self.tile_width, 3)
+
+    def bind(self):
+        """
+        Bind the whole frame buffer
+        """
+
+        glDisable(GL_SCISSOR_TEST)
+        super().bind()
+
+    def bind_tile(self, idx):
+        """
+        Restrict rendering (and clearing) to a single tile
+        Tiles are numbered in row-major order, starting from the top-left
+        """
+
+        assert 0 <= idx < self.num_tiles
+
+        row, col = divmod(idx, self.num_cols)
+        x = col * self.tile_width
+        # OpenGL maps (0,0) to the lower-left corner, which is
+        # the first row read back in top-down mode
+        if self.top_down:
+            y = row * self.tile_height
+        else:
+            y = (self.num_rows - 1 - row) * self.tile_height
+
+        glViewport(x, y, self.tile_width, self.tile_height)
+        glScissor(x, y, self.tile_width, self.tile_height)
+        glEnable(GL_SCISSOR_TEST)
+
+    def _blit(self):
+        # The scissor test also applies to the resolve blit
+        glDisable(GL_SCISSOR_TEST)
+
+        super()._blit()
+
+    def _direct_target(self, out):
+        if not self.top_down or self.num_cols != 1:
+            return None
+
+        if out is None:
+            return np.empty(self.out_shape, dtype=np.uint8)
+
+        return out
+
+    def _output(self, img_array, out):
+        """
+        Produce a numpy array of shape (num_tiles, H, W, 3) from the tiles
+        """
+
+        img = img_array if self.top_down else np.flip(img_array, axis=0)
+
+        tiles = img.reshape(
+            self.num_rows, self.tile_height, self.num_cols, self.tile_width, 3
+        )
+        tiles = tiles.transpose(0, 2, 1, 3, 4).reshape(
+            -1, self.tile_height, self.tile_width, 3
+        )
+        tiles = tiles[: self.num_tiles]
+
+        if out is None:
+            return np.ascontiguousarray(tiles)
+
+        np.copyto(out, tiles)
+        return out
+
+
+class StaticGeometry:
+    """
+    Static scene geometry stored in a vertex buffer object.
+    Triangles are grouped by texture so that the whole batch can be
+    drawn with one draw call per texture instead of one GL call per vertex.
+
+    With texture_arrays enabled, the textures are packed into array
+    textures and the layer index is appended to the texture coordinates,
+    so that there is one draw call per texture size instead.
+    With shaders enabled, textured geometry is drawn with GLSL programs
+    (always the case with texture arrays).
+    """
+
+    # Interleaved vertex layout: position (3), normal (3), texcoord (2)
+    VERTEX_SIZE = 8
+
+    def __init__(self, texture_arrays=False, shaders=False, resources=None):
+        self.texture_arrays = texture_arrays
+        self.shaders = shaders
+
+        # Resource manager owning the texture arrays
+        assert resources is not None or not texture_arrays
+        self.resources = resources
+
+        # Vertex arrays waiting to be uploaded, indexed by texture
+        self.groups = {}
+
+        # Vertex buffer object and draw ranges, one per texture
+        # (or one per texture array)
+        self.vbo = None
+        self.ranges = []
+
+        # Draw ranges with their segmentation IDs
+        self.seg_ranges = []
+
+        # Segmentation IDs and draw ranges making up each texture range,
+        # used to draw only the visible objects
+        self.range_parts = []
+
+        # Total number of vertices uploaded
+        self.num_verts = 0
+
+    def add_triangles(self, tex, verts, norms, texcs, seg_id=0):
+        """
+        Add a list of triangles drawn with a given texture
+        The arrays have shapes (N*3, 3), (N*3, 3) and (N*3, 2)
+        The segmentation ID identifies the object the triangles belong to.
+        """
+
+        assert self.vbo is None, "cannot add geometry after upload"
+
+        if len(verts) == 0:
+            return
+
+        data = np.concatenate([verts, norms, texcs], axis=1).astype(np.float32)
+        self.groups.setdefault(tex, []).append((data, seg_id))
+
+    def add_polygon(self, tex, verts, normal, texcs, seg_id=0):
+        """
+        Add a convex polygon, triangulated as a fan around its first vertex
+        """
+
+        num_verts = verts.shape[0]
+        if num_verts < 3:
+            return
+
+        idx = np.arange(1, num_verts - 1)
+        tris = np.stack([np.zeros_like(idx), idx, idx + 1], axis=1).reshape(-1)
+        norms = np.broadcast_to(normal, (tris.shape[0], 3))
+
+        self.add_triangles(tex, verts[tris], norms, texcs[tris], seg_id)
+
+    def add_quads(self, tex, verts, norms, texcs, seg_id=0):
+        """
+        Add a list of quads, with vertices listed in counter-clockwise order
+        """
+
+        num_quads = verts.shape[0] // 4
+        if num_quads == 0:
+            return
+
+        base = 4 * np.arange(num_quads)[:, None]
+        tris = (base + np.array([0, 1, 2, 0, 2, 3])).reshape(-1)
+
+        self.add_triangles(tex, verts[tris], norms[tris], texcs[tris], seg_id)
+
+    def upload(self):
+        """
+        Upload the accumulated geometry into a vertex buffer object
+        """
+
+        assert self.vbo is None
+
+        groups = self.groups
+        if self.texture_arrays:
+            groups = self._pack_groups(groups)
+
+        arrays = []
+        first = 0
+        for tex, group in groups.items():
+            self.ranges.append((tex, first, sum(d.shape[0] for d, _ in group)))
+            self.range_parts.append([])
+            for data, seg_id in group:
+                arrays.append(data)
+                self.seg_ranges.append((seg_id, first, data.shape[0]))
+                self.range_parts[-1].append((seg_id, first, data.shape[0]))
+                first += data.shape[0]
+
+        self.groups = {}
+        self.num_verts = first
+
+        if self.num_verts == 0:
+            return
+
+        data = np.ascontiguousarray(np.concatenate(arrays), dtype=np.float32)
+
+        self.vbo = GLuint(0)
+        glGenBuffers(1, byref(self.vbo))
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, data.nbytes, data.ctypes.data, GL_STATIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def _pack_groups(self, groups):
+        """
+        Regroup the vertex arrays by texture array, remapping the
+        texture coordinates to (u, v, layer)
+        """
+
+        packed = TextureArray.pack(groups.keys(), self.resources)
+
+        array_groups = {}
+        for tex, group in groups.items():
+            array, layer = packed[tex]
+            for data, seg_id in group:
+                layers = np.full((data.shape[0], 1), layer, dtype=np.float32)
+                data = np.concatenate([data, layers], axis=1)
+                array_groups.setdefault(array, []).append((data, seg_id))
+
+        return array_groups
+
+    @property
+    def vertex_size(self):
+        return self.VERTEX_SIZE + (1 if self.texture_arrays else 0)
+
+    def render(self, textured=True, visible=None):
+        """
+        Draw the geometry, one draw call per texture
+        If a set of segmentation IDs is given as visible, only the
+        geometry with these IDs is drawn.
+        """
+
+        if self.vbo is None:
+            return
+
+        # The fixed-function pipeline cannot sample array textures
+        shader = None
+        if textured and self.texture_arrays:
+            shader = ShaderProgram.get("static_tex_array")
+        elif textured and self.shaders:
+            shader = ShaderProgram.get("static")
+        elif textured:
+            glEnable(GL_TEXTURE_2D)
+
+        if shader is not None:
+            shader.use()
+            glUniform1i(shader.location("tex"), 0)
+
+        layout = [("position", 3, 0), ("normal", 3, 3)]
+        if textured:
+            layout.append(("texcoord", self.vertex_size - 6, 6))
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        enable_arrays(layout, self.vertex_size * 4, shader)
+
+        for (tex, first, count), parts in zip(self.ranges, self.range_parts):
+            if visible is None:
+                if textured:
+                    tex.bind()
+                glDrawArrays(GL_TRIANGLES, first, count)
+                continue
+
+            firsts, counts = self._visible_parts(parts, visible)
+            if len(firsts) == 0:
+                continue
+
+            if textured:
+                tex.bind()
+            glMultiDrawArrays(
+                GL_TRIANGLES,
+                (GLint * len(firsts))(*firsts),
+                (GLsizei * len(counts))(*counts),
+                len(firsts),
+            )
+
+        disable_arrays(layout, shader)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        if shader is not None:
+            glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+            glBindTexture(GL_TEXTURE_2D, 0)
+            ShaderProgram.unuse()
+        elif textured:
+            glDisable(GL_TEXTURE_2D)
+
+    @staticmethod
+    def _visible_parts(parts, visible):
+        """
+        Get the draw ranges of the visible parts of a texture range,
+        merging adjacent ranges
+        """
+
+        firsts = []
+        counts = []
+
+        for seg_id, first, count in parts:
+            if seg_id not in visible:
+                continue
+            if len(firsts) > 0 and firsts[-1] + counts[-1] == first:
+                counts[-1] += count
+            else:
+                firsts.append(first)
+                counts.append(count)
+
+        return firsts, counts
+
+    def render_seg(self, shader):
+        """
+        Draw the geometry with a segmentation shader program, setting the
+        segmentation ID of each draw range
+        """
+
+        if self.vbo is None:
+            return
+
+        layout = [("position", 3, 0)]
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        enable_arrays(layout, self.vertex_size * 4)
+
+        for seg_id, first, count in self.seg_ranges:
+            glUniform1ui(shader.location("seg_id"), seg_id)
+            glDrawArrays(GL_TRIANGLES, first, count)
+
+        disable_arrays(layout)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def delete(self):
+        """
+        Free the vertex buffer object
+        """
+
+        if self.vbo is not None:
+            glDeleteBuffers(1, byref(self.vbo))
+            self.vbo = None
+
+        self.ranges = []
+        self.seg_ranges = []
+        self.range_parts = []
+        self.num_verts = 0
+
+
+class InstancedGeometry:
+    """
+    Geometry shared by several entities, drawn with one instanced draw
+    call per chunk. Each instance has its own position, rotation, scale
+    and color, kept in a vertex buffer which is only refreshed when the
+    instances change.
+    The geometry may be indexed, with the chunks being ranges of the
+    index buffer, and it can also be drawn once with the fixed-function
+    pipeline (see render_fixed).
+    """
+
+    # Interleaved vertex layout: position (3), normal (3), texcoord (2), color (3)
+    VERTEX_SIZE = 11
+    LAYOUT = [("position", 3, 0), ("normal", 3, 3), ("texcoord", 2, 6), ("color", 3, 8)]
+
+    # Interleaved instance layout: position and rotation angle (4),
+    # scale and normal scale (4), color (3)
+    INSTANCE_SIZE = 11
+
+    @staticmethod
+    def unit_box():
+        """
+        Create the geometry of a white box of size 1, with its base at y=0
+        """
+
+        # Corners of each face, in counter-clockwise order, and face normals
+        faces = [
+            ([(1, 1, 1), (0, 1, 1), (0, 0, 1), (1, 0, 1)], (0, 0, 1)),
+            ([(0, 1, 0), (1, 1, 0), (1, 0, 0), (0, 0, 0)], (0, 0, -1)),
+            ([(0, 1, 1), (0, 1, 0), (0, 0, 0), (0, 0, 1)], (-1, 0, 0)),
+            ([(1, 1, 0), (1, 1, 1), (1, 0, 1), (1, 0, 0)], (1, 0, 0)),
+            ([(1, 1, 1), (1, 1, 0), (0, 1, 0), (0, 1, 1)], (0, 1, 0)),
+            ([(1, 0, 0), (1, 0, 1), (0, 0, 1), (0, 0, 0)], (0, -1, 0)),
+        ]
+
+        tris = [0, 1, 2, 0, 2, 3]
+        verts = np.array([[face[i] for i in tris] for face, _ in faces], np.float32)
+        verts = verts.reshape(-1, 3) - np.array([0.5, 0, 0.5], dtype=np.float32)
+        norms = np.repeat(np.array([n for _, n in faces], np.float32), 6, axis=0)
+        texcs = np.zeros(shape=(verts.shape[0], 2), dtype=np.float32)
+        colors = np.ones(shape=(verts.shape[0], 3), dtype=np.float32)
+
+        return InstancedGeometry(verts, norms, texcs, colors, [(None, 0, 36)])
+
+    def __init__(self, verts, norms, texcs, colors, chunks, indices=None):
+        """
+        The chunks are a list of (texture, first vertex, vertex count)
+        where the texture may be None. With indices, the chunks are
+        ranges of the indices instead of the vertices.
+        """
+
+        self.data = np.concatenate([verts, norms, texcs, colors], axis=1)
+        self.data = np.ascontiguousarray(self.data, dtype=np.float32)
+        self.chunks = chunks
 
-        # Convert to real-world z-distances
-        clip_z = (depth_map - 0.5) * 2.0
-        world_z = -2 * z_far * z_near / (clip_z * (z_far - z_near) - (z_far + z_near))
+        self.indices = None
+        if indices is not None:
+            self.indices = np.ascontiguousarray(indices, dtype=np.uint32)
 
-        depth_map = np.ascontiguousarray(world_z)
+        # The vertex and index buffers are created on first use
+        self.vbo = None
+        self.ibo = None
+        self.instance_vbo = None
+        self.seg_vbo = None
+
+        # Instance parameters last uploaded
+        self.instances = None
+
+    def set_instances(self, instances):
+        """
+        Set the parameters of each instance, as an (N, INSTANCE_SIZE) array
+        """
+
+        instances = np.ascontiguousarray(instances, dtype=np.float32)
+        assert instances.shape[1] == self.INSTANCE_SIZE
+
+        if self.instances is not None and np.array_equal(instances, self.instances):
+            return
+
+        self.instances = instances
+
+        if self.instance_vbo is None:
+            self.instance_vbo = GLuint(0)
+            glGenBuffers(1, byref(self.instance_vbo))
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_vbo)
+        glBufferData(
+            GL_ARRAY_BUFFER, instances.nbytes, instances.ctypes.data, GL_DYNAMIC_DRAW
+        )
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def render(self):
+        """
+        Draw all the instances
+        """
+
+        if self.instances is None or self.instances.shape[0] == 0:
+            return
+
+        shader = ShaderProgram.get("instanced")
+        shader.use()
+        glUniform1i(shader.location("tex"), 0)
+
+        self._bind_buffers(shader)
+
+        # Per-instance attributes, advanced once per instance
+        inst_layout = [("inst_pos", 4, 0), ("inst_scale", 4, 4), ("inst_color", 3, 8)]
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_vbo)
+        enable_arrays(inst_layout, self.INSTANCE_SIZE * 4, shader, divisor=1)
+
+        num_instances = self.instances.shape[0]
+        for tex, first, count in self.chunks:
+            if tex:
+                tex.bind()
+            glUniform1i(shader.location("use_tex"), 1 if tex else 0)
+            if self.indices is not None:
+                glDrawElementsInstanced(
+                    GL_TRIANGLES, count, GL_UNSIGNED_INT, first * 4, num_instances
+                )
+            else:
+                glDrawArraysInstanced(GL_TRIANGLES, first, count, num_instances)
+
+        disable_arrays(inst_layout, shader)
+        self._unbind_buffers(shader)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        ShaderProgram.unuse()
+
+    def render_seg(self, instances, seg_ids):
+        """
+        Draw instances with their segmentation IDs, without lighting or
+        textures. The instances are given as for set_instances, and kept
+        in their own vertex buffer, along with the IDs, so that the
+        instances last drawn by render are left as they are.
+        """
+
+        instances = np.asarray(instances, dtype=np.float32)
+        seg_ids = np.asarray(seg_ids, dtype=np.float32)
+        data = np.ascontiguousarray(np.column_stack([instances, seg_ids]))
+
+        if self.seg_vbo is None:
+            self.seg_vbo = GLuint(0)
+            glGenBuffers(1, byref(self.seg_vbo))
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.seg_vbo)
+        glBufferData(GL_ARRAY_BUFFER, data.nbytes, data.ctypes.data, GL_DYNAMIC_DRAW)
+
+        shader = ShaderProgram.get("seg_instanced")
+        shader.use()
+
+        self._bind_buffers(shader)
+
+        inst_layout = [("inst_pos", 4, 0), ("inst_scale", 4, 4), ("inst_seg_id", 1, 11)]
+        glBindBuffer(GL_ARRAY_BUFFER, self.seg_vbo)
+        enable_arrays(inst_layout, data.shape[1] * 4, shader, divisor=1)
+
+        num_instances = data.shape[0]
+        for _, first, count in self.chunks:
+            if self.indices is not None:
+                glDrawElementsInstanced(
+                    GL_TRIANGLES, count, GL_UNSIGNED_INT, first * 4, num_instances
+                )
+            else:
+                glDrawArraysInstanced(GL_TRIANGLES, first, count, num_instances)
+
+        disable_arrays(inst_layout, shader)
+        self._unbind_buffers(shader)
+        ShaderProgram.unuse()
+
+    def render_fixed(self):
+        """
+        Draw the geometry once, at the current transform, with the
+        fixed-function pipeline
+        """
+
+        self._bind_buffers()
+
+        for tex, first, count in self.chunks:
+            if tex:
+                glEnable(GL_TEXTURE_2D)
+                tex.bind()
+            else:
+                glDisable(GL_TEXTURE_2D)
+
+            if self.indices is not None:
+                glDrawElements(GL_TRIANGLES, count, GL_UNSIGNED_INT, first * 4)
+            else:
+                glDrawArrays(GL_TRIANGLES, first, count)
+
+        self._unbind_buffers()
+        glDisable(GL_TEXTURE_2D)
+
+    def _bind_buffers(self, shader=None):
+        """
+        Bind the vertex and index buffers, uploading them on first use,
+        and enable the vertex arrays
+        """
+
+        if self.vbo is None:
+            self.vbo = GLuint(0)
+            glGenBuffers(1, byref(self.vbo))
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+            glBufferData(
+                GL_ARRAY_BUFFER,
+                self.data.nbytes,
+                self.data.ctypes.data,
+                GL_STATIC_DRAW,
+            )
+
+        if self.ibo is None and self.indices is not None:
+            self.ibo = GLuint(0)
+            glGenBuffers(1, byref(self.ibo))
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+            glBufferData(
+                GL_ELEMENT_ARRAY_BUFFER,
+                self.indices.nbytes,
+                self.indices.ctypes.data,
+                GL_STATIC_DRAW,
+            )
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        enable_arrays(self.LAYOUT, self.VERTEX_SIZE * 4, shader)
+
+        if self.ibo is not None:
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+
+    def _unbind_buffers(self, shader=None):
+        disable_arrays(self.LAYOUT, shader)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+    def delete(self):
+        """
+        Free the vertex, index and instance buffers
+        They are uploaded again if the geometry is drawn afterwards.
+        """
+
+        for name in ["vbo", "ibo", "instance_vbo", "seg_vbo"]:
+            buffer = getattr(self, name)
+            if buffer is not None:
+                glDeleteBuffers(1, byref(buffer))
+                setattr(self, name, None)
+
+        self.instances = None
+
+
+# Fixed-function client arrays, indexed by vertex attribute name
+CLIENT_ARRAYS = {
+    "position": GL_VERTEX_ARRAY,
+    "normal": GL_NORMAL_ARRAY,
+    "texcoord": GL_TEXTURE_COORD_ARRAY,
+    "color": GL_COLOR_ARRAY,
+}
+
+
+def enable_arrays(layout, stride, shader=None, divisor=0):
+    """
+    Enable interleaved vertex arrays read from the bound vertex buffer
+    The layout is a list of (attribute name, size, offset in floats).
+    With a shader, the arrays feed the vertex attributes of the same name,
+    otherwise they feed the fixed-function arrays.
+    """
+
+    for name, size, offset in layout:
+        if shader is not None:
+            loc = shader.attrib_location(name)
+            if loc < 0:
+                continue
+            glEnableVertexAttribArray(loc)
+            glVertexAttribPointer(loc, size, GL_FLOAT, GL_FALSE, stride, offset * 4)
+            glVertexAttribDivisor(loc, divisor)
+            continue
+
+        glEnableClientState(CLIENT_ARRAYS[name])
+        if name == "position":
+            glVertexPointer(size, GL_FLOAT, stride, offset * 4)
+        elif name == "normal":
+            glNormalPointer(GL_FLOAT, stride, offset * 4)
+        elif name == "texcoord":
+            glTexCoordPointer(size, GL_FLOAT, stride, offset * 4)
+        elif name == "color":
+            glColorPointer(size, GL_FLOAT, stride, offset * 4)
+
+
+def disable_arrays(layout, shader=None):
+    """
+    Disable vertex arrays enabled with enable_arrays
+    """
+
+    for name, _, _ in layout:
+        if shader is not None:
+            loc = shader.attrib_location(name)
+            if loc < 0:
+                continue
+            glVertexAttribDivisor(loc, 0)
+            glDisableVertexAttribArray(loc)
+            continue
+
+        glDisableClientState(CLIENT_ARRAYS[name])
+
+
+def load_matrix(m):
+    """
+    Load a 4x4 matrix, given as a numpy array, into the current matrix
+    """
 
-        return depth_map
+    glLoadMatrixd((GLdouble * 16)(*m.T.flatten()))
 
 
 def drawAxes(len=0.1):
@@ -0,0 +1,25 @@
+"""
+Module preloaded by the forkserver of MiniWorldAsyncVectorEnv (see
+miniworld/vector.py), so that the workers forked from it start with
+miniworld imported, the textures indexed and the texture cache mapped
+(see miniworld/texcache.py), instead of each worker doing it again.
+OpenGL objects can't be inherited by forked processes, so the textures
+and meshes are still uploaded by each worker, from the shared texture
+cache and the mesh cache (see MESH_CACHE_DIR).
+"""
+
+import glob
+import os
+
+import miniworld  # noqa: F401
+from miniworld import texcache
+from miniworld.opengl import Texture
+from miniworld.texcache import TextureCache
+
+Texture.index_textures()
+
+# The maximum texture size is chosen by each environment, so all the
+# caches built are mapped
+for path in glob.glob(os.path.join(texcache.CACHE_DIR, "texcache_*.json")):
+    name = os.path.basename(path)[len("texcache_") : -len(".json")]
+    TextureCache.open(None if name == "full" else int(name))
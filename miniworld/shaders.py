@@ -0,0 +1,203 @@
+"""
+GLSL shader sources, indexed by program name
+"""
+
+# Camera and light uniforms, and per-vertex lighting reproducing the
+# fixed-function pipeline state set in MiniWorldEnv._render_static: a single
+# light with ambient and diffuse terms, with the vertex color used as ambient
+# and diffuse material color. The light may be directional or positional,
+# as in fixed-function lighting. The ambient color includes the global
+# ambient light of the fixed-function pipeline.
+HEADER = """
+#version 130
+
+uniform mat4 proj;
+uniform mat4 view;
+
+uniform vec4 light_pos;
+uniform vec3 light_ambient;
+uniform vec3 light_color;
+
+vec4 light_vertex(vec4 eye_pos, vec3 normal, vec4 color)
+{
+    // Directional lights have a w coordinate of zero
+    vec4 eye_light = view * light_pos;
+    vec3 light_dir = normalize(eye_light.xyz - eye_light.w * eye_pos.xyz);
+    float diffuse = max(dot(normal, light_dir), 0.0);
+
+    vec3 lit = (light_ambient + diffuse * light_color) * color.rgb;
+
+    return vec4(clamp(lit, 0.0, 1.0), color.a);
+}
+"""
+
+# Static geometry, in world coordinates
+# The texture coordinates have a third component (the layer index)
+# when drawing with array textures
+STATIC_VERT = HEADER + """
+in vec3 position;
+in vec3 normal;
+in vec3 texcoord;
+
+out vec4 v_color;
+out vec3 v_texc;
+
+void main()
+{
+    vec4 eye_pos = view * vec4(position, 1.0);
+
+    v_color = light_vertex(eye_pos, mat3(view) * normal, vec4(1.0));
+    v_texc = texcoord;
+    gl_Position = proj * eye_pos;
+}
+"""
+
+STATIC_FRAG = """
+#version 130
+
+uniform sampler2D tex;
+
+in vec4 v_color;
+in vec3 v_texc;
+
+void main()
+{
+    gl_FragColor = v_color * texture(tex, v_texc.xy);
+}
+"""
+
+TEX_ARRAY_FRAG = """
+#version 130
+
+uniform sampler2DArray tex;
+
+in vec4 v_color;
+in vec3 v_texc;
+
+void main()
+{
+    gl_FragColor = v_color * texture(tex, v_texc);
+}
+"""
+
+# Entities drawn with instanced rendering
+# Each instance is rotated about the Y axis, scaled, then translated. The
+# normals are scaled by inst_scale.w without renormalization, matching the
+# fixed-function pipeline drawing scaled meshes.
+INSTANCED_VERT = HEADER + """
+in vec3 position;
+in vec3 normal;
+in vec2 texcoord;
+in vec3 color;
+
+in vec4 inst_pos;
+in vec4 inst_scale;
+in vec3 inst_color;
+
+out vec4 v_color;
+out vec2 v_texc;
+
+void main()
+{
+    float c = cos(inst_pos.w);
+    float s = sin(inst_pos.w);
+    mat3 rot = mat3(c, 0.0, -s, 0.0, 1.0, 0.0, s, 0.0, c);
+
+    vec3 pos = inst_pos.xyz + rot * (inst_scale.xyz * position);
+    vec4 eye_pos = view * vec4(pos, 1.0);
+    vec3 eye_normal = mat3(view) * (rot * normal * inst_scale.w);
+
+    v_color = light_vertex(eye_pos, eye_normal, vec4(color * inst_color, 1.0));
+    v_texc = texcoord;
+    gl_Position = proj * eye_pos;
+}
+"""
+
+INSTANCED_FRAG = """
+#version 130
+
+uniform sampler2D tex;
+uniform bool use_tex;
+
+in vec4 v_color;
+in vec2 v_texc;
+
+void main()
+{
+    vec4 color = v_color;
+    if (use_tex)
+        color *= texture(tex, v_texc);
+    gl_FragColor = color;
+}
+"""
+
+# Segmentation pass: flat integer object IDs, without lighting or textures
+# The vertex shader uses the fixed-function matrices so that geometry drawn
+# with any method (immediate mode, vertex lists or buffers) can be labelled
+SEG_VERT = """
+#version 130
+
+void main()
+{
+    gl_Position = gl_ModelViewProjectionMatrix * gl_Vertex;
+}
+"""
+
+SEG_FRAG = """
+#version 130
+
+uniform uint seg_id;
+
+out uvec4 seg;
+
+void main()
+{
+    seg = uvec4(seg_id, 0u, 0u, 0u);
+}
+"""
+
+# Segmentation pass for instanced entities, with the segmentation ID of
+# each instance as a per-instance attribute
+SEG_INSTANCED_VERT = HEADER + """
+in vec3 position;
+
+in vec4 inst_pos;
+in vec4 inst_scale;
+in float inst_seg_id;
+
+flat out uint v_seg_id;
+
+void main()
+{
+    float c = cos(inst_pos.w);
+    float s = sin(inst_pos.w);
+    mat3 rot = mat3(c, 0.0, -s, 0.0, 1.0, 0.0, s, 0.0, c);
+
+    vec3 pos = inst_pos.xyz + rot * (inst_scale.xyz * position);
+
+    v_seg_id = uint(inst_seg_id);
+    gl_Position = proj * view * vec4(pos, 1.0);
+}
+"""
+
+SEG_INSTANCED_FRAG = """
+#version 130
+
+flat in uint v_seg_id;
+
+out uvec4 seg;
+
+void main()
+{
+    seg = uvec4(v_seg_id, 0u, 0u, 0u);
+}
+"""
+
+# Vertex and fragment shader sources, indexed by program name
+SHADERS = {
+    "static": (STATIC_VERT, STATIC_FRAG),
+    "static_tex_array": (STATIC_VERT, TEX_ARRAY_FRAG),
+    "instanced": (INSTANCED_VERT, INSTANCED_FRAG),
+    "seg": (SEG_VERT, SEG_FRAG),
+    "seg_instanced": (SEG_INSTANCED_VERT, SEG_INSTANCED_FRAG),
+}
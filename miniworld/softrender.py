@@ -0,0 +1,588 @@
+"""
+Software rasterizer for top views, using NumPy only
+
+Renders the same images as MiniWorldEnv.render_top_view and
+render_local_top_view, up to antialiasing and small filtering differences,
+without making any OpenGL calls. The floors are sampled from their
+textures with trilinear filtering, and entities seen from above are
+drawn from their top faces (boxes) or from top-down sprites of their
+meshes, rasterized once per mesh.
+
+Only the state of the environment is used, so the environment can be
+created without OpenGL (use_gl=False), in which case pyglet.gl is never
+needed. This module only imports OpenGL-free modules for the same reason.
+"""
+
+import math
+
+import numpy as np
+from pyglet.extlibs import png
+
+from miniworld.math import TEX_DENSITY, fit_extents
+from miniworld.texcache import TextureCache
+
+# Size of the top-down sprites of meshes, in pixels along their
+# largest horizontal dimension
+SPRITE_SIZE = 128
+
+# Decoded images, indexed by file path, as lists of mipmap levels
+image_cache = {}
+
+# Top-down sprites, indexed by mesh
+sprite_cache = {}
+
+
+def load_image(path):
+    """
+    Load a PNG image as a list of mipmap levels, each level averaging
+    2x2 texels of the previous one, as glGenerateMipmap does
+    The levels are float arrays of shape (H, W, 3) with values in [0, 1],
+    with the bottom row first, as in OpenGL textures.
+    The decoded image is taken from the texture cache if available.
+    """
+
+    if path in image_cache:
+        return image_cache[path]
+
+    cached = TextureCache.lookup(path)
+    if cached is not None:
+        img = cached[0][:, :, :3].astype(np.float32) / 255
+    else:
+        width, height, rows, _ = png.Reader(filename=path).asRGBA8()
+        img = np.array([np.asarray(row, dtype=np.uint8) for row in rows])
+        img = img.reshape(height, width, 4)[::-1, :, :3].astype(np.float32) / 255
+
+    levels = [img]
+    while max(img.shape[:2]) > 1:
+        h, w = img.shape[:2]
+        if h > 1:
+            img = (img[0 : h // 2 * 2 : 2] + img[1 : h // 2 * 2 : 2]) / 2
+        if w > 1:
+            img = (img[:, 0 : w // 2 * 2 : 2] + img[:, 1 : w // 2 * 2 : 2]) / 2
+        levels.append(img)
+
+    image_cache[path] = levels
+
+    return levels
+
+
+def _bilinear(img, u, v):
+    """
+    Sample an image with bilinear filtering and repeat wrapping
+    """
+
+    h, w = img.shape[:2]
+    x = u * w - 0.5
+    y = v * h - 0.5
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = (x - x0)[:, None]
+    fy = (y - y0)[:, None]
+    x0 = x0.astype(int) % w
+    y0 = y0.astype(int) % h
+    x1 = (x0 + 1) % w
+    y1 = (y0 + 1) % h
+
+    top = img[y0, x0] * (1 - fx) + img[y0, x1] * fx
+    bottom = img[y1, x0] * (1 - fx) + img[y1, x1] * fx
+
+    return top * (1 - fy) + bottom * fy
+
+
+def sample_texture(levels, u, v, lod):
+    """
+    Sample a mipmapped image with trilinear filtering and repeat wrapping
+    at texture coordinates u, v, with a level of detail (log2 of the
+    number of texels per pixel) shared by all the samples
+    """
+
+    lod = min(max(lod, 0), len(levels) - 1)
+    l0 = int(lod)
+    frac = lod - l0
+
+    color = _bilinear(levels[l0], u, v)
+
+    if frac > 0:
+        color = color * (1 - frac) + _bilinear(levels[l0 + 1], u, v) * frac
+
+    return color
+
+
+def _triangle_coords(px, py, tri):
+    """
+    Barycentric coordinates of points relative to a 2D triangle,
+    of shape (N, 3), or None if the triangle is degenerate
+    """
+
+    (x0, y0), (x1, y1), (x2, y2) = tri
+    area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+
+    if abs(area) < 1e-12:
+        return None
+
+    w1 = ((px - x0) * (y2 - y0) - (x2 - x0) * (py - y0)) / area
+    w2 = ((x1 - x0) * (py - y0) - (px - x0) * (y1 - y0)) / area
+
+    return np.stack([1 - w1 - w2, w1, w2], axis=1)
+
+
+class MeshSprite:
+    """
+    Top-down view of a mesh in its local coordinates: for each pixel,
+    the height, normal, vertex color and texture color of the highest
+    surface of the mesh
+    """
+
+    def __init__(self, mesh):
+        geom = mesh.instanced_geom
+        data = geom.data if geom.indices is None else geom.data[geom.indices]
+        verts = data[:, 0:3].reshape(-1, 3, 3)
+        norms = data[:, 3:6].reshape(-1, 3, 3)
+        texcs = data[:, 6:8].reshape(-1, 3, 2)
+        colors = data[:, 8:11].reshape(-1, 3, 3)
+
+        xz = verts[:, :, [0, 2]]
+        self.min_xz = xz.min(axis=(0, 1))
+        extent = xz.max(axis=(0, 1)) - self.min_xz
+        self.scale = SPRITE_SIZE / max(extent.max(), 1e-6)
+        self.width, self.height = (np.ceil(extent * self.scale)).astype(int) + 1
+
+        self.heights = np.full((self.height, self.width), -np.inf)
+        self.normals = np.zeros((self.height, self.width, 3))
+        self.colors = np.zeros((self.height, self.width, 3))
+        self.tex_colors = np.ones((self.height, self.width, 3))
+
+        # Pixels covered by the bounding box of each triangle
+        pix = (xz - self.min_xz) * self.scale
+        c0, r0 = np.maximum(np.ceil(pix.min(axis=1) - 0.5), 0).astype(int).T
+        c1, r1 = np.floor(pix.max(axis=1) - 0.5).astype(int).T
+        c1 = np.minimum(c1, self.width - 1)
+        r1 = np.minimum(r1, self.height - 1)
+        w = np.maximum(c1 - c0 + 1, 0)
+        h = np.maximum(r1 - r0 + 1, 0)
+
+        (x0, y0), (x1, y1), (x2, y2) = np.moveaxis(pix, (1, 2), (0, 1))
+        area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+        counts = np.where(np.abs(area) > 1e-12, w * h, 0)
+
+        # Candidate pixels of all the triangles at once
+        tri = np.repeat(np.arange(len(pix)), counts)
+        k = np.arange(len(tri)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cols = c0[tri] + k % w[tri]
+        rows = r0[tri] + k // w[tri]
+
+        px = cols + 0.5 - x0[tri]
+        py = rows + 0.5 - y0[tri]
+        b1 = (px * (y2 - y0)[tri] - (x2 - x0)[tri] * py) / area[tri]
+        b2 = ((x1 - x0)[tri] * py - px * (y1 - y0)[tri]) / area[tri]
+        bary = np.stack([1 - b1 - b2, b1, b2], axis=1)
+
+        inside = np.all(bary >= 0, axis=1)
+        tri, rows, cols, bary = tri[inside], rows[inside], cols[inside], bary[inside]
+        y = np.sum(bary * verts[tri, :, 1], axis=1)
+
+        # Keep the highest surface at each pixel
+        pixel = rows * self.width + cols
+        order = np.lexsort((y, pixel))
+        last = np.append(pixel[order][1:] != pixel[order][:-1], True)
+        top = order[last]
+        tri, rows, cols, bary = tri[top], rows[top], cols[top], bary[top, :, None]
+
+        self.heights[rows, cols] = y[top]
+        self.normals[rows, cols] = np.sum(bary * norms[tri], axis=1)
+        self.colors[rows, cols] = np.sum(bary * colors[tri], axis=1)
+
+        # Sample the textures of the chunks the triangles belong to
+        texcs = np.sum(bary * texcs[tri], axis=1)
+        for (_, first, count), path in zip(geom.chunks, mesh.tex_paths):
+            if path is None:
+                continue
+
+            img = load_image(path)[0]
+            in_chunk = (tri >= first // 3) & (tri < (first + count) // 3)
+            u, v = texcs[in_chunk].T
+            tx = (u * img.shape[1]).astype(int) % img.shape[1]
+            ty = (v * img.shape[0]).astype(int) % img.shape[0]
+            self.tex_colors[rows[in_chunk], cols[in_chunk]] = img[ty, tx]
+
+    @classmethod
+    def get(cls, mesh):
+        """
+        Get the sprite of a mesh, rasterizing it on first use
+        """
+
+        if mesh not in sprite_cache:
+            sprite_cache[mesh] = MeshSprite(mesh)
+
+        return sprite_cache[mesh]
+
+
+class TopViewRasterizer:
+    """
+    Rasterize the world seen from above into an image with a depth buffer
+    The depth is the height of the surfaces, higher surfaces are in front.
+    """
+
+    def __init__(self, env, width, height, extents, rot=None):
+        """
+        The extents (min_x, max_x, min_z, max_z) are the world area covered
+        by the image. The optional rot is a (2, 3) affine transform applied
+        to the world x, z coordinates before mapping them to the image.
+        """
+
+        self.env = env
+        self.width = width
+        self.height = height
+
+        min_x, max_x, min_z, max_z = extents
+        sx = width / (max_x - min_x)
+        sz = height / (max_z - min_z)
+        to_pixel = np.array([[sx, 0, -min_x * sx], [0, sz, -min_z * sz], [0, 0, 1]])
+        if rot is not None:
+            to_pixel = to_pixel @ np.vstack([rot, [0, 0, 1]])
+
+        # World x, z to image column, row, and back
+        self.to_pixel = to_pixel[:2]
+        self.to_world = np.linalg.inv(to_pixel)[:2]
+
+        # Size of a pixel, in meters
+        self.pixel_size = (max_x - min_x) / width
+
+        self.colors = np.zeros((height, width, 3), dtype=np.float32)
+        self.depth = np.full((height, width), -np.inf)
+
+        # Light parameters, as set up by MiniWorldEnv._setup_lights
+        # Note: the fixed-function global ambient light is 0.2
+        light_pos = np.zeros(4)
+        values = np.ravel(env.light_pos + [1])[:4]
+        light_pos[: len(values)] = values
+        self.light_pos = light_pos
+        self.light_ambient = np.asarray(env.light_ambient)[:3] + 0.2
+        self.light_color = np.asarray(env.light_color)[:3]
+
+    def _pixels(self, corners):
+        """
+        Get the pixels whose centers are inside the image area covered by
+        world x, z points, as row and column indices and world x, z
+        coordinates, or None if there are no such pixels
+        """
+
+        pix = corners @ self.to_pixel[:, :2].T + self.to_pixel[:, 2]
+        c0, r0 = np.maximum(np.ceil(pix.min(axis=0) - 0.5), 0).astype(int)
+        c1, r1 = np.floor(pix.max(axis=0) - 0.5).astype(int)
+        c1 = min(c1, self.width - 1)
+        r1 = min(r1, self.height - 1)
+
+        if c1 < c0 or r1 < r0:
+            return None
+
+        rows, cols = np.mgrid[r0 : r1 + 1, c0 : c1 + 1]
+        rows = rows.ravel()
+        cols = cols.ravel()
+        centers = np.stack([cols + 0.5, rows + 0.5], axis=1)
+        world = centers @ self.to_world[:, :2].T + self.to_world[:, 2]
+
+        return rows, cols, world
+
+    def _write(self, rows, cols, colors, depth, depth_test=True):
+        """
+        Write the colors of pixels in front of the current ones
+        """
+
+        depth = np.broadcast_to(depth, rows.shape)
+
+        if depth_test:
+            front = depth > self.depth[rows, cols]
+            rows, cols, depth = rows[front], cols[front], depth[front]
+            colors = np.broadcast_to(colors, front.shape + (3,))[front]
+
+        self.colors[rows, cols] = colors
+        self.depth[rows, cols] = depth
+
+    def _light(self, colors, normals, points):
+        """
+        Per-pixel version of the fixed-function lighting set up in the
+        environment: ambient and diffuse terms, with the vertex colors as
+        ambient and diffuse material colors
+        """
+
+        x, y, z, w = self.light_pos
+        light_dir = np.array([x, y, z]) - points * w
+        light_dir = light_dir / np.linalg.norm(light_dir, axis=-1, keepdims=True)
+        diffuse = np.maximum(np.sum(normals * light_dir, axis=-1), 0)[:, None]
+
+        return np.clip(colors * (self.light_ambient + diffuse * self.light_color), 0, 1)
+
+    def draw_floor(self, room):
+        """
+        Draw the textured floor of a room
+        """
+
+        pixels = self._pixels(room.outline[:, [0, 2]])
+        if pixels is None:
+            return
+        rows, cols, world = pixels
+
+        # Points inside the (convex) outline of the room
+        ap = world[:, None, :] - room.outline[None, :, [0, 2]]
+        dots = np.sum(ap * room.edge_norms[None, :, [0, 2]], axis=2)
+        inside = np.all(dots >= 0, axis=1)
+        rows, cols, world = rows[inside], cols[inside], world[inside]
+
+        points = np.insert(world, 1, 0, axis=1)
+        normals = np.array([0.0, 1.0, 0.0])
+        colors = self._light(np.ones(3), normals, points)
+
+        # Same texture coordinates as gen_texcs_floor
+        tex = room.floor_tex
+        lod = math.log2(max(TEX_DENSITY * self.pixel_size, 1e-6))
+        colors *= sample_texture(
+            load_image(tex.path),
+            world[:, 0] * TEX_DENSITY / tex.width,
+            world[:, 1] * TEX_DENSITY / tex.height,
+            lod,
+        )
+
+        self._write(rows, cols, colors, 0)
+
+    def draw_box(self, ent):
+        """
+        Draw the top face of a box entity
+        """
+
+        pos = np.asarray(ent.pos)
+        pixels = self._pixels(pos[[0, 2]] + ent.radius * np.array([[-1], [1]]))
+        if pixels is None:
+            return
+        rows, cols, world = pixels
+
+        # Coordinates relative to the box
+        c = math.cos(ent.dir)
+        s = math.sin(ent.dir)
+        dx = world[:, 0] - pos[0]
+        dz = world[:, 1] - pos[2]
+        lx = dx * c - dz * s
+        lz = dx * s + dz * c
+
+        sx, sy, sz = ent.size
+        inside = (np.abs(lx) <= sx / 2) & (np.abs(lz) <= sz / 2)
+        rows, cols, world = rows[inside], cols[inside], world[inside]
+
+        top = pos[1] + sy
+        points = np.insert(world, 1, top, axis=1)
+        colors = self._light(ent.color_vec, np.array([0.0, 1.0, 0.0]), points)
+
+        self._write(rows, cols, colors, top)
+
+    def draw_mesh(self, ent):
+        """
+        Draw a mesh entity from the top-down sprite of its mesh
+        """
+
+        pos = np.asarray(ent.pos)
+        pixels = self._pixels(pos[[0, 2]] + ent.radius * np.array([[-1], [1]]))
+        if pixels is None:
+            return
+        rows, cols, world = pixels
+
+        sprite = MeshSprite.get(ent.mesh)
+
+        # Coordinates in the mesh, undoing the entity transform
+        c = math.cos(ent.dir)
+        s = math.sin(ent.dir)
+        dx = world[:, 0] - pos[0]
+        dz = world[:, 1] - pos[2]
+        local = np.stack([dx * c - dz * s, dx * s + dz * c], axis=1) / ent.scale
+
+        idx = np.floor((local - sprite.min_xz) * sprite.scale).astype(int)
+        valid = (
+            (idx[:, 0] >= 0)
+            & (idx[:, 0] < sprite.width)
+            & (idx[:, 1] >= 0)
+            & (idx[:, 1] < sprite.height)
+        )
+        rows, cols, world, idx = rows[valid], cols[valid], world[valid], idx[valid]
+
+        heights = sprite.heights[idx[:, 1], idx[:, 0]]
+        covered = heights > -np.inf
+        rows, cols, world, idx = (
+            rows[covered],
+            cols[covered],
+            world[covered],
+            idx[covered],
+        )
+        heights = pos[1] + ent.scale * heights[covered]
+
+        # Rotate the normals with the entity
+        # Note: the fixed-function pipeline scales the normals of scaled
+        # meshes by the inverse scale
+        n = sprite.normals[idx[:, 1], idx[:, 0]]
+        normals = np.stack(
+            [n[:, 0] * c + n[:, 2] * s, n[:, 1], n[:, 2] * c - n[:, 0] * s], axis=1
+        )
+        normals /= ent.scale
+
+        points = np.insert(world, 1, heights, axis=1)
+        colors = self._light(sprite.colors[idx[:, 1], idx[:, 0]], normals, points)
+        colors *= sprite.tex_colors[idx[:, 1], idx[:, 0]]
+
+        self._write(rows, cols, colors, heights)
+
+    def draw_line(self, p0, p1, width, color, depth_test=True):
+        """
+        Draw a line between two world points, with a width in pixels
+        The line is drawn at the height of its first point.
+        """
+
+        # Extend the area covered by the end points by the line width
+        ends = np.array([p0[[0, 2]], p1[[0, 2]]])
+        offsets = np.array([[-1, -1], [-1, 1], [1, -1], [1, 1]])
+        margin = width / 2 * self.pixel_size
+        pixels = self._pixels((ends[:, None, :] + margin * offsets).reshape(-1, 2))
+        if pixels is None:
+            return
+        rows, cols, _ = pixels
+
+        q0 = self.to_pixel[:, :2] @ p0[[0, 2]] + self.to_pixel[:, 2]
+        q1 = self.to_pixel[:, :2] @ p1[[0, 2]] + self.to_pixel[:, 2]
+        vec = q1 - q0
+        length = np.linalg.norm(vec)
+        if length < 1e-9:
+            return
+        vec /= length
+
+        dx = cols + 0.5 - q0[0]
+        dy = rows + 0.5 - q0[1]
+        along = dx * vec[0] + dy * vec[1]
+        across = dx * vec[1] - dy * vec[0]
+        inside = (along >= 0) & (along <= length) & (np.abs(across) <= width / 2)
+
+        self._write(rows[inside], cols[inside], color, p0[1], depth_test)
+
+    def draw_triangle(self, p0, p1, p2, color):
+        """
+        Draw a flat, unlit triangle given by world points
+        """
+
+        corners = np.array([p0[[0, 2]], p1[[0, 2]], p2[[0, 2]]])
+        pixels = self._pixels(corners)
+        if pixels is None:
+            return
+        rows, cols, world = pixels
+
+        bary = _triangle_coords(world[:, 0], world[:, 1], corners)
+        if bary is None:
+            return
+
+        inside = np.all(bary >= 0, axis=1)
+        depth = bary[inside] @ np.array([p0[1], p1[1], p2[1]])
+
+        self._write(rows[inside], cols[inside], color, depth)
+
+    def draw_agent(self, agent):
+        """
+        Draw the agent as in Agent.render: a red triangle with a dark
+        outline drawn over everything
+        """
+
+        p = agent.pos + np.array([0, agent.height, 0])
+        dv = agent.dir_vec * agent.radius
+        rv = agent.right_vec * agent.radius
+
+        p0 = p + dv
+        p1 = p + 0.75 * (rv - dv)
+        p2 = p + 0.75 * (-rv - dv)
+
+        self.draw_triangle(p0, p2, p1, np.array([1.0, 0.0, 0.0]))
+
+        outline = np.array([50, 10, 10]) / 255
+        for a, b in [(p0, p2), (p2, p1), (p1, p0)]:
+            self.draw_line(a, b, 3.0, outline, depth_test=False)
+
+    def draw_world(self, render_agent=True):
+        """
+        Draw the floors, entities and wall outlines of the environment
+        """
+
+        env = self.env
+
+        for room in env.rooms:
+            self.draw_floor(room)
+
+        # The entities are told apart by their geometry, meshes or boxes
+        # of a given size, as the entity classes draw with OpenGL
+        for ent in env.entities:
+            if ent is env.agent:
+                continue
+            if hasattr(ent, "mesh"):
+                self.draw_mesh(ent)
+            elif hasattr(ent, "size"):
+                self.draw_box(ent)
+
+        wall_color = np.array([0.3, 0.3, 0.3])
+        for p0, p1 in env._top_wall_lines():
+            self.draw_line(p0, p1, 6.0, wall_color)
+
+        if render_agent:
+            self.draw_agent(env.agent)
+
+    def image(self):
+        """
+        Get the rendered image as an (H, W, 3) uint8 array
+        """
+
+        return np.floor(self.colors * 255 + 0.5).astype(np.uint8)
+
+
+def render_top_view(env, width=None, height=None, render_agent=True):
+    """
+    Render a top view of the whole map, as MiniWorldEnv.render_top_view
+    The image size defaults to the observation size.
+    """
+
+    if width is None:
+        width = env.obs_width
+    if height is None:
+        height = env.obs_height
+
+    extents = fit_extents(
+        env.min_x - 1, env.max_x + 1, env.min_z - 1, env.max_z + 1, width / height
+    )
+
+    raster = TopViewRasterizer(env, width, height, extents)
+    raster.draw_world(render_agent)
+
+    return raster.image()
+
+
+def render_local_top_view(
+    env, view_size=3.0, image_size=256, render_agent=True, rotate=False
+):
+    """
+    Render a top view centered on the agent, as
+    MiniWorldEnv.render_local_top_view
+    With rotate, the view turns with the agent, so that it faces up.
+    """
+
+    cx, _, cz = env.agent.pos
+    extents = fit_extents(
+        cx - view_size / 2,
+        cx + view_size / 2,
+        cz - view_size / 2,
+        cz + view_size / 2,
+        1,
+    )
+
+    rot = None
+    if rotate:
+        # Rotate the world about the agent, so that it faces up (-Z)
+        right = env.agent.right_vec[[0, 2]]
+        back = -env.agent.dir_vec[[0, 2]]
+        center = env.agent.pos[[0, 2]]
+        rot = np.stack([right, back])
+        rot = np.concatenate([rot, (center - rot @ center)[:, None]], axis=1)
+
+    raster = TopViewRasterizer(env, image_size, image_size, extents, rot)
+    raster.draw_world(render_agent)
+
+    return raster.image()
@@ -0,0 +1,227 @@
+"""
+Cache of decoded texture images, memory-mapped from disk
+
+Decoding PNG images is by far the slowest part of loading textures. The
+cache stores the decoded RGBA pixels of every texture in a single raw
+file, with a JSON index, so that processes upload textures straight from the
+memory-mapped file and share it through the page cache. The cache is
+built once with scripts/build_texture_cache.py, optionally with the
+textures downsampled to a maximum size (see the max_texture_size argument
+of MiniWorldEnv).
+
+Textures missing from the cache, or modified since it was built, are
+decoded from their PNG files as usual.
+"""
+
+import json
+import os
+
+import numpy as np
+import pyglet
+
+# Directory containing the package resources (textures and meshes)
+RESOURCE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Directory of the cache files
+CACHE_DIR = os.environ.get(
+    "MINIWORLD_TEXTURE_CACHE", os.path.join("~", ".cache", "miniworld", "textures")
+)
+CACHE_DIR = os.path.expanduser(CACHE_DIR)
+
+
+def decode_image(path):
+    """
+    Decode an image file into an array of RGBA pixels, of shape (H, W, 4)
+    The bottom row comes first, as in OpenGL textures.
+    """
+
+    img = pyglet.image.load(path)
+    data = img.get_image_data().get_data("RGBA", img.width * 4)
+
+    return np.frombuffer(data, dtype=np.uint8).reshape(img.height, img.width, 4)
+
+
+def downsample_image(img, width, height):
+    """
+    Downsample an (H, W, C) uint8 image to a smaller size, averaging the
+    block of source pixels covered by each destination pixel
+    """
+
+    img = np.asarray(img, dtype=np.float32)
+
+    for axis, size in ((0, height), (1, width)):
+        if img.shape[axis] == size:
+            continue
+
+        # First source pixel of each destination pixel
+        starts = (np.arange(size) * img.shape[axis]) // size
+        counts = np.diff(np.append(starts, img.shape[axis]))
+
+        img = np.add.reduceat(img, starts, axis=axis)
+        img /= np.expand_dims(counts, axis=1 - axis)[..., None]
+
+    return np.ascontiguousarray(np.round(img), dtype=np.uint8)
+
+
+class TextureCache:
+    """
+    Decoded texture images of a cache file, indexed by path
+    """
+
+    # Caches opened, indexed by maximum texture size (None if missing)
+    caches = {}
+
+    @staticmethod
+    def file_path(max_size=None, cache_dir=None):
+        """
+        Path of the cache file for a maximum texture size, without extension
+        """
+
+        name = "texcache_full" if max_size is None else "texcache_%d" % max_size
+
+        return os.path.join(cache_dir or CACHE_DIR, name)
+
+    @classmethod
+    def open(cls, max_size=None):
+        """
+        Open the cache for a maximum texture size, None if it was not built
+        """
+
+        if max_size not in cls.caches:
+            path = cls.file_path(max_size)
+            if os.path.exists(path + ".json"):
+                cls.caches[max_size] = TextureCache(path)
+            else:
+                cls.caches[max_size] = None
+
+        return cls.caches[max_size]
+
+    @classmethod
+    def lookup(cls, tex_path, max_size=None):
+        """
+        Get the cached pixels of a texture, downsampled to max_size, along
+        with the size of the source image. Textures downsampled when the
+        cache was built are used if available, then full-size textures.
+        Returns None if the texture is not cached.
+        """
+
+        for size in dict.fromkeys([max_size, None]):
+            cache = cls.open(size)
+            if cache is not None:
+                entry = cache.get(tex_path)
+                if entry is not None:
+                    return entry
+
+        return None
+
+    @staticmethod
+    def key(tex_path):
+        """
+        Key of a texture in the index, its path relative to the package
+        """
+
+        return os.path.relpath(os.path.realpath(tex_path), RESOURCE_DIR)
+
+    @staticmethod
+    def stamp(tex_path):
+        """
+        Size and modification time of a texture file, to detect changes
+        """
+
+        st = os.stat(tex_path)
+
+        return [st.st_size, st.st_mtime_ns]
+
+    @classmethod
+    def build(cls, tex_paths, max_size=None, cache_dir=None, decode=None):
+        """
+        Decode textures and write them into a cache file
+        The decode function maps a list of paths to an iterable of decoded
+        images, e.g. using a pool of processes. The images are written
+        as they are decoded, so that they are not all held in memory.
+        Returns the path of the cache file.
+        """
+
+        if decode is None:
+
+            def decode(paths):
+                return map(decode_image, paths)
+
+        path = cls.file_path(max_size, cache_dir)
+        index = {"max_size": max_size, "textures": {}}
+
+        # Write to temporary files first, so that a failed build leaves any
+        # previous cache intact
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+
+        data_file = open(tmp_path + ".bin", "wb")
+        offset = 0
+
+        for tex_path, img in zip(tex_paths, decode(tex_paths)):
+            src_height, src_width = img.shape[:2]
+
+            if max_size is not None and max(src_width, src_height) > max_size:
+                scale = max_size / max(src_width, src_height)
+                img = downsample_image(
+                    img,
+                    max(1, int(src_width * scale)),
+                    max(1, int(src_height * scale)),
+                )
+
+            index["textures"][cls.key(tex_path)] = {
+                "offset": offset,
+                "shape": list(img.shape),
+                "src_size": [src_width, src_height],
+                "stamp": cls.stamp(tex_path),
+            }
+
+            data_file.write(np.ascontiguousarray(img).tobytes())
+            offset += img.size
+
+        data_file.close()
+
+        with open(tmp_path + ".json", "w") as f:
+            json.dump(index, f)
+
+        # Replace the index last, so that the cache is only used once
+        # complete. The previous index is removed first, as it does not
+        # match the new data file.
+        if os.path.exists(path + ".json"):
+            os.remove(path + ".json")
+        os.replace(tmp_path + ".bin", path + ".bin")
+        os.replace(tmp_path + ".json", path + ".json")
+
+        # Forget the cache if it was already opened
+        cls.caches.pop(max_size, None)
+
+        return path
+
+    def __init__(self, path):
+        with open(path + ".json") as f:
+            index = json.load(f)
+
+        self.max_size = index["max_size"]
+        self.textures = index["textures"]
+
+        # The pixels are only read from disk as they are used
+        self.data = None
+        if os.path.getsize(path + ".bin") > 0:
+            self.data = np.memmap(path + ".bin", dtype=np.uint8, mode="r")
+
+    def get(self, tex_path):
+        """
+        Get the pixels of a texture and the size of its source image,
+        or None if the texture is missing or was modified
+        """
+
+        entry = self.textures.get(self.key(tex_path))
+
+        if entry is None or entry["stamp"] != self.stamp(tex_path):
+            return None
+
+        offset = entry["offset"]
+        shape = entry["shape"]
+        pixels = self.data[offset : offset + np.prod(shape)].reshape(shape)
+
+        return pixels, tuple(entry["src_size"])
@@ -1,5 +1,7 @@
 import os
 
+from pyglet.extlibs import png
+
 
 def get_subdir_path(sub_dir):
     # Get the directory this module is located in
@@ -35,3 +37,15 @@ def get_file_path(sub_dir, file_name, default_ext):
         file_path += "." + default_ext
 
     return file_path
+
+
+def image_size(path):
+    """
+    Get the (width, height) of a PNG image file, reading only its header,
+    without OpenGL (pyglet.image needs it)
+    """
+
+    with open(path, "rb") as f:
+        width, height, _, _ = png.Reader(file=f).read()
+
+    return width, height
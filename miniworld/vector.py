@@ -0,0 +1,556 @@
+"""
+Vectorized environment stepping several MiniWorld worlds in one process
+
+The worlds share the OpenGL context of the process, along with their
+textures and meshes (see ResourceManager), and their observations are
+rendered in a single batched pass into one (N, H, W, 3) array, instead
+of one process and one OpenGL context per environment as with
+gymnasium's AsyncVectorEnv.
+
+To scale to several cores, MiniWorldAsyncVectorEnv runs one such
+vectorized environment per worker process, with the workers rendering
+their observations straight into a shared-memory array.
+"""
+
+import multiprocessing as mp
+import os
+from copy import deepcopy
+from multiprocessing import shared_memory
+from typing import Optional
+
+import gymnasium as gym
+import numpy as np
+import pyglet
+from gymnasium import spaces
+from gymnasium.vector import VectorEnv
+from gymnasium.vector.utils import batch_space, concatenate, create_empty_array
+
+from miniworld.miniworld import render_obs_batch
+
+# The vector environments use the gymnasium 1.1 vector API (autoreset modes,
+# VectorEnv constructor and infos), while miniworld supports older versions
+try:
+    from gymnasium.vector import AutoresetMode
+except ImportError as e:
+    raise ImportError(
+        "miniworld.vector requires gymnasium>=1.1.0, "
+        f"found gymnasium {gym.__version__} (pip install 'miniworld[vector]')"
+    ) from e
+
+
+class MiniWorldVectorEnv(VectorEnv):
+    """
+    Step num_envs copies of a MiniWorld environment back-to-back, and
+    render all their observations at once.
+
+    The environments are created with gym.make(env_id, **kwargs), with
+    the wrappers registered for them (e.g. TimeLimit), but without the
+    passive environment checker by default. Observations are
+    batch-rendered by the base environments for environments with plain
+    RGB observations, other observation types (e.g. with depth or
+    segmentation maps) are rendered one environment at a time.
+
+    Episodes are reset automatically, by default on the step following
+    the end of an episode (see gymnasium.vector.AutoresetMode), with the
+    final observation and info of the episode returned in the infos with
+    AutoresetMode.SAME_STEP.
+    """
+
+    def __init__(
+        self,
+        env_id: str,
+        num_envs: int,
+        copy: bool = True,
+        autoreset_mode: AutoresetMode = AutoresetMode.NEXT_STEP,
+        **kwargs,
+    ):
+        """
+        With copy, reset and step return a copy of the observations
+        instead of the array they are rendered into
+        """
+
+        super().__init__()
+
+        if num_envs <= 0:
+            raise ValueError(f"num_envs must be positive, got {num_envs}")
+        autoreset_mode = AutoresetMode(autoreset_mode)
+        if autoreset_mode not in [AutoresetMode.NEXT_STEP, AutoresetMode.SAME_STEP]:
+            raise ValueError(f"unsupported autoreset mode {autoreset_mode}")
+
+        # The observations of batch-rendered environments are None until
+        # they are rendered, which the environment checker warns about
+        kwargs.setdefault("disable_env_checker", True)
+
+        self.envs = [gym.make(env_id, **kwargs) for _ in range(num_envs)]
+        self.num_envs = num_envs
+        self.copy = copy
+        self.autoreset_mode = autoreset_mode
+
+        env0 = self.envs[0]
+        self.metadata = dict(env0.metadata)
+        self.metadata["autoreset_mode"] = autoreset_mode
+        self.render_mode = env0.render_mode
+
+        self.single_observation_space = env0.observation_space
+        self.single_action_space = env0.action_space
+        self.observation_space = batch_space(self.single_observation_space, num_envs)
+        self.action_space = batch_space(self.single_action_space, num_envs)
+
+        # Render the observations of all the environments in one pass,
+        # when they are plain RGB images
+        self.batch_render = isinstance(self.single_observation_space, spaces.Box)
+        for env in self.envs:
+            assert env.unwrapped.gl_context is env0.unwrapped.gl_context
+            env.unwrapped.defer_obs = self.batch_render
+
+        # Observations of the last step, rendered in place
+        self._observations = create_empty_array(
+            self.single_observation_space, n=num_envs, fn=np.zeros
+        )
+        self._env_obs = [None] * num_envs
+        self._rewards = np.zeros((num_envs,), dtype=np.float64)
+        self._terminations = np.zeros((num_envs,), dtype=np.bool_)
+        self._truncations = np.zeros((num_envs,), dtype=np.bool_)
+
+        # Environments to reset on the next step
+        self._autoreset_envs = np.zeros((num_envs,), dtype=np.bool_)
+
+    def reset(
+        self,
+        *,
+        seed: Optional[int] = None,
+        options: Optional[dict] = None,
+    ):
+        """
+        Reset all the environments
+        An integer seed seeds the environments with seed, seed + 1, etc.
+        """
+
+        if seed is None:
+            seed = [None] * self.num_envs
+        elif isinstance(seed, int):
+            seed = [seed + i for i in range(self.num_envs)]
+        if len(seed) != self.num_envs:
+            raise ValueError(f"expected {self.num_envs} seeds, got {len(seed)}")
+
+        env_infos = self._reset(seed, options)
+
+        infos = {}
+        for i, info in enumerate(env_infos):
+            infos = self._add_info(infos, info, i)
+
+        return self._batch_obs(), infos
+
+    def _reset(self, seeds, options=None):
+        """
+        Reset the environments with a list of seeds, and return the info
+        of each environment. The observations are not batched yet.
+        """
+
+        self._terminations[:] = False
+        self._truncations[:] = False
+        self._autoreset_envs[:] = False
+
+        env_infos = []
+        for i, env in enumerate(self.envs):
+            self._env_obs[i], info = env.reset(seed=seeds[i], options=options)
+            env_infos.append(info)
+
+        return env_infos
+
+    def step(self, actions):
+        """
+        Step all the environments, resetting those whose episode ended
+        """
+
+        env_infos = self._step(actions)
+
+        infos = {}
+        for i, info in enumerate(env_infos):
+            infos = self._add_info(infos, info, i)
+
+        return (
+            self._batch_obs(),
+            np.copy(self._rewards),
+            np.copy(self._terminations),
+            np.copy(self._truncations),
+            infos,
+        )
+
+    def _step(self, actions):
+        """
+        Step the environments and return the info of each environment
+        The observations are not batched yet.
+        """
+
+        env_infos = []
+        for i, (env, action) in enumerate(zip(self.envs, actions)):
+            if self._autoreset_envs[i]:
+                self._env_obs[i], info = env.reset()
+                self._rewards[i] = 0
+                self._terminations[i] = False
+                self._truncations[i] = False
+            else:
+                (
+                    self._env_obs[i],
+                    self._rewards[i],
+                    self._terminations[i],
+                    self._truncations[i],
+                    info,
+                ) = env.step(action)
+
+            if self.autoreset_mode == AutoresetMode.SAME_STEP and (
+                self._terminations[i] or self._truncations[i]
+            ):
+                final_obs = self._env_obs[i]
+                if self.batch_render:
+                    final_obs = env.unwrapped.render_obs()
+
+                final_info = info
+                self._env_obs[i], info = env.reset()
+                info = dict(info, final_obs=final_obs, final_info=final_info)
+
+            env_infos.append(info)
+
+        self._autoreset_envs = self._terminations | self._truncations
+        if self.autoreset_mode == AutoresetMode.SAME_STEP:
+            self._autoreset_envs[:] = False
+
+        return env_infos
+
+    def _batch_obs(self):
+        """
+        Produce the batched observations of all the environments
+        """
+
+        if self.batch_render:
+            views = [(env.unwrapped, env.unwrapped.agent) for env in self.envs]
+            render_obs_batch(views, out=self._observations)
+        else:
+            self._observations = concatenate(
+                self.single_observation_space, self._env_obs, self._observations
+            )
+
+        return deepcopy(self._observations) if self.copy else self._observations
+
+    def render(self):
+        return tuple(env.render() for env in self.envs)
+
+    def call(self, name, *args, **kwargs):
+        """
+        Call a method, or get an attribute, of every environment
+        """
+
+        results = []
+        for env in self.envs:
+            attr = env.get_wrapper_attr(name)
+            results.append(attr(*args, **kwargs) if callable(attr) else attr)
+
+        return tuple(results)
+
+    def get_attr(self, name):
+        return tuple(env.get_wrapper_attr(name) for env in self.envs)
+
+    def set_attr(self, name, values):
+        if not isinstance(values, (list, tuple)):
+            values = [values] * self.num_envs
+        if len(values) != self.num_envs:
+            raise ValueError(f"expected {self.num_envs} values, got {len(values)}")
+
+        for env, value in zip(self.envs, values):
+            env.set_wrapper_attr(name, value)
+
+    def close_extras(self, **kwargs):
+        for env in self.envs:
+            env.close()
+
+
+def _worker(conn, env_id, num_envs, autoreset_mode, cpu, kwargs):
+    """
+    Run a vectorized environment in a worker process of
+    MiniWorldAsyncVectorEnv, rendering its observations into a slice of
+    the shared observation array
+    """
+
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+
+    venv = MiniWorldVectorEnv(
+        env_id, num_envs, copy=False, autoreset_mode=autoreset_mode, **kwargs
+    )
+    conn.send(
+        (
+            venv.single_observation_space,
+            venv.single_action_space,
+            venv.metadata,
+            venv.render_mode,
+        )
+    )
+
+    # Attach the shared observation array, which the parent process owns
+    # and unlinks (the workers share its resource tracker)
+    shm_name, shape, start = conn.recv()
+    shm = shared_memory.SharedMemory(shm_name)
+    observations = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    venv._observations = observations[start : start + num_envs]
+
+    while True:
+        cmd, data = conn.recv()
+
+        try:
+            if cmd == "reset":
+                result = venv._reset(*data)
+                venv._batch_obs()
+            elif cmd == "step":
+                env_infos = venv._step(data)
+                venv._batch_obs()
+                result = (
+                    venv._rewards,
+                    venv._terminations,
+                    venv._truncations,
+                    env_infos,
+                )
+            elif cmd == "call":
+                name, args, kwargs = data
+                result = venv.call(name, *args, **kwargs)
+            elif cmd == "set_attr":
+                result = venv.set_attr(*data)
+            elif cmd == "close":
+                venv.close()
+                conn.send(None)
+                break
+            else:
+                assert False, f"unknown command {cmd}"
+        except Exception as e:
+            result = e
+
+        conn.send(result)
+
+    venv._observations = None
+    del observations
+    shm.close()
+
+
+class MiniWorldAsyncVectorEnv(VectorEnv):
+    """
+    Step num_envs copies of a MiniWorld environment in worker processes,
+    each running a MiniWorldVectorEnv over a share of the environments.
+
+    The workers render their observations straight into a shared-memory
+    (N, H, W, 3) array, so that only the rewards, flags and infos are
+    sent back through pipes. Workers are forked from a forkserver which
+    preloads miniworld (see miniworld/preload.py) when pyglet's shadow
+    window is disabled, and can be pinned to one CPU each. Only
+    environments with RGB image observations are supported.
+
+    An integer seed passed to reset seeds the environments with seed,
+    seed + 1, etc., whatever the number of workers, so that the results
+    do not depend on how the environments are split.
+    """
+
+    def __init__(
+        self,
+        env_id: str,
+        num_envs: int,
+        num_workers: Optional[int] = None,
+        copy: bool = True,
+        autoreset_mode: AutoresetMode = AutoresetMode.NEXT_STEP,
+        pin_cpus: bool = False,
+        context: Optional[str] = None,
+        **kwargs,
+    ):
+        """
+        By default, there is one worker per available CPU. With pin_cpus,
+        each worker runs on a single CPU. The context is the multiprocessing
+        start method, by default "forkserver" where available.
+        """
+
+        super().__init__()
+
+        cpus = sorted(os.sched_getaffinity(0)) if pin_cpus else []
+        if num_workers is None:
+            num_workers = len(cpus) if pin_cpus else os.cpu_count()
+        num_workers = min(num_workers, num_envs)
+        if num_workers <= 0:
+            raise ValueError(
+                f"num_envs and num_workers must be positive, got {num_envs} "
+                f"and {num_workers}"
+            )
+
+        if context is None:
+            context = "forkserver"
+            if context not in mp.get_all_start_methods():
+                context = "spawn"
+        ctx = mp.get_context(context)
+
+        # Importing pyglet.gl creates pyglet's shadow window, with a live
+        # OpenGL context (and a window system connection), which forked
+        # workers must not share. This includes headless pyglet, which
+        # creates an EGL shadow window, so miniworld is only preloaded
+        # when the shadow window is disabled (e.g. with the EGL backend).
+        if context == "forkserver" and not pyglet.options["shadow_window"]:
+            ctx.set_forkserver_preload(["miniworld.preload"])
+
+        self.num_envs = num_envs
+        self.copy = copy
+        self.autoreset_mode = AutoresetMode(autoreset_mode)
+
+        # Environments of each worker
+        bounds = np.linspace(0, num_envs, num_workers + 1).astype(int)
+        self.slices = [slice(bounds[i], bounds[i + 1]) for i in range(num_workers)]
+
+        self.conns = []
+        self.processes = []
+        for idx, env_slice in enumerate(self.slices):
+            parent_conn, child_conn = ctx.Pipe()
+            cpu = cpus[idx % len(cpus)] if pin_cpus else None
+            process = ctx.Process(
+                target=_worker,
+                args=(
+                    child_conn,
+                    env_id,
+                    env_slice.stop - env_slice.start,
+                    self.autoreset_mode,
+                    cpu,
+                    kwargs,
+                ),
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+
+        obs_space, action_space, metadata, render_mode = self._recv_all()[0]
+
+        if not isinstance(obs_space, spaces.Box) or obs_space.dtype != np.uint8:
+            for process in self.processes:
+                process.terminate()
+            raise ValueError(
+                f"only RGB image observations are supported, got {obs_space}"
+            )
+        self.single_observation_space = obs_space
+        self.single_action_space = action_space
+        self.observation_space = batch_space(obs_space, num_envs)
+        self.action_space = batch_space(action_space, num_envs)
+        self.metadata = metadata
+        self.render_mode = render_mode
+
+        # Observations of all the environments, written by the workers
+        shape = (num_envs,) + obs_space.shape
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self._observations = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+        for conn, env_slice in zip(self.conns, self.slices):
+            conn.send((self.shm.name, shape, env_slice.start))
+
+        self._rewards = np.zeros((num_envs,), dtype=np.float64)
+        self._terminations = np.zeros((num_envs,), dtype=np.bool_)
+        self._truncations = np.zeros((num_envs,), dtype=np.bool_)
+
+    def _recv_all(self):
+        """
+        Receive the results of a command from all the workers, raising
+        the first error once all of them have answered
+        """
+
+        results = [conn.recv() for conn in self.conns]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        return results
+
+    def reset(
+        self,
+        *,
+        seed: Optional[int] = None,
+        options: Optional[dict] = None,
+    ):
+        """
+        Reset all the environments
+        """
+
+        if seed is None:
+            seed = [None] * self.num_envs
+        elif isinstance(seed, int):
+            seed = [seed + i for i in range(self.num_envs)]
+        if len(seed) != self.num_envs:
+            raise ValueError(f"expected {self.num_envs} seeds, got {len(seed)}")
+
+        for conn, env_slice in zip(self.conns, self.slices):
+            conn.send(("reset", (seed[env_slice], options)))
+
+        infos = {}
+        for env_infos, env_slice in zip(self._recv_all(), self.slices):
+            for i, info in enumerate(env_infos, env_slice.start):
+                infos = self._add_info(infos, info, i)
+
+        return self._get_obs(), infos
+
+    def step(self, actions):
+        """
+        Step all the environments, resetting those whose episode ended
+        """
+
+        actions = np.asarray(actions)
+        for conn, env_slice in zip(self.conns, self.slices):
+            conn.send(("step", actions[env_slice]))
+
+        infos = {}
+        for result, env_slice in zip(self._recv_all(), self.slices):
+            (
+                self._rewards[env_slice],
+                self._terminations[env_slice],
+                self._truncations[env_slice],
+                env_infos,
+            ) = result
+            for i, info in enumerate(env_infos, env_slice.start):
+                infos = self._add_info(infos, info, i)
+
+        return (
+            self._get_obs(),
+            np.copy(self._rewards),
+            np.copy(self._terminations),
+            np.copy(self._truncations),
+            infos,
+        )
+
+    def _get_obs(self):
+        return np.copy(self._observations) if self.copy else self._observations
+
+    def render(self):
+        return self.call("render")
+
+    def call(self, name, *args, **kwargs):
+        """
+        Call a method, or get an attribute, of every environment
+        """
+
+        for conn in self.conns:
+            conn.send(("call", (name, args, kwargs)))
+
+        return tuple(result for results in self._recv_all() for result in results)
+
+    def get_attr(self, name):
+        return self.call(name)
+
+    def set_attr(self, name, values):
+        if not isinstance(values, (list, tuple)):
+            values = [values] * self.num_envs
+        if len(values) != self.num_envs:
+            raise ValueError(f"expected {self.num_envs} values, got {len(values)}")
+
+        for conn, env_slice in zip(self.conns, self.slices):
+            conn.send(("set_attr", (name, values[env_slice])))
+        self._recv_all()
+
+    def close_extras(self, **kwargs):
+        for conn in self.conns:
+            conn.send(("close", None))
+        self._recv_all()
+        for process in self.processes:
+            process.join()
+
+        self._observations = None
+        self.shm.close()
+        self.shm.unlink()
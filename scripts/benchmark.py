@@ -9,8 +9,7 @@ import gymnasium as gym
 # Benchmark loading time
 st = time.time()
 env = gym.make("MiniWorld-Maze-v0")
-env.seed(0)
-env.reset()
+env.reset(seed=0)
 load_time = 1000 * (time.time() - st)
 
 # Benchmark the reset time
@@ -21,6 +20,7 @@ reset_time = 1000 * (time.time() - st) / 100
 
 # Benchmark the rendering/update speed
 num_frames = 0
+draw_counts = {}
 st = time.time()
 
 while True:
@@ -36,6 +36,9 @@ while True:
     if termination or truncation:
         env.reset()
 
+    for name, count in env.unwrapped.draw_counts.items():
+        draw_counts[name] = draw_counts.get(name, 0) + count
+
     num_frames += 1
 
 fps = num_frames / dt
@@ -46,5 +49,7 @@ print(f"load time: {int(load_time)} ms")
 print(f"reset time: {reset_time:,.1f} ms")
 print(f"frame time: {frame_time:,.1f} ms")
 print(f"frame rate: {fps:,.1f} FPS")
+for name, count in draw_counts.items():
+    print(f"{name} per frame: {count / num_frames:,.1f}")
 
 env.close()
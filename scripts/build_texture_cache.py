@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Decode all the textures once and store them in a memory-mapped cache
+(see miniworld/texcache.py), e.g.:
+
+scripts/build_texture_cache.py
+scripts/build_texture_cache.py --max_size 128
+
+A cache written elsewhere with --cache_dir is only read by environments
+run with the MINIWORLD_TEXTURE_CACHE environment variable set to it.
+"""
+
+import argparse
+import glob
+import os
+import time
+from multiprocessing import Pool
+
+import miniworld  # noqa: F401
+from miniworld.texcache import CACHE_DIR, RESOURCE_DIR, TextureCache, decode_image
+
+parser = argparse.ArgumentParser(description="Build the texture cache")
+parser.add_argument(
+    "--max_size",
+    type=int,
+    default=None,
+    help="maximum texture size, larger textures are downsampled",
+)
+parser.add_argument(
+    "--cache_dir",
+    default=None,
+    help="output directory (default: MINIWORLD_TEXTURE_CACHE, or "
+    "~/.cache/miniworld/textures), the cache is only used if "
+    "MINIWORLD_TEXTURE_CACHE points to it",
+)
+parser.add_argument(
+    "--num_workers", type=int, default=os.cpu_count(), help="decoding processes"
+)
+args = parser.parse_args()
+
+tex_paths = sorted(
+    glob.glob(os.path.join(RESOURCE_DIR, "textures", "**", "*.png"), recursive=True)
+    + glob.glob(os.path.join(RESOURCE_DIR, "meshes", "*.png"))
+)
+
+print(f"decoding {len(tex_paths)} textures")
+start = time.time()
+
+with Pool(args.num_workers) as pool:
+    path = TextureCache.build(
+        tex_paths,
+        max_size=args.max_size,
+        cache_dir=args.cache_dir,
+        decode=lambda paths: pool.imap(decode_image, paths, chunksize=16),
+    )
+
+size = os.path.getsize(path + ".bin")
+print(f"wrote {path}.bin ({size / 2**20:.1f} MB) in {time.time() - start:.1f} s")
+
+if os.path.realpath(os.path.dirname(path)) != os.path.realpath(CACHE_DIR):
+    print(f"set MINIWORLD_TEXTURE_CACHE={os.path.dirname(path)} to use this cache")
@@ -61,7 +61,11 @@ setup(
         "pyglet>=1.5.27,<2.0",
         "gymnasium>=0.29.1",
     ],
-    extras_require={"testing": ["pytest>=7.0.1", "torch"]},
+    extras_require={
+        "testing": ["pytest>=7.0.1", "torch"],
+        # In-process and multiprocess vector environments (miniworld.vector)
+        "vector": ["gymnasium>=1.1.0"],
+    },
     # Include textures and meshes in the package
     include_package_data=True,
     classifiers=[
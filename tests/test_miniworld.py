@@ -1,14 +1,24 @@
 import math
+import os
 import pickle
+import subprocess
+import sys
 import warnings
 
 import gymnasium as gym
+import numpy as np
 import pytest
 from gymnasium.utils.env_checker import check_env, data_equivalence
 
 import miniworld
-from miniworld.entity import TextFrame
-from miniworld.miniworld import MiniWorldEnv
+from miniworld import objmesh, texcache
+from miniworld.entity import Box, TextFrame
+from miniworld.math import intersect_circle_segs
+from miniworld.miniworld import MiniWorldEnv, render_obs_batch
+from miniworld.objmesh import ObjMesh
+from miniworld.opengl import FrameBuffer, Texture
+from miniworld.texcache import TextureCache
+from miniworld.utils import get_file_path, image_size
 from miniworld.wrappers import PyTorchObsWrapper, StochasticActionWrapper
 
 miniworld_env_ids = [env_id for env_id in gym.registry if "MiniWorld" in env_id]
@@ -95,6 +105,731 @@ def test_collision_detection():
     env.close()
 
 
+def test_static_geometry():
+    # The room geometry is uploaded into vertex buffers, one range per texture
+    env = gym.make("MiniWorld-ThreeRooms-v0").unwrapped
+    env.reset()
+
+    geom = env.static_geom
+    textures = set()
+    num_verts = 0
+    for room in env.rooms:
+        textures.update([room.floor_tex, room.wall_tex])
+        num_verts += 3 * (room.floor_verts.shape[0] - 2)
+        num_verts += 6 * (room.wall_verts.shape[0] // 4)
+        if not room.no_ceiling:
+            textures.add(room.ceil_tex)
+            num_verts += 3 * (room.ceil_verts.shape[0] - 2)
+
+    assert geom.num_verts == num_verts
+    assert {tex for tex, _, _ in geom.ranges} == textures
+    assert sum(count for _, _, count in geom.ranges) == num_verts
+
+    env.close()
+
+
+def test_batch_render():
+    # Batched rendering into a tiled frame buffer matches render_obs,
+    # for several cameras in one world and for several worlds
+    env0 = gym.make("MiniWorld-Hallway-v0").unwrapped
+    env1 = gym.make("MiniWorld-OneRoom-v0").unwrapped
+    env0.reset(seed=0)
+    env1.reset(seed=0)
+    obs0 = env0.render_obs()
+    obs1 = env1.render_obs()
+
+    batch = render_obs_batch(
+        [(env0, env0.agent), (env1, env1.agent), (env0, env0.agent)]
+    )
+    assert batch.shape == (3,) + env0.observation_space.shape
+    assert batch.dtype == np.uint8
+    for obs, img in zip([obs0, obs1, obs0], batch):
+        assert np.abs(img.astype(int) - obs).max() <= 2
+
+    assert env0.render_obs_batch([env0.agent] * 5).shape[0] == 5
+
+    # Views of different observation sizes can't share a frame buffer
+    env2 = gym.make("MiniWorld-OneRoom-v0", obs_width=40, obs_height=30).unwrapped
+    with pytest.raises(AssertionError):
+        render_obs_batch([(env0, env0.agent), (env2, env2.agent)])
+
+    env0.close()
+    env1.close()
+    env2.close()
+
+
+def test_async_readback():
+    # Asynchronous readback returns frame t-1 and matches synchronous rendering
+    env = gym.make("MiniWorld-Hallway-v0").unwrapped
+    actions = [0, 2, 2, 1]
+
+    env.reset(seed=0)
+    expected = []
+    for action in actions:
+        env.step(action)
+        expected.append(env.render_obs())
+
+    env.reset(seed=0)
+    frames = []
+    for action in actions:
+        env.step(action)
+        frame = env.render_obs_async()
+        if frame is not None:
+            frames.append(frame)
+    assert len(frames) == len(actions) - 1
+    assert env.obs_fb.num_pending == 1
+    frames.append(env.collect_obs())
+    assert env.collect_obs() is None
+
+    for frame, obs in zip(frames, expected):
+        assert np.array_equal(frame, obs)
+
+    env.close()
+
+
+def test_top_down_readback():
+    # Flipping the projection produces the same images without a flip copy,
+    # and observations can be written into caller-provided arrays
+    env = gym.make("MiniWorld-Hallway-v0").unwrapped
+    env_td = gym.make("MiniWorld-Hallway-v0", top_down_readback=True).unwrapped
+    obs, _ = env.reset(seed=0)
+    obs_td, _ = env_td.reset(seed=0)
+    assert np.abs(obs.astype(int) - obs_td).mean() < 1
+
+    out = np.zeros(env.observation_space.shape, dtype=np.uint8)
+    assert env_td.render_obs(out=out) is out
+    assert np.array_equal(out, obs_td)
+    assert env.render_obs(out=out) is out
+    assert np.array_equal(out, obs)
+
+    out = np.zeros((4,) + env.observation_space.shape, dtype=np.uint8)
+    assert env_td.render_obs_batch([env_td.agent] * 4, out=out) is out
+    assert all(np.abs(img.astype(int) - obs_td).max() <= 2 for img in out)
+
+    env.close()
+    env_td.close()
+
+
+def test_texture_arrays():
+    # Rooms drawn through array textures look the same as with 2D textures
+    env = gym.make("MiniWorld-ThreeRooms-v0").unwrapped
+    env_ta = gym.make("MiniWorld-ThreeRooms-v0", texture_arrays=True).unwrapped
+    obs, _ = env.reset(seed=0)
+    obs_ta, _ = env_ta.reset(seed=0)
+    assert np.abs(obs.astype(int) - obs_ta).max() <= 2
+
+    # Same-sized textures share one draw call
+    geom = env_ta.static_geom
+    assert len(geom.ranges) < len(env.static_geom.ranges)
+    assert geom.num_verts == env.static_geom.num_verts
+
+    # The layers of removed textures are reused
+    arrays = env_ta.gl_context.resources.texture_arrays
+    array = next(iter(arrays.values()))
+    tex, layer = next(iter(array.layers.items()))
+    num_layers = len(array.textures)
+    array.remove(tex)
+    assert array.add(tex) == layer
+    assert len(array.textures) == num_layers
+
+    # And the arrays are deleted once their textures are released
+    # (the environments of other tests still using them are released first)
+    resources = env_ta.gl_context.resources
+    textures = [tex for array in arrays.values() for tex in array.layers]
+    owners = {owner for tex in textures for owner in resources.users[tex]}
+    for owner in owners - {env, env_ta}:
+        resources.release(owner)
+    assert all(resources.num_users(tex) in (1, 2) for tex in textures)
+    env.close()
+    assert len(arrays) > 0
+    env_ta.close()
+    assert all(resources.num_users(tex) == 0 for tex in textures)
+    assert len(arrays) == 0
+
+
+def test_instancing():
+    # Entities drawn instanced look the same as when drawn one by one
+    env = gym.make("MiniWorld-PickupObjects-v0").unwrapped
+    env_in = gym.make("MiniWorld-PickupObjects-v0", instancing=True).unwrapped
+    obs, _ = env.reset(seed=0)
+    obs_in, _ = env_in.reset(seed=0)
+    assert np.abs(obs.astype(int) - obs_in).max() <= 2
+    top = env.render_top_view()
+    top_in = env_in.render_top_view()
+    assert np.abs(top.astype(int) - top_in).max() <= 2
+
+    # The instance buffer is only refreshed when the entities move
+    box = next(ent for ent in env_in.entities if isinstance(ent, Box))
+    instances = box.instance_geom.instances
+    assert len(instances) == sum(isinstance(ent, Box) for ent in env_in.entities)
+    env_in.render_top_view()
+    assert box.instance_geom.instances is instances
+
+    env.close()
+    env_in.close()
+
+
+def test_glsl_renderer():
+    # The GLSL renderer reproduces the fixed-function lighting
+    env = gym.make("MiniWorld-PickupObjects-v0").unwrapped
+    env_gl = gym.make("MiniWorld-PickupObjects-v0", renderer="glsl").unwrapped
+    obs, _ = env.reset(seed=0)
+    obs_gl, _ = env_gl.reset(seed=0)
+    assert np.abs(obs.astype(int) - obs_gl).mean() < 0.5
+    top = env.render_top_view()
+    top_gl = env_gl.render_top_view()
+    assert np.abs(top.astype(int) - top_gl).mean() < 0.5
+
+    with pytest.raises(AssertionError):
+        gym.make("MiniWorld-OneRoom-v0", renderer="vulkan")
+
+    env.close()
+    env_gl.close()
+
+
+def test_obs_depth():
+    # RGB and depth observations are rendered in a single pass
+    env = gym.make("MiniWorld-Hallway-v0").unwrapped
+    env_d = gym.make("MiniWorld-Hallway-v0", obs_depth=True).unwrapped
+    obs, _ = env.reset(seed=0)
+    obs_d, _ = env_d.reset(seed=0)
+    assert env_d.observation_space.contains(obs_d)
+    assert np.array_equal(obs, obs_d["rgb"])
+
+    # The float depth buffer matches the 16-bit depth buffer
+    depth = env.render_depth()
+    assert np.abs(depth - obs_d["depth"]).max() < 0.01
+
+    out = np.zeros_like(obs_d["depth"])
+    _, depth_d = env_d.render_obs_depth(depth_out=out)
+    assert depth_d is out
+    assert np.array_equal(out, obs_d["depth"])
+
+    env.close()
+    env_d.close()
+
+
+def test_obs_seg():
+    # Segmentation maps are rendered alongside RGB observations
+    env = gym.make("MiniWorld-PickupObjects-v0").unwrapped
+    env_s = gym.make("MiniWorld-PickupObjects-v0", obs_seg=True).unwrapped
+    obs, _ = env.reset(seed=0)
+    obs_s, _ = env_s.reset(seed=0)
+    assert env_s.observation_space.contains(obs_s)
+    assert np.array_equal(obs, obs_s["rgb"])
+
+    # Every ID maps back to a visible room or entity
+    seg = obs_s["seg"]
+    assert env_s.seg_object(0) is None
+    for seg_id in np.unique(seg[seg > 0]):
+        obj = env_s.seg_object(int(seg_id))
+        assert obj in env_s.rooms or obj in env_s.entities
+        assert obj is not env_s.agent
+    assert any(env_s.seg_object(int(i)) in env_s.rooms for i in np.unique(seg))
+
+    # Entities sharing geometry are drawn instanced in the segmentation pass
+    ents = [env_s.seg_object(int(i)) for i in np.unique(seg[seg > 0])]
+    assert any(ent in env_s.entities and ent.instance_geom for ent in ents)
+
+    out = np.zeros_like(seg)
+    _, seg_out = env_s.render_obs_seg(seg_out=out)
+    assert seg_out is out
+    assert np.array_equal(out, seg)
+
+    env.close()
+    env_s.close()
+
+
+def test_frustum_culling():
+    # Culling the rooms and entities outside the view does not change
+    # the rendered images
+    env = gym.make("MiniWorld-Maze-v0").unwrapped
+    env_c = gym.make("MiniWorld-Maze-v0", culling=True).unwrapped
+    obs, _ = env.reset(seed=0)
+    obs_c, _ = env_c.reset(seed=0)
+    assert np.array_equal(obs, obs_c)
+    assert np.array_equal(env.render_top_view(), env_c.render_top_view())
+
+    env_c.render_obs()
+    counts = env_c.draw_counts
+    assert counts["rooms_culled"] > 0
+    assert counts["rooms"] + counts["rooms_culled"] == len(env_c.rooms)
+    assert env.draw_counts["rooms_culled"] == 0
+
+    env.close()
+    env_c.close()
+
+    # Entities behind the camera are culled
+    env = gym.make("MiniWorld-OneRoom-v0", culling=True).unwrapped
+    env.reset(seed=0)
+    env.agent.pos = env.box.pos - [2, 0, 0]
+    env.agent.dir = 0
+    env.render_obs()
+    assert env.draw_counts["entities"] == 1
+    env.agent.dir = math.pi
+    env.render_obs()
+    assert env.draw_counts["entities_culled"] == 1
+
+    env.close()
+
+
+def test_portal_culling():
+    # Only the rooms seen through portals are drawn, without changing
+    # the rendered images
+    env = gym.make("MiniWorld-Maze-v0", culling=True).unwrapped
+    env_p = gym.make("MiniWorld-Maze-v0", portal_culling=True).unwrapped
+    env.reset(seed=0)
+    env_p.reset(seed=0)
+
+    # The room adjacency graph is symmetric
+    for idx, neighbors in enumerate(env_p.portal_graph):
+        assert len(neighbors) > 0
+        for other, _, _ in neighbors:
+            assert idx in [room for room, _, _ in env_p.portal_graph[other]]
+
+    for action in [0, 0, 2, 2, 1]:
+        obs, _, _, _, _ = env.step(action)
+        obs_p, _, _, _, _ = env_p.step(action)
+        assert np.array_equal(obs, obs_p)
+        assert env_p.portal_culled
+        assert env_p.draw_counts["rooms"] < env.draw_counts["rooms"]
+
+    env.close()
+    env_p.close()
+
+
+def test_top_view_cache():
+    # The static layer of the top view is rendered once per episode,
+    # and the cached views match freshly rendered ones
+    env = gym.make("MiniWorld-PutNext-v0").unwrapped
+
+    for seed in [0, 1]:
+        env.reset(seed=seed)
+        assert not env.top_view_valid
+
+        for action in [0, 2, 4]:
+            env.step(action)
+            img = env.render_top_view()
+            assert len(env.top_view_valid) == 1
+
+            env.top_view_valid.clear()
+            assert np.array_equal(img, env.render_top_view())
+
+    # Frame buffers of the same format share the cached layer
+    for _ in range(3):
+        frame_buffer = FrameBuffer(
+            env.obs_width,
+            env.obs_height,
+            env.obs_fb.num_samples,
+            top_down=env.obs_fb.top_down,
+            float_depth=env.obs_fb.float_depth,
+        )
+        assert np.array_equal(env.render_top_view(frame_buffer), img)
+        frame_buffer.delete()
+    assert len(env.top_view_cache) == 1
+
+    env.close()
+
+
+def test_local_top_view_map():
+    # The local top view drawn from the cached map of the static world
+    # closely matches the one rendering the whole world
+    env = gym.make("MiniWorld-PutNext-v0").unwrapped
+    env_m = gym.make("MiniWorld-PutNext-v0", local_map_res=100).unwrapped
+    env.reset(seed=0)
+    env_m.reset(seed=0)
+
+    for action in [2, 0, 2]:
+        env.step(action)
+        env_m.step(action)
+        img = env.render_local_top_view()
+        img_m = env_m.render_local_top_view()
+        assert img_m.shape == img.shape
+        assert np.abs(img.astype(int) - img_m).mean() < 5
+
+    # The map is rendered once per episode
+    fb = env_m.local_map_fb
+    assert env_m.render_local_top_view(image_size=64).shape == (64, 64, 3)
+    assert env_m.local_map_fb is fb
+
+    # When the agent faces up, rotating the view changes nothing
+    env_m.agent.dir = np.pi / 2
+    assert np.array_equal(
+        env_m.render_local_top_view(), env_m.render_local_top_view(rotate=True)
+    )
+
+    env.close()
+    env_m.close()
+
+    # The walls are as wide as without the map, whatever its resolution
+    def walls(img):
+        return np.all(np.abs(img.astype(int) - 76) <= 1, axis=2)
+
+    env = gym.make("MiniWorld-PutNext-v0").unwrapped
+    env.reset(seed=0)
+    ref = walls(env.render_local_top_view())
+    env.close()
+
+    for res in [10, 100]:
+        env_m = gym.make("MiniWorld-PutNext-v0", local_map_res=res).unwrapped
+        env_m.reset(seed=0)
+        mask = walls(env_m.render_local_top_view())
+        assert (mask != ref).sum() < 0.02 * ref.sum()
+        env_m.close()
+
+
+def test_softrender():
+    # The software rasterizer renders top views close to the OpenGL ones
+    from miniworld import softrender
+
+    env = gym.make("MiniWorld-PutNext-v0").unwrapped
+    env.reset(seed=0)
+    env.step(2)
+
+    img = softrender.render_top_view(env)
+    assert img.shape == env.render_top_view().shape
+    assert np.abs(img.astype(int) - env.render_top_view()).mean() < 8
+
+    for rotate in [False, True]:
+        img = softrender.render_local_top_view(env, image_size=64, rotate=rotate)
+        ref = env.render_local_top_view(image_size=64, rotate=rotate)
+        assert img.shape == (64, 64, 3)
+        assert np.abs(img.astype(int) - ref).mean() < 8
+
+    env.close()
+
+
+def test_softrender_without_gl(tmp_path):
+    # Environments created without OpenGL are drawn in software, in a
+    # subprocess where pyglet.gl can't be imported
+    script = """
+import sys
+
+sys.modules["pyglet.gl"] = None
+
+import gymnasium as gym
+import numpy as np
+import pytest
+from miniworld import softrender
+
+env = gym.make("MiniWorld-PickupObjects-v0", use_gl=False).unwrapped
+obs, _ = env.reset(seed=0)
+assert obs is None
+env.step(2)
+img = softrender.render_top_view(env)
+with pytest.raises(RuntimeError):
+    env.render_top_view()
+env.close()
+np.save(sys.argv[1], img)
+"""
+    from miniworld import softrender
+
+    path = tmp_path / "top_view.npy"
+    subprocess.run([sys.executable, "-c", script, path], check=True)
+
+    # Same image as for an environment using OpenGL
+    env = gym.make("MiniWorld-PickupObjects-v0").unwrapped
+    env.reset(seed=0)
+    env.step(2)
+    assert np.array_equal(np.load(path), softrender.render_top_view(env))
+    env.close()
+
+
+def test_egl_context(tmp_path):
+    # The OpenGL backend is chosen once per process, render with the
+    # surfaceless EGL context in a subprocess
+    script = """
+import sys
+import gymnasium as gym
+import numpy as np
+import miniworld
+
+env_a = gym.make("MiniWorld-OneRoom-v0").unwrapped
+env_b = gym.make("MiniWorld-OneRoom-v0").unwrapped
+assert env_a.gl_context is env_b.gl_context
+obs_a, _ = env_a.reset(seed=0)
+obs_b, _ = env_b.reset(seed=0)
+np.savez(sys.argv[1], obs_a=obs_a, obs_b=obs_b)
+"""
+    path = tmp_path / "obs.npz"
+    env_vars = dict(os.environ, MINIWORLD_GL_CONTEXT="egl")
+    subprocess.run([sys.executable, "-c", script, path], env=env_vars, check=True)
+
+    # Same observations as with the default backend
+    env = gym.make("MiniWorld-OneRoom-v0")
+    obs, _ = env.reset(seed=0)
+    egl_obs = np.load(path)
+    assert np.array_equal(obs, egl_obs["obs_a"])
+    assert np.array_equal(obs, egl_obs["obs_b"])
+    env.close()
+
+
+def test_lazy_render():
+    # The human view resources are only created on the first render
+    env = gym.make(
+        "MiniWorld-OneRoom-v0", render_mode="rgb_array", lazy_render=True
+    ).unwrapped
+    env.reset(seed=0)
+    assert env.vis_fb is None
+    img = env.render()
+    assert img.shape == (600, 800, 3)
+    assert env.vis_fb is not None
+    env.close()
+
+    # Single-sample observations are rendered without a resolve blit,
+    # and are close to the antialiased ones
+    env = gym.make("MiniWorld-OneRoom-v0", lazy_render=True).unwrapped
+    env_1x = gym.make("MiniWorld-OneRoom-v0", lazy_render=True, obs_samples=1)
+    env_1x = env_1x.unwrapped
+    assert env_1x.obs_fb.multi_fbo is env_1x.obs_fb.final_fbo
+    obs, _ = env.reset(seed=0)
+    obs_1x, _ = env_1x.reset(seed=0)
+    assert obs_1x.shape == obs.shape
+    assert np.abs(obs.astype(np.float32) - obs_1x).mean() < 4
+    env.close()
+    env_1x.close()
+
+
+def test_max_texture_size():
+    env = gym.make("MiniWorld-OneRoom-v0")
+    obs, _ = env.reset(seed=0)
+    env.close()
+
+    # Textures are downsampled on load, and cached separately. Their size
+    # is still the size of their image, which texture coordinates use.
+    env = gym.make("MiniWorld-OneRoom-v0", max_texture_size=64)
+    obs_64, _ = env.reset(seed=0)
+    tex = env.unwrapped.rooms[0].wall_tex
+    env.close()
+
+    assert max(tex.tex.width, tex.tex.height) == 64
+    assert (tex.width, tex.height) == image_size(tex.path)
+    assert Texture.get(tex.name).tex.width > 64
+    assert np.abs(obs.astype(np.float32) - obs_64).mean() < 8
+
+
+def test_texture_cache(tmp_path, monkeypatch):
+    tex_paths = [Texture.get(name).path for name in ["brick_wall", "asphalt"]]
+    tex = Texture.get("brick_wall")
+    pixels = tex.read_pixels()
+
+    # Build a cache of the textures, and use it instead of the default one
+    cache_dir = tmp_path / "textures"
+    monkeypatch.setattr(texcache, "CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(TextureCache, "caches", {})
+    TextureCache.build(tex_paths)
+
+    # The cache files are written in place of the previous ones, if any
+    TextureCache.build(tex_paths)
+    assert sorted(os.listdir(cache_dir)) == ["texcache_full.bin", "texcache_full.json"]
+
+    for path in tex_paths:
+        cached, src_size = TextureCache.lookup(path)
+        assert np.array_equal(cached, texcache.decode_image(path))
+        assert src_size == cached.shape[1::-1]
+
+    # Textures load from the cache identically
+    cached_tex = Texture(Texture.load(tex.path), tex.name, tex.path)
+    assert np.array_equal(cached_tex.read_pixels(), pixels)
+
+    # Modified textures are decoded again
+    cache = TextureCache.open()
+    cache.textures[TextureCache.key(tex.path)]["stamp"] = [0, 0]
+    assert TextureCache.lookup(tex.path) is None
+
+
+def test_texture_index(monkeypatch):
+    assert Texture.num_variants("concrete") == 4
+    assert Texture.num_variants("brick_wall") == 1
+
+    # Variants are ordered by index, past the ninth one
+    paths = Texture.get_paths("chars/ch_0x100")
+    assert len(paths) > 9
+    assert paths[9].endswith("ch_0x100_10.png")
+
+    # Indexed textures are looked up without probing the filesystem
+    def exists(path):
+        raise AssertionError(f"probed {path}")
+
+    monkeypatch.setattr(os.path, "exists", exists)
+    assert len(Texture.get_paths("cinder_blocks")) == 1
+    assert Texture.get_paths("chars/ch_0x100_3")[0].endswith("ch_0x100_3.png")
+
+
+def test_mesh_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(objmesh, "MESH_CACHE_DIR", str(tmp_path))
+    file_path = get_file_path("meshes", "office_chair", "obj")
+
+    # The parsed mesh is written to the cache, and loaded back identically
+    mesh = ObjMesh(file_path)
+    assert len(list(tmp_path.iterdir())) == 1
+    cached = mesh._load_cached(file_path)
+    parsed = mesh._parse(file_path)
+    assert cached.keys() == parsed.keys()
+    for key in parsed:
+        assert np.array_equal(cached[key], parsed[key])
+
+    cached_mesh = ObjMesh(file_path)
+    assert np.array_equal(cached_mesh.min_coords, mesh.min_coords)
+    assert np.array_equal(cached_mesh.max_coords, mesh.max_coords)
+    assert cached_mesh.tex_paths == mesh.tex_paths
+
+    # Stale cache files are ignored
+    monkeypatch.setattr(objmesh, "MESH_CACHE_VERSION", -1)
+    assert mesh._load_cached(file_path) is None
+
+    # The cache can be disabled, and is then neither read nor written
+    monkeypatch.setattr(objmesh, "MESH_CACHE_DIR", None)
+    ObjMesh(file_path)
+    assert mesh._load_cached(file_path) is None
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_mesh_geometry():
+    # The barrel mesh has two materials using the same texture
+    mesh = ObjMesh.get("barrel")
+    textures = [tex for tex in mesh.textures if tex is not None]
+    assert len(textures) == 2
+    assert textures[0] is textures[1]
+    assert textures[0] is Texture.get_file(mesh.tex_paths[0])
+
+    # One indexed vertex buffer, with identical vertices merged, and
+    # chunks covering all the indices
+    geom = mesh.instanced_geom
+    assert len(geom.data) < len(geom.indices)
+    assert geom.indices.max() == len(geom.data) - 1
+    assert sum(count for _, _, count in geom.chunks) == len(geom.indices)
+
+
+def test_shared_context():
+    # Environments share one OpenGL context, without clobbering each
+    # other's static geometry
+    env0 = gym.make("MiniWorld-PickupObjects-v0").unwrapped
+    env1 = gym.make("MiniWorld-Maze-v0").unwrapped
+    assert env0.gl_context is env1.gl_context
+    assert env0.static_list != env1.static_list
+
+    obs0, _ = env0.reset(seed=1)
+    env1.reset(seed=2)
+    env1.step(env1.actions.move_forward)
+    assert np.array_equal(env0.render_obs(), obs0)
+
+    # Resources still used by another environment are kept on close
+    env2 = gym.make("MiniWorld-PickupObjects-v0").unwrapped
+    env2.reset(seed=1)
+    resources = env0.gl_context.resources
+    mesh = next(ent.mesh for ent in env0.entities if hasattr(ent, "mesh"))
+    num_users = resources.num_users(mesh)
+    assert num_users >= 2
+    env2.close()
+    assert resources.num_users(mesh) == num_users - 1
+    assert mesh in ObjMesh.cache.values()
+
+    # And released once the last environment using them is closed
+    # (the environments of other tests still using them are released first)
+    wall_tex = env1.rooms[0].wall_tex
+    owners = set(resources.users[mesh]) | set(resources.users[wall_tex])
+    for owner in owners - {env0, env1}:
+        resources.release(owner)
+    assert resources.num_users(mesh) == 1
+    env0.close()
+    assert resources.num_users(mesh) == 0
+    assert resources.num_users(wall_tex) == 1
+    assert mesh not in ObjMesh.cache.values()
+    assert mesh.instanced_geom.vbo is None
+    assert wall_tex in Texture.tex_cache.values()
+    env1.close()
+    assert resources.num_users(wall_tex) == 0
+    assert wall_tex not in Texture.tex_cache.values()
+
+
+def test_vector_env():
+    # Worlds stepped and rendered together match separate environments,
+    # and are reset on the step after their episode ends
+    vector = pytest.importorskip("miniworld.vector")
+    num_envs = 3
+    venv = vector.MiniWorldVectorEnv("MiniWorld-Hallway-v0", num_envs)
+    venv.set_attr("max_episode_steps", 2)
+    envs = [gym.make("MiniWorld-Hallway-v0").unwrapped for _ in range(num_envs)]
+    for env in envs:
+        env.max_episode_steps = 2
+
+    obs, _ = venv.reset(seed=0)
+    assert obs.shape == venv.observation_space.shape
+    expected = [env.reset(seed=i)[0] for i, env in enumerate(envs)]
+
+    actions = np.array([2, 1, 0])
+    for step in range(4):
+        # The batched rendering may differ by one on a few edge pixels
+        for img, ref in zip(obs, expected):
+            assert np.abs(img.astype(int) - ref).max() <= 1
+
+        obs, rewards, terminations, truncations, _ = venv.step(actions)
+        if step == 2:
+            # Reset step
+            expected = [env.reset()[0] for env in envs]
+            assert not truncations.any()
+        else:
+            results = [env.step(a) for env, a in zip(envs, actions)]
+            expected = [result[0] for result in results]
+            assert truncations.tolist() == [result[3] for result in results]
+
+    with pytest.raises(ValueError):
+        venv.set_attr("max_episode_steps", [2, 2])
+    with pytest.raises(ValueError):
+        venv.reset(seed=[0, 1])
+    venv.close()
+
+    with pytest.raises(ValueError):
+        vector.MiniWorldVectorEnv("MiniWorld-Hallway-v0", 0)
+
+
+def test_async_vector_env():
+    # Workers render into shared memory, with the same results as a single
+    # process, whatever the number of workers
+    vector = pytest.importorskip("miniworld.vector")
+    venv = vector.MiniWorldVectorEnv("MiniWorld-Hallway-v0", 3)
+    assert venv.envs[0] is not venv.envs[0].unwrapped
+    aenv = vector.MiniWorldAsyncVectorEnv("MiniWorld-Hallway-v0", 3, num_workers=2)
+    assert aenv.observation_space == venv.observation_space
+    aenv.set_attr("max_episode_steps", 2)
+    venv.set_attr("max_episode_steps", 2)
+
+    results = [aenv.reset(seed=0)], [venv.reset(seed=0)]
+    actions = np.array([2, 1, 0])
+    for _ in range(3):
+        results[0].append(aenv.step(actions))
+        results[1].append(venv.step(actions))
+
+    for result, expected in zip(*results):
+        # The workers render smaller batches, which may differ by one on a few
+        # edge pixels
+        assert np.abs(result[0].astype(int) - expected[0]).max() <= 1
+        for value, expected_value in zip(result[1:-1], expected[1:-1]):
+            assert np.array_equal(value, expected_value)
+    assert aenv.get_attr("step_count") == (0, 0, 0)
+
+    aenv.close()
+    venv.close()
+
+
+def test_wall_grid():
+    # The grid index gives the same collisions as testing all the walls
+    env = gym.make("MiniWorld-Maze-v0").unwrapped
+    env.reset(seed=0)
+    rng = np.random.default_rng(0)
+
+    for _ in range(500):
+        x = rng.uniform(env.min_x - 1, env.max_x + 1)
+        z = rng.uniform(env.min_z - 1, env.max_z + 1)
+        pos = np.array([x, 0, z])
+        radius = rng.uniform(0.05, 1.5)
+        expected = intersect_circle_segs(pos, radius, env.wall_segs)
+        assert env.wall_grid.intersect_circle(pos, radius) == expected
+
+    env.close()
+
+
 @pytest.mark.parametrize("env_id", miniworld_env_ids)
 def test_all_envs(env_id):
     # Try loading each of the available environments